@@ -0,0 +1,329 @@
+import os
+import re
+import time
+import heapq
+import random
+import itertools
+import threading
+import openai
+import requests
+
+# Central scheduler for every outbound API call made by the agents.
+# It keeps a request and token budget per model, orders waiting calls by priority,
+# follows the rate limit headers the APIs send back and retries 429s, timeouts and
+# 5xx errors with jittered exponential backoff.
+
+# Lower numbers go first
+priority_toc = 0
+priority_research = 1
+priority_chapter = 2
+priority_summary = 3
+priority_image = 4
+priority_download = 5
+
+# Raised for HTTP responses that are worth retrying (429 and 5xx), e.g. from Tavily
+class RetryableHTTPError(Exception):
+    def __init__(self, message, status_code=None, headers=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.headers = headers or {}
+
+retryable_openai_errors = (
+    openai.error.RateLimitError,
+    openai.error.Timeout,
+    openai.error.APIError,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIConnectionError,
+)
+retryable_requests_errors = (requests.exceptions.Timeout, requests.exceptions.ConnectionError)
+
+# Parse durations like "20ms", "1s", "6m0s" used by the x-ratelimit-reset-* headers
+def parse_reset_duration(value):
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    total = 0.0
+    matched = False
+    for amount, unit in re.findall(r"([\d.]+)(ms|h|m|s)", value):
+        matched = True
+        total += float(amount) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+    return total if matched else None
+
+def header_value(headers, name):
+    if not headers:
+        return None
+    for key, value in headers.items():
+        if key.lower() == name:
+            return value
+    return None
+
+# Token bucket style budget for one model, refilled continuously from per-minute limits
+class ModelBudget:
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, max_concurrent=None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_concurrent = max_concurrent
+        self.request_level = float(requests_per_minute or 0)
+        self.token_level = float(tokens_per_minute or 0)
+        self.in_flight = 0
+        # Shrinks after 429s and grows back slowly after successes
+        self.scale = 1.0
+        self.blocked_until = 0.0
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        elapsed = now - self.updated
+        self.updated = now
+        if self.requests_per_minute:
+            self.request_level = min(self.requests_per_minute, self.request_level + elapsed * self.requests_per_minute * self.scale / 60)
+        if self.tokens_per_minute:
+            self.token_level = min(self.tokens_per_minute, self.token_level + elapsed * self.tokens_per_minute * self.scale / 60)
+
+    def clamp_tokens(self, tokens):
+        return min(tokens, self.tokens_per_minute) if self.tokens_per_minute else tokens
+
+    def wait_time(self, tokens, now):
+        # Seconds until a call needing this many tokens could start, 0 if it can start now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.max_concurrent and self.in_flight >= self.max_concurrent:
+            return None  # Wait for a release
+        wait_time = 0.0
+        if self.requests_per_minute and self.request_level < 1:
+            wait_time = max(wait_time, (1 - self.request_level) * 60 / (self.requests_per_minute * self.scale))
+        tokens = self.clamp_tokens(tokens)
+        if self.tokens_per_minute and self.token_level < tokens:
+            wait_time = max(wait_time, (tokens - self.token_level) * 60 / (self.tokens_per_minute * self.scale))
+        return wait_time
+
+    def take(self, tokens):
+        self.in_flight += 1
+        if self.requests_per_minute:
+            self.request_level -= 1
+        if self.tokens_per_minute:
+            self.token_level -= self.clamp_tokens(tokens)
+
+class ApiScheduler:
+    def __init__(self, budgets=None, max_in_flight=16, max_retries=6, base_backoff=1.0, max_backoff=60.0):
+        self.budgets = budgets or {}
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.waiters = []
+        self.sequence = itertools.count()
+        self.retries = 0
+        self.rate_limited = 0
+        # Queue wait and retries of the last call made from each thread, read by the telemetry
+        self.local = threading.local()
+
+    def budget(self, model):
+        with self.condition:
+            if model not in self.budgets:
+                self.budgets[model] = ModelBudget()
+            return self.budgets[model]
+
+    def call(self, model, function, /, *args, priority=priority_chapter, tokens=0, check_cancelled=None, **kwargs):
+        # Run function(*args, **kwargs) once the model's budget allows it, retrying transient failures
+        # model and function are positional only, so the API call itself can take a model keyword
+        attempt = 0
+        queue_wait = 0.0
+        self.local.last_call = {"queue_wait": queue_wait, "retries": 0}
+        while True:
+            wait_started = time.monotonic()
+            self.acquire(model, tokens, priority, check_cancelled)
+            queue_wait += time.monotonic() - wait_started
+            self.local.last_call = {"queue_wait": queue_wait, "retries": attempt}
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                self.release(model, success=False)
+                retryable, headers = self.classify(e)
+                if not retryable or attempt >= self.max_retries:
+                    raise
+                delay = self.backoff_delay(model, attempt, e, headers)
+                attempt += 1
+                with self.condition:
+                    self.retries += 1
+                print(f"{model} call failed ({type(e).__name__}: {e}), retry {attempt}/{self.max_retries} in {delay:.1f}s")
+                self.sleep(delay, check_cancelled)
+                continue
+            self.release(model, success=True)
+            return result
+
+    def last_call_stats(self):
+        # Stats of the last call() made by the current thread
+        return dict(getattr(self.local, "last_call", {"queue_wait": 0.0, "retries": 0}))
+
+    def acquire(self, model, tokens, priority, check_cancelled=None):
+        budget = self.budget(model)
+        with self.condition:
+            entry = (priority, next(self.sequence), model, tokens)
+            heapq.heappush(self.waiters, entry)
+            try:
+                while True:
+                    if check_cancelled:
+                        check_cancelled()
+                    now = time.monotonic()
+                    chosen, wait_time = self.next_runnable(now)
+                    if chosen is entry:
+                        self.waiters.remove(entry)
+                        heapq.heapify(self.waiters)
+                        budget.take(tokens)
+                        self.in_flight += 1
+                        entry = None
+                        return
+                    if chosen is not None:
+                        # Someone else can go now, let them run first
+                        self.condition.notify_all()
+                    self.condition.wait(timeout=min(wait_time, 1.0) if wait_time else 1.0)
+            finally:
+                if entry is not None and entry in self.waiters:
+                    self.waiters.remove(entry)
+                    heapq.heapify(self.waiters)
+                    self.condition.notify_all()
+
+    def next_runnable(self, now):
+        # Best priority waiter whose model budget allows it right now.
+        # A waiter blocked by its own model's budget does not hold up other models.
+        if self.in_flight >= self.max_in_flight:
+            return None, None
+        soonest = None
+        blocked_models = set()
+        for entry in sorted(self.waiters):
+            priority, sequence, model, tokens = entry
+            if model in blocked_models:
+                continue  # Keep order within a model
+            budget = self.budgets[model]
+            budget.refill(now)
+            wait_time = budget.wait_time(tokens, now)
+            if wait_time == 0:
+                return entry, None
+            blocked_models.add(model)
+            if wait_time is not None:
+                soonest = wait_time if soonest is None else min(soonest, wait_time)
+        return None, soonest
+
+    def release(self, model, success):
+        with self.condition:
+            budget = self.budgets[model]
+            budget.in_flight -= 1
+            self.in_flight -= 1
+            if success:
+                budget.scale = min(1.0, budget.scale + 0.02)
+            self.condition.notify_all()
+
+    def refund(self, model, tokens):
+        # Return tokens reserved up front (prompt plus max_tokens) that the call did not use
+        if tokens <= 0:
+            return
+        with self.condition:
+            budget = self.budgets.get(model)
+            if budget and budget.tokens_per_minute:
+                budget.token_level = min(budget.tokens_per_minute, budget.token_level + tokens)
+                self.condition.notify_all()
+
+    def classify(self, error):
+        if isinstance(error, retryable_openai_errors):
+            return True, getattr(error, "headers", None)
+        if isinstance(error, RetryableHTTPError):
+            return True, error.headers
+        if isinstance(error, retryable_requests_errors):
+            return True, None
+        return False, None
+
+    def backoff_delay(self, model, attempt, error, headers):
+        rate_limited = isinstance(error, openai.error.RateLimitError) or getattr(error, "status_code", None) == 429
+        retry_after = parse_reset_duration(header_value(headers, "retry-after"))
+        if rate_limited:
+            with self.condition:
+                self.rate_limited += 1
+                budget = self.budgets[model]
+                # Multiplicative decrease, the budget grows back after successful calls
+                budget.scale = max(0.25, budget.scale * 0.7)
+            self.observe_headers(model, headers)
+        delay = min(self.max_backoff, self.base_backoff * 2 ** attempt) * random.uniform(0.5, 1.5)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        if rate_limited:
+            with self.condition:
+                budget = self.budgets[model]
+                budget.blocked_until = max(budget.blocked_until, time.monotonic() + delay)
+        return delay
+
+    def observe_headers(self, model, headers):
+        # Align the local budget with what the API reports as remaining
+        if not headers:
+            return
+        with self.condition:
+            budget = self.budgets.get(model)
+            if budget is None:
+                return
+            now = time.monotonic()
+            budget.refill(now)
+            remaining_requests = header_value(headers, "x-ratelimit-remaining-requests")
+            remaining_tokens = header_value(headers, "x-ratelimit-remaining-tokens")
+            try:
+                if remaining_requests is not None and budget.requests_per_minute:
+                    budget.request_level = min(budget.request_level, float(remaining_requests))
+                if remaining_tokens is not None and budget.tokens_per_minute:
+                    budget.token_level = min(budget.token_level, float(remaining_tokens))
+            except ValueError:
+                return
+            if remaining_requests is not None and float(remaining_requests) <= 0:
+                reset = parse_reset_duration(header_value(headers, "x-ratelimit-reset-requests"))
+                if reset:
+                    budget.blocked_until = max(budget.blocked_until, now + reset)
+            self.condition.notify_all()
+
+    def sleep(self, delay, check_cancelled=None):
+        end = time.monotonic() + delay
+        while True:
+            if check_cancelled:
+                check_cancelled()
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(min(remaining, 0.5))
+
+    def stats(self):
+        with self.condition:
+            return {"retries": self.retries, "rate_limited": self.rate_limited, "in_flight": self.in_flight}
+
+default_scheduler = None
+default_scheduler_lock = threading.Lock()
+
+# One scheduler per process, so every agent and every book share the same budgets
+def get_scheduler():
+    global default_scheduler
+    with default_scheduler_lock:
+        if default_scheduler is None:
+            default_scheduler = ApiScheduler(
+                {
+                    "gpt-4o": ModelBudget(
+                        requests_per_minute=int(os.getenv("OPENAI_RPM", "500")),
+                        tokens_per_minute=int(os.getenv("OPENAI_TPM", "30000")),
+                    ),
+                    "dall-e-3": ModelBudget(
+                        requests_per_minute=int(os.getenv("IMAGES_PER_MINUTE", "5")),
+                        max_concurrent=int(os.getenv("MAX_CONCURRENT_IMAGES", "3")),
+                    ),
+                    "tavily": ModelBudget(requests_per_minute=int(os.getenv("TAVILY_RPM", "100"))),
+                },
+                max_in_flight=int(os.getenv("MAX_API_CALLS_IN_FLIGHT", "16")),
+                max_retries=int(os.getenv("MAX_RETRIES", "6")),
+            )
+        return default_scheduler
+
+# Change the limits of the shared scheduler, e.g. from command line options
+def configure_model_budget(model, requests_per_minute=None, tokens_per_minute=None, max_concurrent=None):
+    scheduler = get_scheduler()
+    with scheduler.condition:
+        scheduler.budgets[model] = ModelBudget(requests_per_minute, tokens_per_minute, max_concurrent)
+        scheduler.condition.notify_all()
@@ -0,0 +1,134 @@
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import contextlib
+import tracemalloc
+from api_scheduler import configure_model_budget, get_scheduler
+from mock_provider import MockProvider
+from response_cache import ResponseCache
+from ebook_engine import BookGenerator, default_max_concurrent_chapters, max_concurrent_images
+
+# resource is not available on Windows
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Offline end-to-end benchmark: generates whole books (research, TOC, chapters, images, merge) against
+# the mock provider and reports wall time, peak memory and the concurrency the pipeline reached.
+# Nothing is sent to OpenAI or Tavily, so runs are free and repeatable:
+#
+#   python benchmark.py --chapters 5 20 100 --images --latency 0.2
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the generation pipeline against a local mock backend.")
+    parser.add_argument("--chapters", type=int, nargs="+", default=[5, 20, 100], help="Book sizes to run (default: 5 20 100)")
+    parser.add_argument("--images", action="store_true", help="Generate cover and chapter images")
+    parser.add_argument("--stream", action="store_true", help="Stream chapter text")
+    parser.add_argument("--concurrency", type=int, default=default_max_concurrent_chapters, help="Chapters in flight")
+    parser.add_argument("--latency", type=float, default=0.05, help="Simulated seconds per API call (images take 4x)")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="Share of calls answered with a rate limit error")
+    parser.add_argument("--words", type=int, default=800, help="Words per generated chapter")
+    parser.add_argument("--rpm", type=int, default=100000, help="Requests per minute allowed by the scheduler")
+    parser.add_argument("--tpm", type=int, default=100000000, help="Tokens per minute allowed by the scheduler")
+    parser.add_argument("--images-per-minute", type=int, default=100000, help="Image requests per minute allowed")
+    parser.add_argument("--backoff", type=float, default=0.05, help="Base retry backoff in seconds")
+    parser.add_argument("--cache", action="store_true", help="Use a fresh response cache for each run")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the simulated rate limit errors")
+    parser.add_argument("--json", help="Also write the results to this JSON file")
+    parser.add_argument("--keep", action="store_true", help="Keep the generated books instead of deleting them")
+    parser.add_argument("--verbose", action="store_true", help="Show the engine's output")
+    return parser.parse_args(argv)
+
+def configure_scheduler(args):
+    configure_model_budget("gpt-4o", args.rpm, args.tpm)
+    configure_model_budget("dall-e-3", args.images_per_minute, None, max_concurrent_images)
+    configure_model_budget("tavily", args.rpm)
+    scheduler = get_scheduler()
+    scheduler.base_backoff = args.backoff
+    return scheduler
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def run_book(chapter_count, args, scheduler):
+    provider = MockProvider(
+        latency=args.latency,
+        rate_limit_rate=args.rate_limit,
+        toc_chapters=chapter_count,
+        chapter_words=args.words,
+        seed=args.seed,
+    )
+    output_root = tempfile.mkdtemp(prefix="ebook_benchmark_")
+    cache = ResponseCache(os.path.join(output_root, "cache.sqlite3")) if args.cache else None
+    engine = BookGenerator(
+        f"Benchmark book with {chapter_count} chapters", "mock-key", cache,
+        scheduler=scheduler, output_root=output_root, provider=provider
+    )
+    retries_before = scheduler.stats()["retries"]
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        with output:
+            engine.run(None, args.images, args.concurrency, args.stream)
+        elapsed = time.perf_counter() - started
+        peak_heap = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        if cache:
+            cache.close()
+        if not args.keep:
+            shutil.rmtree(output_root, ignore_errors=True)
+
+    stats = provider.stats()
+    return {
+        "chapters": chapter_count,
+        "chapters_written": len(engine.chapters),
+        "wall_seconds": round(elapsed, 3),
+        "chapters_per_minute": round(len(engine.chapters) * 60 / elapsed, 1),
+        "peak_heap_mb": round(peak_heap / (1024 * 1024), 1),
+        "peak_rss_mb": round(peak_rss_mb(), 1) if resource else None,
+        "peak_concurrency": stats["peak_in_flight"],
+        "average_concurrency": round(stats["busy_seconds"] / elapsed, 2),
+        "calls": stats["calls"],
+        "rate_limited": stats["rate_limited"],
+        "retries": scheduler.stats()["retries"] - retries_before,
+        "output": output_root if args.keep else None,
+    }
+
+def print_results(results):
+    print(f"{'chapters':>8} {'wall s':>8} {'ch/min':>8} {'heap MB':>8} {'rss MB':>8} {'peak conc':>9} {'avg conc':>8} {'retries':>7}")
+    for result in results:
+        rss = f"{result['peak_rss_mb']:.1f}" if result["peak_rss_mb"] is not None else "-"
+        print(
+            f"{result['chapters']:>8} {result['wall_seconds']:>8.2f} {result['chapters_per_minute']:>8.1f} "
+            f"{result['peak_heap_mb']:>8.1f} {rss:>8} {result['peak_concurrency']:>9} "
+            f"{result['average_concurrency']:>8.2f} {result['retries']:>7}"
+        )
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    scheduler = configure_scheduler(args)
+    results = []
+    for chapter_count in args.chapters:
+        results.append(run_book(chapter_count, args, scheduler))
+        print(f"{chapter_count} chapters done in {results[-1]['wall_seconds']:.2f}s")
+    print_results(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump({"settings": vars(args), "results": results}, file, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,115 @@
+import os
+from run_manifest import atomic_write_chunks, atomic_write_text
+from image_assets import ImageStore
+from ebook_engine import build_back_matter, build_front_matter, sanitize_filename
+
+# The Final Content of a book split into segments: the front matter, one per chapter and the
+# back matter. The editor only holds the segment being edited, the others stay here as plain
+# strings. Saving writes the chapters that changed to their own .md files and streams the
+# merged book file from the segments, in the same layout as merge_chapters_into_single_content.
+
+class BookDocument:
+    def __init__(self, book_folder, topic, chapter_titles):
+        self.book_folder = book_folder
+        self.topic = topic
+        self.segments = [{"title": "Front matter", "file": None, "pieces": [build_front_matter(topic, chapter_titles)], "dirty": False}]
+        for chapter_title in chapter_titles:
+            self.segments.append({
+                "title": chapter_title,
+                "file": f"{sanitize_filename(chapter_title)}.md",
+                "pieces": [],
+                "dirty": False,
+            })
+        self.segments.append({"title": "Back matter", "file": None, "pieces": [build_back_matter()], "dirty": False})
+
+    @property
+    def chapter_count(self):
+        return len(self.segments) - 2
+
+    def chapter_segment(self, chapter_index):
+        return chapter_index + 1
+
+    def label(self, index):
+        segment = self.segments[index]
+        return f"* {segment['title']}" if segment["dirty"] else segment["title"]
+
+    def labels(self):
+        return [self.label(index) for index in range(len(self.segments))]
+
+    def text(self, index):
+        # Streamed pieces are joined once, when the text is first needed
+        pieces = self.segments[index]["pieces"]
+        if len(pieces) > 1:
+            pieces[:] = ["".join(pieces)]
+        return pieces[0] if pieces else ""
+
+    def set_text(self, index, text):
+        # Returns True when the text changed, the segment is then saved with the next save
+        if text == self.text(index):
+            return False
+        self.segments[index]["pieces"] = [text]
+        self.segments[index]["dirty"] = True
+        return True
+
+    def append_text(self, index, text):
+        # Text streamed by the generator, it is already in the chapter file
+        self.segments[index]["pieces"].append(text)
+
+    def load_chapter(self, chapter_index, chapter_content):
+        # Finished chapter from the generator, edits made in the meantime are kept
+        segment = self.segments[self.chapter_segment(chapter_index)]
+        if not segment["dirty"]:
+            segment["pieces"] = [chapter_content]
+
+    def mark_dirty(self, index):
+        self.segments[index]["dirty"] = True
+
+    def is_dirty(self):
+        return any(segment["dirty"] for segment in self.segments)
+
+    def iter_markdown(self):
+        # The chapter texts themselves are yielded, not copies with the separators added
+        yield self.text(0)
+        for index in range(1, len(self.segments) - 1):
+            yield "\n\n"
+            yield self.text(index)
+            yield "\n\n"
+        yield self.text(len(self.segments) - 1)
+
+    def markdown(self):
+        return "".join(self.iter_markdown())
+
+    def merged_path(self):
+        return os.path.join(self.book_folder, f"{sanitize_filename(self.topic)}.md")
+
+    def write_merged(self, path):
+        atomic_write_chunks(path, self.iter_markdown())
+
+    def take_changes(self):
+        # What the next save has to write, as plain strings, so it can be written on another
+        # thread while the document keeps changing. The segments count as saved from here on.
+        chapters = {}
+        for index, segment in enumerate(self.segments):
+            if segment["dirty"] and segment["file"]:
+                chapters[segment["file"]] = self.text(index)
+            segment["dirty"] = False
+        return {
+            "book_folder": self.book_folder,
+            "chapters": chapters,
+            "merged": list(self.iter_markdown()),
+            "merged_path": self.merged_path(),
+        }
+
+    def save(self, manifest=None):
+        return write_changes(self.take_changes(), manifest)
+
+# Returns the number of chapter files written and the path of the merged file
+def write_changes(changes, manifest=None):
+    for chapter_file, text in changes["chapters"].items():
+        atomic_write_text(os.path.join(changes["book_folder"], chapter_file), text)
+        if manifest:
+            manifest.chapter_edited(os.path.splitext(chapter_file)[0], text)
+    # The editor links images by name, the merged book links their web variants
+    resolve_links = ImageStore(changes["book_folder"]).link_resolver(manifest.image_hashes() if manifest else {})
+    atomic_write_chunks(changes["merged_path"], (resolve_links(chunk) for chunk in changes["merged"]))
+    return len(changes["chapters"]), changes["merged_path"]
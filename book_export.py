@@ -0,0 +1,625 @@
+import os
+import re
+import html
+import json
+import time
+import uuid
+import shutil
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from run_manifest import RunManifest, content_hash, file_hash
+from image_assets import ImageStore, process_context
+
+# fpdf2 and pypdf are optional, without them only EPUB export is available
+try:
+    from fpdf import FPDF
+    from fpdf.fonts import FontFace
+except ImportError:
+    FPDF = FontFace = None
+try:
+    from pypdf import PdfReader, PdfWriter
+except ImportError:
+    PdfReader = PdfWriter = None
+# Pillow is optional, without it images are exported as they are
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# PDF and EPUB export of a finished book.
+#
+# The book's Markdown is split into the front matter and one part per chapter. Every part is
+# rendered on its own, in a process pool, to a PDF or XHTML fragment that is cached in the
+# book's .export folder under a hash of its Markdown, its images and the export settings.
+# The fragments are then stitched together with the cover and a table of contents, so
+# exporting again after editing one chapter only renders that chapter again.
+
+export_formats = ("pdf", "epub")
+export_folder_name = ".export"
+# Bump when the rendering changes, so cached fragments are rendered again
+export_version = 1
+export_workers = int(os.getenv("EXPORT_WORKERS", str(min(8, os.cpu_count() or 1))))
+
+# Longest image side in pixels and JPEG quality, per format
+image_settings = {
+    "pdf": (int(os.getenv("PDF_IMAGE_MAX_PX", "1200")), int(os.getenv("PDF_IMAGE_QUALITY", "80"))),
+    "epub": (int(os.getenv("EPUB_IMAGE_MAX_PX", "1000")), int(os.getenv("EPUB_IMAGE_QUALITY", "75"))),
+}
+
+# A Unicode TTF font for the PDF, without one the core Helvetica font is used and
+# characters outside Latin-1 are replaced
+pdf_font_candidates = [
+    os.getenv("PDF_FONT_PATH", ""),
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/TTF/DejaVuSans.ttf",
+    "/usr/share/fonts/dejavu/DejaVuSans.ttf",
+    "/Library/Fonts/Arial Unicode.ttf",
+    "C:\\Windows\\Fonts\\arial.ttf",
+]
+pdf_font_styles = {
+    "B": ("-Bold", "bd"),
+    "I": ("-Oblique", "-Italic", "i"),
+    "BI": ("-BoldOblique", "-BoldItalic", "bi"),
+}
+# Width of images in the PDF, in points
+pdf_image_width = 340
+pdf_heading_sizes = {"h1": 22, "h2": 17, "h3": 14, "h4": 12, "h5": 11, "h6": 11}
+latin1_replacements = {
+    "\u2018": "'", "\u2019": "'", "\u201c": '"', "\u201d": '"', "\u2013": "-", "\u2014": "-",
+    "\u2026": "...", "\u2022": "-", "\u00a0": " ", "\u2192": "->",
+}
+
+epub_stylesheet = """body { font-family: serif; line-height: 1.5; margin: 0 5%; }
+h1, h2, h3, h4, h5, h6 { font-family: sans-serif; line-height: 1.2; }
+img { max-width: 100%; height: auto; display: block; margin: 1em auto; }
+blockquote { margin-left: 1.5em; font-style: italic; }
+pre { white-space: pre-wrap; font-size: 0.9em; }
+table { border-collapse: collapse; }
+td, th { border: 1px solid #999; padding: 0.2em 0.5em; }
+"""
+
+chapter_heading_pattern = re.compile(r"^#\s+(.+?)\s*#*\s*$")
+chapter_image_pattern = re.compile(r"^!\[[^\]]* Image\]\([^)\s]+\)\s*$")
+image_pattern = re.compile(r"!\[([^\]]*)\]\(([^)\s]+)(?:\s+\"[^\"]*\")?\)")
+link_pattern = re.compile(r"\[([^\]]+)\]\(([^)\s]+)(?:\s+\"[^\"]*\")?\)")
+list_item_pattern = re.compile(r"^(\s*)([-*+]|\d+[.)])\s+(.*)$")
+
+# Raised when a book cannot be exported, the message is meant for the user
+class ExportError(Exception):
+    pass
+
+def available_formats():
+    formats = ["epub"]
+    if FPDF is not None and PdfWriter is not None:
+        formats.insert(0, "pdf")
+    return formats
+
+# Book splitting
+
+def plain_heading(text):
+    return re.sub(r"[*_`]", "", text).strip()
+
+def split_book(markdown_text):
+    # Returns the front matter and a list of {"title", "markdown"} chapters.
+    # The first H1 is the book title, every further H1 starts a chapter. A chapter's image
+    # link sits just before its heading, so it moves into the chapter it belongs to.
+    lines = markdown_text.replace("\r\n", "\n").split("\n")
+    starts = []
+    in_fence = False
+    for number, line in enumerate(lines):
+        if line.lstrip().startswith("```"):
+            in_fence = not in_fence
+        elif not in_fence and chapter_heading_pattern.match(line):
+            starts.append(number)
+    if len(starts) < 2:
+        return markdown_text, []
+
+    boundaries = []
+    for start in starts[1:]:
+        previous = start - 1
+        while previous > 0 and not lines[previous].strip():
+            previous -= 1
+        boundaries.append(previous if chapter_image_pattern.match(lines[previous]) else start)
+
+    front_matter = strip_toc_section("\n".join(lines[:boundaries[0]]))
+    chapters = []
+    for number, boundary in enumerate(boundaries):
+        end = boundaries[number + 1] if number + 1 < len(boundaries) else len(lines)
+        title = plain_heading(chapter_heading_pattern.match(lines[starts[number + 1]]).group(1))
+        chapters.append({"title": title, "markdown": "\n".join(lines[boundary:end]).strip() + "\n"})
+    return front_matter, chapters
+
+# The exported book gets its own table of contents, with page numbers in the PDF
+def strip_toc_section(front_matter):
+    kept = []
+    skipping = False
+    for line in front_matter.split("\n"):
+        if line.startswith("#"):
+            skipping = plain_heading(line.lstrip("#")).lower() == "table of contents"
+        if not skipping:
+            kept.append(line)
+    return "\n".join(kept).strip() + "\n"
+
+def book_title(front_matter):
+    for line in front_matter.split("\n"):
+        match = chapter_heading_pattern.match(line)
+        if match:
+            return plain_heading(match.group(1))
+    return "E-Book"
+
+def image_sources(markdown_text):
+    return [match.group(2) for match in image_pattern.finditer(markdown_text)]
+
+# Markdown to XHTML, enough for what the writer produces and the editor's toolbar inserts
+
+def render_inline(text, image_map, image_width=None):
+    parts = []
+    for number, part in enumerate(re.split(r"(`[^`\n]+`)", text)):
+        if number % 2:
+            parts.append(f"<code>{html.escape(part[1:-1], quote=False)}</code>")
+            continue
+        # Image tags and link targets are set aside, so file names are not read as emphasis
+        tags = []
+
+        def set_aside(tag):
+            tags.append(tag)
+            return f"\x00{len(tags) - 1}\x00"
+
+        part = html.escape(part, quote=False)
+        part = image_pattern.sub(lambda match: set_aside(image_tag(match.group(1), match.group(2), image_map, image_width)), part)
+        part = link_pattern.sub(
+            lambda match: set_aside(f'<a href="{match.group(2).replace(chr(34), "&quot;")}">') + f"{match.group(1)}</a>", part
+        )
+        part = re.sub(r"\*\*(.+?)\*\*|__(.+?)__", lambda match: f"<b>{match.group(1) or match.group(2)}</b>", part)
+        part = re.sub(r"(?<![\w*])\*(?![\s*])(.+?)(?<![\s*])\*(?![\w*])", r"<i>\1</i>", part)
+        part = re.sub(r"(?<![\w_])_(?![\s_])(.+?)(?<![\s_])_(?![\w_])", r"<i>\1</i>", part)
+        part = re.sub(r"~~(.+?)~~", r"<del>\1</del>", part)
+        part = part.replace("&lt;u&gt;", "<u>").replace("&lt;/u&gt;", "</u>")
+        part = re.sub(r"\x00(\d+)\x00", lambda match: tags[int(match.group(1))], part)
+        parts.append(part)
+    return "".join(parts)
+
+def image_tag(alt, source, image_map, image_width=None):
+    # Images that are not in the book folder are left out
+    target = image_map.get(html.unescape(source))
+    if not target:
+        return ""
+    width = f' width="{image_width}"' if image_width else ""
+    return f'<img src="{html.escape(target)}" alt="{alt.replace(chr(34), "&quot;")}"{width} />'
+
+def markdown_to_html(markdown_text, image_map, image_width=None):
+    blocks = []
+    paragraph = []
+    list_stack = []
+    lines = markdown_text.split("\n")
+
+    def flush_paragraph():
+        if paragraph:
+            blocks.append(f"<p>{render_inline(' '.join(paragraph), image_map, image_width)}</p>")
+            paragraph.clear()
+
+    def close_lists(depth=0):
+        while len(list_stack) > depth:
+            blocks.append(f"</li></{list_stack.pop()}>")
+
+    number = 0
+    while number < len(lines):
+        line = lines[number]
+        stripped = line.strip()
+        list_item = list_item_pattern.match(line)
+        if stripped.startswith("```"):
+            flush_paragraph()
+            close_lists()
+            code = []
+            number += 1
+            while number < len(lines) and not lines[number].strip().startswith("```"):
+                code.append(lines[number])
+                number += 1
+            blocks.append(f"<pre><code>{html.escape(chr(10).join(code), quote=False)}</code></pre>")
+        elif not stripped:
+            flush_paragraph()
+            # A blank line between two items keeps the list open
+            following = next((later for later in lines[number + 1:] if later.strip()), "")
+            if list_stack and not list_item_pattern.match(following):
+                close_lists()
+        elif re.match(r"^#{1,6}\s", stripped):
+            flush_paragraph()
+            close_lists()
+            level = len(stripped) - len(stripped.lstrip("#"))
+            blocks.append(f"<h{level}>{render_inline(stripped[level:].strip().rstrip('#').strip(), image_map, image_width)}</h{level}>")
+        elif re.match(r"^([-*_])(\s*\1){2,}$", stripped):
+            flush_paragraph()
+            close_lists()
+            blocks.append("<hr />")
+        elif stripped.startswith(">"):
+            flush_paragraph()
+            close_lists()
+            quote = []
+            while number < len(lines) and lines[number].strip().startswith(">"):
+                quote.append(lines[number].strip()[1:].strip())
+                number += 1
+            blocks.append(f"<blockquote><p>{render_inline(' '.join(quote), image_map, image_width)}</p></blockquote>")
+            continue
+        elif stripped.startswith("|") and stripped.endswith("|"):
+            flush_paragraph()
+            close_lists()
+            rows = []
+            while number < len(lines) and lines[number].strip().startswith("|"):
+                cells = [cell.strip() for cell in lines[number].strip().strip("|").split("|")]
+                if not all(re.match(r"^:?-+:?$", cell) for cell in cells if cell):
+                    tag = "th" if not rows else "td"
+                    rows.append("<tr>" + "".join(f"<{tag}>{render_inline(cell, image_map, image_width)}</{tag}>" for cell in cells) + "</tr>")
+                number += 1
+            blocks.append(f"<table>{''.join(rows)}</table>")
+            continue
+        elif list_item:
+            flush_paragraph()
+            indent, marker, text = list_item.groups()
+            depth = len(indent.replace("\t", "    ")) // 2 + 1
+            tag = "ul" if marker in "-*+" else "ol"
+            if depth > len(list_stack):
+                depth = len(list_stack) + 1
+                blocks.append(f"<{tag}><li>")
+                list_stack.append(tag)
+            else:
+                close_lists(depth)
+                if list_stack[-1] != tag:
+                    close_lists(depth - 1)
+                    blocks.append(f"<{tag}><li>")
+                    list_stack.append(tag)
+                else:
+                    blocks.append("</li><li>")
+            blocks.append(render_inline(text, image_map, image_width))
+        elif list_stack and line.startswith(" "):
+            # Continuation of a list item
+            blocks.append(" " + render_inline(stripped, image_map, image_width))
+        else:
+            close_lists()
+            paragraph.append(stripped)
+        number += 1
+    flush_paragraph()
+    close_lists()
+    return "\n".join(blocks)
+
+# Images
+
+def prepare_image(source_path, source_hash, export_format, images_folder):
+    # Downscaled and recompressed copy of an image, named after its content and the settings
+    # so every chapter and every export reuses the same file
+    max_px, quality = image_settings[export_format]
+    if Image is None:
+        extension = os.path.splitext(source_path)[1].lower() or ".png"
+        target = os.path.join(images_folder, f"{source_hash[:20]}{extension}")
+        if not os.path.exists(target):
+            temp_path = f"{target}.{os.getpid()}.tmp"
+            shutil.copyfile(source_path, temp_path)
+            os.replace(temp_path, target)
+        return target
+    name = content_hash(f"{source_hash}:{max_px}:{quality}")[:20]
+    target = os.path.join(images_folder, f"{name}.jpg")
+    if not os.path.exists(target):
+        with Image.open(source_path) as image:
+            image.thumbnail((max_px, max_px))
+            if image.mode in ("RGBA", "LA", "P"):
+                image = image.convert("RGBA")
+                background = Image.new("RGB", image.size, (255, 255, 255))
+                background.paste(image, mask=image.getchannel("A"))
+                image = background
+            elif image.mode != "RGB":
+                image = image.convert("RGB")
+            temp_path = f"{target}.{os.getpid()}.tmp"
+            image.save(temp_path, "JPEG", quality=quality, optimize=True, progressive=export_format == "epub")
+        os.replace(temp_path, target)
+    return target
+
+# Fragment rendering, runs in the worker processes
+
+def render_fragment(job):
+    images_folder = job["images_folder"]
+    image_map = {}
+    for source, (source_path, source_hash) in job["images"].items():
+        prepared = prepare_image(source_path, source_hash, job["format"], images_folder)
+        if job["format"] == "epub":
+            image_map[source] = f"images/{os.path.basename(prepared)}"
+        else:
+            image_map[source] = prepared
+    body = markdown_to_html(job["markdown"], image_map, pdf_image_width if job["format"] == "pdf" else None)
+    temp_path = f"{job['path']}.{os.getpid()}.tmp"
+    if job["format"] == "epub":
+        with open(temp_path, "w", encoding="utf-8") as file:
+            file.write(body)
+    else:
+        render_pdf(body, temp_path, job["font_path"])
+    os.replace(temp_path, job["path"])
+    return job["path"]
+
+def find_pdf_font():
+    for path in pdf_font_candidates:
+        if path and os.path.exists(path):
+            return path
+    return None
+
+def font_variant(path, style):
+    stem, extension = os.path.splitext(path)
+    for suffix in pdf_font_styles[style]:
+        candidate = f"{stem}{suffix}{extension}"
+        if os.path.exists(candidate):
+            return candidate
+    return path
+
+def new_pdf(font_path):
+    pdf = FPDF(format="A4")
+    pdf.set_margins(20, 20, 20)
+    pdf.set_auto_page_break(True, margin=20)
+    if font_path:
+        pdf.add_font("BookFont", "", font_path)
+        for style in pdf_font_styles:
+            pdf.add_font("BookFont", style, font_variant(font_path, style))
+        family = "BookFont"
+    else:
+        family = "Helvetica"
+    pdf.set_font(family, size=11)
+    return pdf, family
+
+def to_latin1(text):
+    for character, replacement in latin1_replacements.items():
+        text = text.replace(character, replacement)
+    return text.encode("latin-1", "replace").decode("latin-1")
+
+def render_pdf(body, path, font_path):
+    pdf, family = new_pdf(font_path)
+    if not font_path:
+        body = to_latin1(body)
+    # fpdf2 has no strikethrough, images on their own line are centred
+    body = body.replace("<del>", "").replace("</del>", "").replace("<p><img ", '<p align="center"><img ')
+    pdf.add_page()
+    pdf.write_html(
+        body,
+        font_family=family,
+        pre_code_font=family if font_path else "Courier",
+        tag_styles={tag: font_face(family, size) for tag, size in pdf_heading_sizes.items()},
+    )
+    pdf.output(path)
+
+def font_face(family, size):
+    return FontFace(family=family, emphasis="BOLD", size_pt=size)
+
+# Stitching
+
+class BookExporter:
+    def __init__(self, book_folder, executor=None):
+        self.book_folder = book_folder
+        self.export_folder = os.path.join(book_folder, export_folder_name)
+        self.images_folder = os.path.join(self.export_folder, "images")
+        self.image_store = ImageStore(book_folder)
+        # A shared process pool lets several books export at once under one limit
+        self.executor = executor
+        self.font_path = find_pdf_font()
+        self.stats = {"rendered": 0, "reused": 0}
+
+    def fragment_key(self, export_format, markdown_text, images):
+        settings = {
+            "version": export_version,
+            "format": export_format,
+            "images": sorted(source_hash for _, source_hash in images.values()),
+            "image_settings": image_settings[export_format] if Image is not None else None,
+            "font": self.font_path if export_format == "pdf" else None,
+        }
+        return content_hash(json.dumps(settings, sort_keys=True) + "\n" + markdown_text)
+
+    def resolve_images(self, markdown_text, image_hashes):
+        # Local images referenced by the Markdown, with the hash of their current content.
+        # Images from the asset store are exported from their print variant.
+        images = {}
+        for source in image_sources(markdown_text):
+            if re.match(r"^[a-z]+://", source):
+                continue
+            path = self.image_store.source_path(source, image_hashes)
+            if path:
+                images[source] = (path, file_hash(path))
+        return images
+
+    def export(self, markdown_text, formats, output_name, check_cancelled=None, on_progress=None):
+        # Returns {format: path of the exported file}
+        unknown = [export_format for export_format in formats if export_format not in export_formats]
+        if unknown:
+            raise ExportError(f"Unknown export format: {', '.join(unknown)}")
+        if "pdf" in formats and "pdf" not in available_formats():
+            raise ExportError("PDF export needs the fpdf2 and pypdf packages (pip install fpdf2 pypdf pillow).")
+        front_matter, chapters = split_book(markdown_text)
+        if not chapters:
+            raise ExportError("No chapters found, every chapter must start with a level 1 heading.")
+        os.makedirs(self.images_folder, exist_ok=True)
+        manifest = RunManifest.load(self.book_folder)
+        image_hashes = manifest.image_hashes() if manifest else {}
+
+        parts = [{"title": None, "markdown": front_matter}] + chapters
+        jobs = []
+        for export_format in formats:
+            fragments_folder = os.path.join(self.export_folder, export_format)
+            os.makedirs(fragments_folder, exist_ok=True)
+            for part in parts:
+                images = self.resolve_images(part["markdown"], image_hashes)
+                key = self.fragment_key(export_format, part["markdown"], images)
+                extension = "pdf" if export_format == "pdf" else "xhtml"
+                part.setdefault("fragments", {})[export_format] = os.path.join(fragments_folder, f"{key}.{extension}")
+                jobs.append({
+                    "format": export_format,
+                    "markdown": part["markdown"],
+                    "images": images,
+                    "images_folder": self.images_folder,
+                    "path": part["fragments"][export_format],
+                    "font_path": self.font_path,
+                })
+
+        self.render_missing(jobs, check_cancelled, on_progress)
+        title = book_title(front_matter)
+        paths = {}
+        for export_format in formats:
+            fragments = [part["fragments"][export_format] for part in parts]
+            output_path = os.path.join(self.book_folder, f"{output_name}.{export_format}")
+            if export_format == "pdf":
+                self.stitch_pdf(title, fragments, [chapter["title"] for chapter in chapters], output_path)
+            else:
+                self.stitch_epub(title, fragments, [chapter["title"] for chapter in chapters], output_path)
+            self.remove_stale_fragments(export_format, fragments)
+            paths[export_format] = output_path
+        return paths
+
+    def render_missing(self, jobs, check_cancelled=None, on_progress=None):
+        missing = [job for job in jobs if not os.path.exists(job["path"])]
+        self.stats = {"rendered": len(missing), "reused": len(jobs) - len(missing)}
+        if not missing:
+            return
+        executor = self.executor or ProcessPoolExecutor(max_workers=max(1, min(export_workers, len(missing))), mp_context=process_context)
+        futures = [executor.submit(render_fragment, job) for job in missing]
+        try:
+            for done, future in enumerate(as_completed(futures), start=1):
+                if check_cancelled:
+                    check_cancelled()
+                future.result()
+                if on_progress:
+                    on_progress(done, len(futures))
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+        finally:
+            if executor is not self.executor:
+                executor.shutdown(wait=True, cancel_futures=True)
+
+    def remove_stale_fragments(self, export_format, fragments):
+        # Fragments of chapters that were edited or removed since the last export
+        keep = {os.path.basename(path) for path in fragments}
+        fragments_folder = os.path.join(self.export_folder, export_format)
+        for name in os.listdir(fragments_folder):
+            if name not in keep:
+                os.remove(os.path.join(fragments_folder, name))
+
+    def render_pdf_toc(self, chapter_titles, first_pages, path):
+        pdf, family = new_pdf(self.font_path)
+        pdf.add_page()
+        pdf.set_font(family, "B", 20)
+        pdf.cell(0, 14, "Table of Contents", new_x="LMARGIN", new_y="NEXT")
+        pdf.ln(4)
+        pdf.set_font(family, size=12)
+        for chapter_title, first_page in zip(chapter_titles, first_pages):
+            if not self.font_path:
+                chapter_title = to_latin1(chapter_title)
+            pdf.cell(pdf.epw - 15, 9, chapter_title)
+            pdf.cell(15, 9, str(first_page), align="R", new_x="LMARGIN", new_y="NEXT")
+        pdf.output(path)
+        return len(PdfReader(path).pages)
+
+    def stitch_pdf(self, title, fragments, chapter_titles, output_path):
+        readers = [PdfReader(path) for path in fragments]
+        page_counts = [len(reader.pages) for reader in readers]
+        toc_path = os.path.join(self.export_folder, "pdf_toc.tmp.pdf")
+        # The TOC's own length moves the chapters, so render it until its page count is stable
+        toc_pages = 1
+        while True:
+            first_pages = []
+            page = page_counts[0] + toc_pages + 1
+            for count in page_counts[1:]:
+                first_pages.append(page)
+                page += count
+            rendered_pages = self.render_pdf_toc(chapter_titles, first_pages, toc_path)
+            if rendered_pages == toc_pages:
+                break
+            toc_pages = rendered_pages
+
+        writer = PdfWriter()
+        for page in readers[0].pages:
+            writer.add_page(page)
+        for page in PdfReader(toc_path).pages:
+            writer.add_page(page)
+        for reader, chapter_title, first_page in zip(readers[1:], chapter_titles, first_pages):
+            for page in reader.pages:
+                writer.add_page(page)
+            writer.add_outline_item(chapter_title, first_page - 1)
+        writer.add_metadata({"/Title": title})
+        temp_path = f"{output_path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as file:
+            writer.write(file)
+        os.replace(temp_path, output_path)
+        os.remove(toc_path)
+
+    def stitch_epub(self, title, fragments, chapter_titles, output_path):
+        identifier = f"urn:uuid:{uuid.uuid5(uuid.NAMESPACE_URL, title)}"
+        bodies = []
+        for path in fragments:
+            with open(path, "r", encoding="utf-8") as file:
+                bodies.append(file.read())
+        images = []
+        for body in bodies:
+            for name in re.findall(r'src="images/([^"]+)"', body):
+                if name not in images:
+                    images.append(name)
+        cover_image = next(iter(re.findall(r'src="images/([^"]+)"', bodies[0])), None)
+
+        documents = [("cover.xhtml", title, bodies[0])]
+        for number, (chapter_title, body) in enumerate(zip(chapter_titles, bodies[1:]), start=1):
+            documents.append((f"chapter_{number:03}.xhtml", chapter_title, body))
+
+        manifest_items = [
+            '<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>',
+            '<item id="css" href="style.css" media-type="text/css"/>',
+        ]
+        for number, (name, _, _) in enumerate(documents):
+            manifest_items.append(f'<item id="doc{number}" href="{name}" media-type="application/xhtml+xml"/>')
+        for number, name in enumerate(images):
+            media_type = "image/jpeg" if name.endswith(".jpg") else "image/png"
+            properties = ' properties="cover-image"' if name == cover_image else ""
+            manifest_items.append(f'<item id="img{number}" href="images/{name}" media-type="{media_type}"{properties}/>')
+        spine = ['<itemref idref="doc0"/>', '<itemref idref="nav"/>']
+        spine += [f'<itemref idref="doc{number}"/>' for number in range(1, len(documents))]
+        package = f"""<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="book-id">
+<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+<dc:identifier id="book-id">{identifier}</dc:identifier>
+<dc:title>{html.escape(title)}</dc:title>
+<dc:language>en</dc:language>
+<meta property="dcterms:modified">{time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}</meta>
+</metadata>
+<manifest>
+{chr(10).join(manifest_items)}
+</manifest>
+<spine>
+{chr(10).join(spine)}
+</spine>
+</package>
+"""
+        nav_items = "\n".join(
+            f'<li><a href="{name}">{html.escape(document_title)}</a></li>' for name, document_title, _ in documents[1:]
+        )
+        nav = xhtml_document("Table of Contents", f'<nav epub:type="toc" id="toc"><h1>Table of Contents</h1>\n<ol>\n{nav_items}\n</ol></nav>')
+        container = """<?xml version="1.0" encoding="utf-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles>
+</container>
+"""
+        temp_path = f"{output_path}.{os.getpid()}.tmp"
+        with zipfile.ZipFile(temp_path, "w") as epub:
+            # The mimetype entry must come first and stay uncompressed
+            epub.writestr("mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+            epub.writestr("META-INF/container.xml", container, compress_type=zipfile.ZIP_DEFLATED)
+            epub.writestr("OEBPS/content.opf", package, compress_type=zipfile.ZIP_DEFLATED)
+            epub.writestr("OEBPS/nav.xhtml", nav, compress_type=zipfile.ZIP_DEFLATED)
+            epub.writestr("OEBPS/style.css", epub_stylesheet, compress_type=zipfile.ZIP_DEFLATED)
+            for name, document_title, body in documents:
+                epub.writestr(f"OEBPS/{name}", xhtml_document(document_title, body), compress_type=zipfile.ZIP_DEFLATED)
+            for name in images:
+                # Images are already compressed
+                epub.write(os.path.join(self.images_folder, name), f"OEBPS/images/{name}", compress_type=zipfile.ZIP_STORED)
+        os.replace(temp_path, output_path)
+
+def xhtml_document(title, body):
+    return f"""<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="en">
+<head><title>{html.escape(title)}</title><link rel="stylesheet" type="text/css" href="style.css"/></head>
+<body>
+{body}
+</body>
+</html>
+"""
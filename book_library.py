@@ -0,0 +1,298 @@
+import os
+import re
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import threading
+from run_manifest import RunManifest, content_hash, manifest_filename
+
+# Index of every generated book, for the Library tab and `python book_library.py`.
+#
+# A book is a folder with a manifest.json, see run_manifest.py. The index keeps one row per book
+# (topic, TOC, status, cost) and one per finished chapter file, and puts the topic, TOC and
+# chapter texts into an SQLite FTS5 table, so titles and text are searched without reading any
+# book from disk. Refreshing is incremental: a manifest or chapter file whose size and mtime are
+# unchanged is skipped, a changed one is read and hashed and only re-indexed when its hash
+# differs. Folders that are gone are dropped from the index.
+#
+# The indexed texts are the chapters as they were last saved, so a book can also be reopened
+# from the index.
+
+library_path = os.getenv("LIBRARY_PATH", os.path.join(".ebook_cache", "library.sqlite3"))
+library_root = os.getenv("LIBRARY_ROOT", ".")
+library_search_limit = int(os.getenv("LIBRARY_SEARCH_LIMIT", "50"))
+
+# Book level entries (topic and TOC) have no chapter file
+book_entry_file = ""
+
+def file_signature(path):
+    status = os.stat(path)
+    return status.st_mtime_ns, status.st_size
+
+def read_text(path):
+    with open(path, "r", encoding="utf-8") as file:
+        return file.read()
+
+# FTS5 query matching every word of the user's text as a prefix, so punctuation or
+# operators typed into the search box never make the query invalid
+def fts_query(text):
+    words = re.findall(r"\w+", text.lower())
+    return " ".join(f'"{word}"*' for word in words)
+
+class BookLibrary:
+    def __init__(self, path=library_path):
+        self.path = path
+        self.lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS books ("
+            "folder TEXT PRIMARY KEY, topic TEXT, toc TEXT, status TEXT, include_images INTEGER, "
+            "chapter_count INTEGER, cost REAL, updated REAL, mtime INTEGER, size INTEGER)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "folder TEXT, file TEXT, title TEXT, position INTEGER, mtime INTEGER, size INTEGER, "
+            "content_hash TEXT, entry INTEGER, PRIMARY KEY (folder, file))"
+        )
+        # Python builds without FTS5 fall back to a plain table searched with LIKE
+        try:
+            self.connection.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS entries USING fts5(topic, title, body, tokenize='porter unicode61')"
+            )
+            self.full_text = True
+        except sqlite3.OperationalError:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS entries (topic TEXT, title TEXT, body TEXT)")
+            self.full_text = False
+        self.connection.commit()
+
+    # Indexing
+
+    def refresh(self, root=library_root):
+        # Brings the books in root up to date and returns how many were re-indexed
+        root = os.path.abspath(root)
+        folders = set()
+        if os.path.isdir(root):
+            for name in os.listdir(root):
+                folder = os.path.join(root, name)
+                if os.path.isfile(os.path.join(folder, manifest_filename)):
+                    folders.add(folder)
+        changed = 0
+        for folder in sorted(folders):
+            try:
+                changed += self.update_book(folder)
+            except (OSError, ValueError) as e:
+                print(f"Failed to index {folder}: {e}")
+        with self.lock:
+            known = [row[0] for row in self.connection.execute("SELECT folder FROM books")]
+            for folder in known:
+                if os.path.dirname(folder) == root and folder not in folders:
+                    self.delete_book(folder)
+                    changed += 1
+            self.connection.commit()
+        return changed
+
+    def update_book(self, folder):
+        # Re-indexes what changed in one book folder, returns 1 when anything did
+        folder = os.path.abspath(folder)
+        manifest_path = os.path.join(folder, manifest_filename)
+        if not os.path.isfile(manifest_path):
+            with self.lock:
+                self.delete_book(folder)
+                self.connection.commit()
+            return 0
+        mtime, size = file_signature(manifest_path)
+        with self.lock:
+            row = self.connection.execute("SELECT mtime, size FROM books WHERE folder = ?", (folder,)).fetchone()
+        if row == (mtime, size) and not self.chapters_changed(folder):
+            return 0
+
+        manifest = RunManifest.load(folder)
+        if manifest is None:
+            return 0
+        # Finished chapters in TOC order, whatever order they were written in
+        chapters = sorted(
+            (entry for entry in manifest.chapter_entries().values() if entry.get("status") == "done"),
+            key=lambda entry: entry["index"],
+        )
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO books (folder, topic, toc, status, include_images, chapter_count, cost, updated, mtime, size) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (folder, manifest.topic, json.dumps(manifest.toc, ensure_ascii=False), manifest.data["status"],
+                 int(manifest.include_images), len(chapters), manifest.data.get("cost", 0.0),
+                 manifest.data.get("updated", mtime / 1e9), mtime, size),
+            )
+            self.index_text(folder, book_entry_file, "", -1, manifest.topic, "\n".join(manifest.toc), None)
+            files = {book_entry_file}
+            for entry in chapters:
+                path = os.path.join(folder, entry["file"])
+                if not os.path.isfile(path):
+                    continue
+                files.add(entry["file"])
+                self.index_file(folder, entry["file"], entry["title"], entry["index"], manifest.topic, path)
+            for (chapter_file,) in self.connection.execute("SELECT file FROM files WHERE folder = ?", (folder,)).fetchall():
+                if chapter_file not in files:
+                    self.delete_file(folder, chapter_file)
+            self.connection.commit()
+        return 1
+
+    def chapters_changed(self, folder):
+        # Chapters saved from the editor change their files, the manifest only when the hash is recorded
+        with self.lock:
+            rows = self.connection.execute("SELECT file, mtime, size FROM files WHERE folder = ? AND file != ?", (folder, book_entry_file)).fetchall()
+        for chapter_file, mtime, size in rows:
+            path = os.path.join(folder, chapter_file)
+            if not os.path.isfile(path) or file_signature(path) != (mtime, size):
+                return True
+        return False
+
+    def index_file(self, folder, chapter_file, title, position, topic, path):
+        # Called with the lock held
+        mtime, size = file_signature(path)
+        row = self.connection.execute(
+            "SELECT mtime, size, title, position FROM files WHERE folder = ? AND file = ?", (folder, chapter_file)
+        ).fetchone()
+        if row == (mtime, size, title, position):
+            return
+        self.index_text(folder, chapter_file, title, position, topic, read_text(path), (mtime, size))
+
+    def index_text(self, folder, chapter_file, title, position, topic, text, signature):
+        # Called with the lock held. A text with the indexed hash only gets its file details updated.
+        mtime, size = signature or (None, None)
+        digest = content_hash(f"{topic}\n{title}\n{text}")
+        row = self.connection.execute(
+            "SELECT content_hash, entry FROM files WHERE folder = ? AND file = ?", (folder, chapter_file)
+        ).fetchone()
+        if row and row[0] == digest:
+            self.connection.execute(
+                "UPDATE files SET mtime = ?, size = ?, position = ? WHERE folder = ? AND file = ?",
+                (mtime, size, position, folder, chapter_file),
+            )
+            return
+        if row:
+            self.connection.execute("DELETE FROM entries WHERE rowid = ?", (row[1],))
+        entry = self.connection.execute("INSERT INTO entries (topic, title, body) VALUES (?, ?, ?)", (topic, title, text)).lastrowid
+        self.connection.execute(
+            "INSERT OR REPLACE INTO files (folder, file, title, position, mtime, size, content_hash, entry) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (folder, chapter_file, title, position, mtime, size, digest, entry),
+        )
+
+    def delete_file(self, folder, chapter_file):
+        # Called with the lock held
+        self.connection.execute(
+            "DELETE FROM entries WHERE rowid IN (SELECT entry FROM files WHERE folder = ? AND file = ?)", (folder, chapter_file)
+        )
+        self.connection.execute("DELETE FROM files WHERE folder = ? AND file = ?", (folder, chapter_file))
+
+    def delete_book(self, folder):
+        # Called with the lock held
+        self.connection.execute("DELETE FROM entries WHERE rowid IN (SELECT entry FROM files WHERE folder = ?)", (folder,))
+        self.connection.execute("DELETE FROM files WHERE folder = ?", (folder,))
+        self.connection.execute("DELETE FROM books WHERE folder = ?", (folder,))
+
+    # Queries
+
+    def books(self):
+        # Every indexed book, most recently updated first
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT folder, topic, status, chapter_count, cost, updated FROM books ORDER BY updated DESC"
+            ).fetchall()
+        return [
+            {"folder": folder, "topic": topic, "status": status, "chapters": chapter_count, "cost": cost, "updated": updated}
+            for folder, topic, status, chapter_count, cost, updated in rows
+        ]
+
+    def search(self, text, limit=library_search_limit):
+        # Best matches first, each with its book, chapter (empty for the topic and TOC) and a snippet
+        # where the matched words are marked with « »
+        words = re.findall(r"\w+", text.lower())
+        if not words:
+            return []
+        with self.lock:
+            if self.full_text:
+                rows = self.connection.execute(
+                    "SELECT files.folder, entries.topic, files.title, files.file, snippet(entries, 2, '«', '»', '…', 12) "
+                    "FROM entries JOIN files ON files.entry = entries.rowid "
+                    "WHERE entries MATCH ? ORDER BY bm25(entries, 10.0, 5.0, 1.0) LIMIT ?",
+                    (fts_query(text), limit),
+                ).fetchall()
+            else:
+                condition = " AND ".join(["(entries.topic || ' ' || entries.title || ' ' || entries.body) LIKE ?"] * len(words))
+                rows = self.connection.execute(
+                    "SELECT files.folder, entries.topic, files.title, files.file, substr(entries.body, 1, 120) "
+                    f"FROM entries JOIN files ON files.entry = entries.rowid WHERE {condition} LIMIT ?",
+                    [f"%{word}%" for word in words] + [limit],
+                ).fetchall()
+        return [
+            {"folder": folder, "topic": topic, "chapter": title, "file": chapter_file, "snippet": " ".join(snippet.split())}
+            for folder, topic, title, chapter_file, snippet in rows
+        ]
+
+    def load_book(self, folder):
+        # The indexed book without touching its folder: topic, TOC, options and chapter texts by title.
+        # None when the book is not indexed.
+        folder = os.path.abspath(folder)
+        with self.lock:
+            row = self.connection.execute("SELECT topic, toc, status, include_images FROM books WHERE folder = ?", (folder,)).fetchone()
+            if row is None:
+                return None
+            chapters = self.connection.execute(
+                "SELECT files.title, entries.body FROM files JOIN entries ON entries.rowid = files.entry "
+                "WHERE files.folder = ? AND files.file != ? ORDER BY files.position",
+                (folder, book_entry_file),
+            ).fetchall()
+        topic, toc, status, include_images = row
+        return {
+            "folder": folder,
+            "topic": topic,
+            "toc": json.loads(toc),
+            "status": status,
+            "include_images": bool(include_images),
+            "chapters": dict(chapters),
+        }
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Search the books generated so far.")
+    parser.add_argument("query", nargs="?", default="", help="Words to search for in titles and chapter texts (lists the books when left out)")
+    parser.add_argument("--root", default=library_root, help="Folder the book folders are in (default: current folder)")
+    parser.add_argument("--limit", type=int, default=library_search_limit, help="Most results shown")
+    parser.add_argument("--no-refresh", action="store_true", help="Search the index as it is, without checking the book folders")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    library = BookLibrary()
+    start_time = time.time()
+    changed = 0 if args.no_refresh else library.refresh(args.root)
+    refreshed_time = time.time()
+    results = library.search(args.query, args.limit) if args.query else library.books()[:args.limit]
+    search_time = time.time()
+    library.close()
+    if args.json:
+        print(json.dumps(results, indent=2, ensure_ascii=False))
+        return 0
+    for result in results:
+        if args.query:
+            where = f"{result['topic']} / {result['chapter']}" if result["chapter"] else result["topic"]
+            print(f"{where}\n    {result['snippet']}\n    {result['folder']}")
+        else:
+            updated = time.strftime("%Y-%m-%d %H:%M", time.localtime(result["updated"]))
+            print(f"{result['topic']} ({result['status']}, {result['chapters']} chapters, ${result['cost']:.2f}, {updated})\n    {result['folder']}")
+    print(
+        f"{len(results)} results, {changed} books re-indexed in {(refreshed_time - start_time) * 1000:.0f} ms, "
+        f"searched in {(search_time - refreshed_time) * 1000:.0f} ms"
+    )
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,152 @@
+import re
+
+# Clean up and completeness check of generated chapter text.
+#
+# MarkdownNormalizer makes one pass over the text, line by line, so it works the same on a whole
+# chapter and on a stream of pieces:
+#   - a ```markdown wrapper around the whole answer is removed, real code blocks are kept and an
+#     unclosed one is closed at the end
+#   - headings get a single space after the #s and no closing #s, the first H1 is the chapter
+#     title and later H1s become H2s (every H1 starts a new chapter in the merged book)
+#   - headings get a blank line before and after, runs of blank lines become one, trailing
+#     whitespace and leading blank lines are dropped
+#
+# Only complete lines are let through, the line being written stays in the normaliser. When the
+# answer was cut off (truncation_reason), that unfinished line is discarded and the writer asks for
+# the rest of the chapter, which then continues on a new line.
+
+fence_pattern = re.compile(r"^\s*(```+|~~~+)\s*([\w+.-]*)\s*$")
+heading_pattern = re.compile(r"^(#{1,6})[ \t]+(.*?)(?:[ \t]+#+)?[ \t]*$")
+list_item_pattern = re.compile(r"^([-*+]|\d+[.)])\s")
+wrapper_languages = ("", "markdown", "md")
+# A paragraph ending in one of these is complete, emphasis and code marks are ignored
+sentence_endings = (".", "!", "?", "…", ":", ";", ")", "]", "}", '"', "'", "”", "’")
+
+class MarkdownNormalizer:
+    def __init__(self):
+        self.buffer = ""
+        self.started = False
+        self.blank_lines = 0
+        self.after_heading = False
+        self.seen_title = False
+        self.wrapper_open = False
+        # Marker of the open code block
+        self.fence = None
+        self.last_line = ""
+
+    @property
+    def partial_line(self):
+        return self.buffer
+
+    def discard_partial_line(self):
+        dropped, self.buffer = self.buffer, ""
+        return dropped
+
+    def feed(self, piece):
+        # Yields the normalised text of the lines completed by this piece
+        self.buffer += piece
+        if "\n" not in self.buffer:
+            return
+        complete, self.buffer = self.buffer.rsplit("\n", 1)
+        for line in complete.split("\n"):
+            text = self.normalize_line(line)
+            if text:
+                yield text
+
+    def finish_fence_line(self):
+        # Answers often end with a fence line without a newline after it. A fence line is complete
+        # as it is, so it is let through instead of being taken for an unfinished line.
+        if fence_pattern.match(self.buffer):
+            yield from self.feed("\n")
+
+    def close(self):
+        line, self.buffer = self.buffer, ""
+        text = self.normalize_line(line)
+        if text:
+            yield text
+        if self.fence:
+            yield f"\n{self.fence}"
+            self.fence = None
+
+    def emit(self, line, blank_before=False):
+        if not self.started:
+            self.started = True
+            separator = ""
+        elif blank_before or self.blank_lines or self.after_heading:
+            separator = "\n\n"
+        else:
+            separator = "\n"
+        self.blank_lines = 0
+        self.after_heading = False
+        self.last_line = line
+        return separator + line
+
+    def normalize_line(self, line):
+        fence = fence_pattern.match(line)
+        if self.fence is not None:
+            # Inside a code block everything is kept as it is
+            if fence and fence.group(1).startswith(self.fence) and not fence.group(2):
+                self.fence = None
+            self.last_line = line
+            if not self.started:
+                self.started = True
+                return line
+            return "\n" + line
+        if fence:
+            marker, language = fence.groups()
+            if language.lower() in wrapper_languages and (self.wrapper_open or not self.started or language):
+                # The whole answer wrapped in a fence: drop the fence lines
+                self.wrapper_open = not self.wrapper_open if not language else True
+                return ""
+            self.fence = marker
+            return self.emit(line.strip(), blank_before=True)
+        line = line.rstrip()
+        if not line.strip():
+            if self.started:
+                self.blank_lines += 1
+            return ""
+        heading = heading_pattern.match(line)
+        if heading:
+            level = len(heading.group(1))
+            if level == 1:
+                if self.seen_title:
+                    level = 2
+                self.seen_title = True
+            text = self.emit(f"{'#' * level} {heading.group(2).strip()}", blank_before=True)
+            self.after_heading = True
+            return text
+        return self.emit(line)
+
+def is_dangling(line):
+    # Whether the last line of a chapter looks unfinished
+    line = line.strip()
+    if not line:
+        return False
+    if heading_pattern.match(line):
+        # A heading without any text under it
+        return True
+    if fence_pattern.match(line):
+        # The end of a code block
+        return False
+    if list_item_pattern.match(line) or line.startswith("|") or line.startswith("!["):
+        # Lists (references in particular) and tables often end without punctuation
+        return False
+    line = line.rstrip("*_`")
+    if re.search(r"https?://\S+$", line):
+        return False
+    return not line.endswith(sentence_endings)
+
+def truncation_reason(normalizer, finish_reason=None):
+    # Why the text seen by the normaliser looks cut off, None when it looks complete.
+    # finish_reason is unknown (None) for cached answers, the structure is checked either way.
+    if finish_reason == "length":
+        return "length limit"
+    if normalizer.fence is not None:
+        return "unclosed code block"
+    if is_dangling(normalizer.partial_line.strip() or normalizer.last_line):
+        return "unfinished sentence"
+    return None
+
+def normalize_markdown(text):
+    normalizer = MarkdownNormalizer()
+    return "".join(list(normalizer.feed(text)) + list(normalizer.close()))
@@ -0,0 +1,198 @@
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from response_cache import open_response_cache, cache_stages
+from api_scheduler import configure_model_budget, get_scheduler
+from book_export import BookExporter, export_formats, export_workers
+from image_assets import image_variant_workers, process_context
+from book_library import BookLibrary
+from providers import api_keys_required
+from ebook_engine import (
+    BookGenerator,
+    GenerationCancelled,
+    GenerationError,
+    default_max_concurrent_chapters,
+    initialize_openai_client,
+    max_concurrent_images,
+    read_tavily_api_key,
+    sanitize_filename,
+)
+
+# Headless batch mode: generates every book listed in a topics file without the Tk GUI.
+#
+# The topics file has one book per line, either a plain topic or a JSON object with a
+# pre-approved TOC that skips research and TOC generation, for example:
+#
+#   Color psychology for designers
+#   {"topic": "Urban beekeeping", "toc": ["CHAPTER 01 - Why bees", "CHAPTER 02 - Hives"]}
+#
+# All books share one chapter pool and the process wide API scheduler, so the limits are global.
+
+def read_topics_file(path):
+    books = []
+    with open(path, "r", encoding="utf-8") as file:
+        for line_number, line in enumerate(file, start=1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("{"):
+                try:
+                    entry = json.loads(line)
+                except ValueError as e:
+                    raise ValueError(f"{path}:{line_number}: invalid JSON: {e}")
+                toc = entry.get("toc")
+                if isinstance(toc, str):
+                    toc = toc.strip().split("\n")
+                books.append({"topic": entry["topic"].strip(), "toc": toc, "images": entry.get("images")})
+            else:
+                books.append({"topic": line, "toc": None, "images": None})
+    for book in books:
+        if len(book["topic"]) < 5:
+            raise ValueError(f"Topic must be at least 5 characters long: {book['topic']!r}")
+    return books
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Generate e-books from a file of topics without the GUI.")
+    parser.add_argument("topics_file", help="Text file with one topic per line, or JSON lines with a topic and an optional toc")
+    parser.add_argument("--output", default=".", help="Folder the book folders are created in (default: current folder)")
+    parser.add_argument("--images", action="store_true", help="Generate cover and chapter images")
+    parser.add_argument("--books", type=int, default=2, help="Books processed at the same time (default: 2)")
+    parser.add_argument("--chapters", type=int, default=default_max_concurrent_chapters,
+                        help="Chapters generated at the same time across all books")
+    parser.add_argument("--image-requests", type=int, default=max_concurrent_images,
+                        help="Image requests in flight at the same time across all books")
+    parser.add_argument("--images-per-minute", type=int, default=int(os.getenv("IMAGES_PER_MINUTE", "5")),
+                        help="Image requests started per minute across all books")
+    parser.add_argument("--resume", action="store_true", help="Reuse finished chapters and images from earlier runs")
+    parser.add_argument("--bypass-cache", default="",
+                        help=f"Comma separated stages that skip the response cache ({', '.join(cache_stages)})")
+    parser.add_argument("--export", default="",
+                        help=f"Comma separated formats every finished book is exported to ({', '.join(export_formats)})")
+    return parser.parse_args(argv)
+
+def make_event_printer(topic):
+    def on_event(kind, *payload):
+        if kind == "status":
+            message, progress = payload
+            print(f"[{topic}] {message} ({progress:.0f}%)")
+        elif kind == "chapter_ready":
+            print(f"[{topic}] Chapter ready: {payload[1]}")
+        elif kind == "info":
+            print(f"[{topic}] {payload[0]}")
+    return on_event
+
+def generate_book(book, args, cache, chapter_executor, cancel_event, tavily_api_key, export_executor=None, formats=(),
+                  image_executor=None):
+    engine = BookGenerator(
+        book["topic"],
+        tavily_api_key,
+        cache,
+        make_event_printer(book["topic"]),
+        cancel_event,
+        chapter_executor,
+        get_scheduler(),
+        args.output,
+        image_executor=image_executor,
+    )
+    include_images = args.images if book["images"] is None else bool(book["images"])
+    file_path = engine.run(book["toc"], include_images, args.chapters, resume=args.resume)
+    if formats:
+        with open(file_path, "r", encoding="utf-8") as file:
+            markdown_text = file.read()
+        exporter = BookExporter(engine.book_folder, export_executor)
+        for export_path in exporter.export(markdown_text, formats, sanitize_filename(book["topic"]), engine.check_cancelled).values():
+            print(f"[{book['topic']}] Exported {export_path}")
+    return file_path
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    # The keys are only needed by the live provider, the mock provider runs without them
+    if api_keys_required():
+        if not initialize_openai_client():
+            return 2
+        tavily_api_key = read_tavily_api_key()
+        if not tavily_api_key:
+            return 2
+    else:
+        tavily_api_key = os.getenv("TAVILY_API_KEY", "")
+    try:
+        books = read_topics_file(args.topics_file)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Failed to read topics file: {e}")
+        return 2
+
+    formats = [export_format.strip().lower() for export_format in args.export.split(",") if export_format.strip()]
+    unknown = [export_format for export_format in formats if export_format not in export_formats]
+    if unknown:
+        print(f"Unknown export format: {', '.join(unknown)}")
+        return 2
+
+    bypass = [stage.strip() for stage in args.bypass_cache.split(",") if stage.strip()]
+    cache = open_response_cache(bypass)
+    cancel_event = threading.Event()
+    chapter_executor = ThreadPoolExecutor(max_workers=max(1, args.chapters))
+    configure_model_budget("dall-e-3", args.images_per_minute, None, max(1, args.image_requests))
+    book_executor = ThreadPoolExecutor(max_workers=max(1, args.books))
+    # Chapters of all books are rendered in one process pool
+    export_executor = ProcessPoolExecutor(max_workers=max(1, export_workers), mp_context=process_context) if formats else None
+    # and image variants in another one
+    with_images = any(args.images if book["images"] is None else book["images"] for book in books)
+    image_executor = ProcessPoolExecutor(max_workers=max(1, image_variant_workers), mp_context=process_context) if with_images else None
+    start_time = time.time()
+    failures = 0
+    try:
+        futures = {
+            book_executor.submit(
+                generate_book, book, args, cache, chapter_executor, cancel_event, tavily_api_key, export_executor, formats,
+                image_executor
+            ): book
+            for book in books
+        }
+        for future in as_completed(futures):
+            topic = futures[future]["topic"]
+            try:
+                print(f"[{topic}] Saved {future.result()}")
+            except GenerationCancelled:
+                failures += 1
+                print(f"[{topic}] Cancelled")
+            except GenerationError as e:
+                failures += 1
+                print(f"[{topic}] Failed: {e}")
+            except Exception as e:
+                failures += 1
+                print(f"[{topic}] Failed: {e}")
+    except KeyboardInterrupt:
+        # Queued chapters are dropped, requests already in flight finish and are discarded
+        cancel_event.set()
+        failures = len(books)
+        print("Cancelling...")
+    finally:
+        book_executor.shutdown(wait=True, cancel_futures=True)
+        chapter_executor.shutdown(wait=True, cancel_futures=True)
+        if export_executor:
+            export_executor.shutdown(wait=True, cancel_futures=True)
+        if image_executor:
+            image_executor.shutdown(wait=True, cancel_futures=True)
+
+    stats = cache.stats()
+    elapsed_minutes, elapsed_seconds = divmod(int(time.time() - start_time), 60)
+    print(
+        f"{len(books) - failures}/{len(books)} books generated in {elapsed_minutes:02}:{elapsed_seconds:02}, "
+        f"cost ${stats['spent_cost']:.2f}, cache {stats['total_hits']} hits / {stats['total_misses']} misses"
+    )
+    scheduler_stats = get_scheduler().stats()
+    print(f"API retries: {scheduler_stats['retries']}, rate limited: {scheduler_stats['rate_limited']}")
+    cache.close()
+
+    # New and updated books become searchable with `python book_library.py`
+    library = BookLibrary()
+    print(f"Library: {library.refresh(args.output)} books indexed")
+    library.close()
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1394 @@
+import os
+import re
+import json
+import time
+import threading
+import itertools
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import requests
+import openai
+from dotenv import load_dotenv
+from response_cache import ResponseCache, cache_stages
+from run_manifest import RunManifest, atomic_write_text, file_hash
+from image_assets import ImageStore
+from research_index import ResearchIndex
+from redundancy_index import RedundancyIndex
+from toc_diff import chapter_context, plan_chapter_reuse, strip_chapter_number, unchanged_chapters
+from telemetry import RunTelemetry
+from chapter_validation import MarkdownNormalizer, normalize_markdown, truncation_reason
+from prompt_builder import (
+    TokenLedger,
+    chapter_messages,
+    compact_extract,
+    continuation_messages,
+    count_message_tokens,
+    count_tokens,
+    rewrite_messages,
+    summary_messages,
+    summary_max_tokens,
+)
+from http_transport import add_response_observer, get_http_session, http_timeout
+from providers import get_provider
+from api_scheduler import (
+    RetryableHTTPError,
+    get_scheduler,
+    priority_chapter,
+    priority_download,
+    priority_image,
+    priority_research,
+    priority_summary,
+    priority_toc,
+)
+
+# Generation engine shared by the Tk app (ebook_project_ui.py) and the command line (ebook_cli.py).
+# Nothing in this module imports tkinter.
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Maximum number of chapters generated at the same time (each chapter makes two API calls)
+default_max_concurrent_chapters = int(os.getenv("MAX_CONCURRENT_CHAPTERS", "4"))
+
+# Follow-up requests for a chapter that was cut off, and the completion tokens each may use
+max_chapter_continuations = int(os.getenv("MAX_CHAPTER_CONTINUATIONS", "2"))
+chapter_continuation_tokens = int(os.getenv("CHAPTER_CONTINUATION_TOKENS", "800"))
+
+# Passages repeating an earlier chapter (by shingle overlap, see redundancy_index.py) are rewritten
+# one by one after the chapters are written, at most max_redundancy_rewrites per book
+redundancy_rewrites = os.getenv("REDUNDANCY_REWRITES", "1") == "1"
+redundancy_threshold = float(os.getenv("REDUNDANCY_THRESHOLD", "0.5"))
+max_redundancy_rewrites = int(os.getenv("MAX_REDUNDANCY_REWRITES", "10"))
+# Length of the "already covered" note in chapter prompts
+covered_topics_chars = int(os.getenv("COVERED_TOPICS_CHARS", "600"))
+
+# Image generation limits, DALL-E 3 quotas are low so the scheduler also spaces requests out per minute
+max_concurrent_images = int(os.getenv("MAX_CONCURRENT_IMAGES", "3"))
+max_concurrent_downloads = 4
+image_download_chunk_size = 64 * 1024
+image_download_timeout = int(os.getenv("IMAGE_DOWNLOAD_TIMEOUT", "60"))
+
+# Per-chapter research: parallel Tavily searches, and how many sources each chapter prompt gets
+max_concurrent_searches = int(os.getenv("MAX_CONCURRENT_SEARCHES", "4"))
+research_sources_per_chapter = int(os.getenv("RESEARCH_SOURCES_PER_CHAPTER", "5"))
+research_source_chars = 800
+
+# Seconds before an API request is abandoned and retried by the scheduler
+openai_request_timeout = int(os.getenv("OPENAI_TIMEOUT", "180"))
+tavily_request_timeout = int(os.getenv("TAVILY_TIMEOUT", "60"))
+
+# USD prices used for the running cost estimate
+chat_token_prices = {"gpt-4o": (2.50 / 1_000_000, 10.00 / 1_000_000), "gpt-4o-mini": (0.15 / 1_000_000, 0.60 / 1_000_000)}  # (input, output) per token
+image_prices = {("dall-e-3", "1024x1024", "hd"): 0.08, ("dall-e-3", "1024x1024", "standard"): 0.04}
+tavily_search_price = 0.008
+
+# Speculative writing of the proposed chapters while the TOC is reviewed, off unless enabled.
+# The limit is in USD, a chapter is only started while the spend so far plus the estimate
+# for the chapters in flight stays under it.
+speculative_generation = os.getenv("SPECULATIVE_GENERATION", "0").lower() in ("1", "true", "yes")
+speculative_spend_limit = float(os.getenv("SPECULATIVE_SPEND_LIMIT", "0.50"))
+
+# Initialize OpenAI client
+def initialize_openai_client():
+    openai_api_key = os.getenv("OPENAI_API_KEY")
+    if openai_api_key:
+        openai.api_key = openai_api_key
+        # Route OpenAI calls through the shared connection pool
+        session = get_http_session()
+        if openai.requestssession is not session:
+            openai.requestssession = session
+            add_response_observer(observe_openai_headers)
+        return True
+    else:
+        print("OpenAI API key not found in .env file.")
+        return False
+
+# openai 0.28 only exposes response headers on errors, the shared session sees them on every response
+def observe_openai_headers(response):
+    request = response.request
+    if not request.url.startswith(openai.api_base) or not request.body:
+        return
+    try:
+        model = json.loads(request.body).get("model")
+    except ValueError:
+        return
+    if model:
+        get_scheduler().observe_headers(model, response.headers)
+
+# Read the Tavily API key
+def read_tavily_api_key():
+    tavily_api_key = os.getenv("TAVILY_API_KEY")
+    if not tavily_api_key:
+        print("Tavily API key not found in .env file.")
+    return tavily_api_key
+
+# Function to sanitize filenames
+def sanitize_filename(filename):
+    # Remove invalid characters
+    filename = re.sub(r'[<>:"/\\|?*]', '', filename)
+    # Replace spaces with underscores
+    filename = filename.replace(' ', '_')
+    # Remove non-ASCII characters
+    filename = filename.encode('ascii', 'ignore').decode('ascii')
+    # Truncate filename to a reasonable length
+    return filename[:255]
+
+# Names the cover and chapter images are linked and recorded by, see image_assets.py
+cover_image_name = "cover_page.png"
+
+def chapter_image_name(chapter_title):
+    return f"{sanitize_filename(chapter_title)}_image.png"
+
+# Every book is written to its own folder named after the topic
+def book_folder_for_topic(topic, output_root="."):
+    return os.path.normpath(os.path.join(output_root, sanitize_filename(topic.replace(" ", "_"))))
+
+# Chapters of a TOC, section lines and blank lines are skipped
+def toc_chapter_titles(toc):
+    return [title for title in toc if title.strip() and "SECTION" not in title.upper()]
+
+# Search query for a chapter, without the "CHAPTER 01 -" prefix
+def chapter_search_query(topic, chapter_title):
+    return f"{topic}: {strip_chapter_number(chapter_title)}"
+
+# The image link at the top of a chapter, its target is the image name or a file in the asset store
+def chapter_image_pattern(chapter_title):
+    return re.compile(r"!\[" + re.escape(chapter_title) + r" Image\]\(([^)\s]+)\)")
+
+def link_chapter_image(chapter_content, chapter_title, target):
+    return chapter_image_pattern(chapter_title).sub(lambda match: f"![{chapter_title} Image]({target})", chapter_content, count=1)
+
+# Point a reused chapter at its new title after renumbering: the chapter heading and the image link
+def retitle_chapter_content(chapter_content, old_title, new_title):
+    def retitle_link(match):
+        # A link into the asset store does not depend on the title, only the image name does
+        target = match.group(1)
+        if target == chapter_image_name(old_title):
+            target = chapter_image_name(new_title)
+        return f"![{new_title} Image]({target})"
+    chapter_content = chapter_image_pattern(old_title).sub(retitle_link, chapter_content, count=1)
+    lines = chapter_content.split("\n")
+    for number, line in enumerate(lines):
+        if line.startswith("#"):
+            lines[number] = line.replace(old_title, new_title, 1)
+            break
+    return "\n".join(lines)
+
+def estimate_chat_cost(model, prompt_tokens, completion_tokens):
+    input_price, output_price = chat_token_prices.get(model, (0.0, 0.0))
+    return prompt_tokens * input_price + completion_tokens * output_price
+
+# The mock provider is free, so a mock run reports no spend and never reaches a spend limit
+def billed_cost(provider, cost):
+    return cost if getattr(provider, "billed", True) else 0.0
+
+def chat_cache_key(params):
+    return ResponseCache.make_key(
+        params["model"],
+        params["messages"],
+        {name: value for name, value in params.items() if name not in ("model", "messages", "stream")}
+    )
+
+# Tokens reserved in the scheduler's budget before a chat call, the unused part is refunded afterwards
+def reserved_chat_tokens(params):
+    return count_message_tokens(params["messages"], params["model"]) + params.get("max_tokens", 0)
+
+# Chat completion that is served from the response cache when the same request was made before,
+# otherwise sent through the shared scheduler for rate limiting and retries.
+# The call is recorded in the token ledger and the telemetry trace under report_stage (default: the cache stage).
+def cached_chat_completion(cache, stage, scheduler=None, priority=priority_chapter, check_cancelled=None,
+                           ledger=None, report_stage=None, baseline_prompt_tokens=None, telemetry=None, provider=None,
+                           outcome=None, cache_key=None, **params):
+    # outcome, when given, receives the finish_reason of an answer from the API.
+    # cache_key replaces the key derived from params, for prompts with parts that must not change it.
+    key = cache_key or chat_cache_key(params)
+    report_stage = report_stage or stage
+    model = params["model"]
+    started = time.monotonic()
+    if cache:
+        cached = cache.get_text(stage, key)
+        if cached is not None:
+            prompt_tokens = count_message_tokens(params["messages"], model)
+            completion_tokens = count_tokens(cached, model)
+            if ledger:
+                ledger.record(report_stage, prompt_tokens, completion_tokens, baseline_prompt_tokens, cached=True)
+            if telemetry:
+                telemetry.record(report_stage, model, started, None, prompt_tokens, completion_tokens, cached=True)
+            return cached
+    scheduler = scheduler or get_scheduler()
+    provider = provider or get_provider()
+    reserved_tokens = reserved_chat_tokens(params)
+    try:
+        response = scheduler.call(
+            model,
+            provider.chat_completion,
+            priority=priority,
+            tokens=reserved_tokens,
+            check_cancelled=check_cancelled,
+            request_timeout=http_timeout(openai_request_timeout),
+            **params
+        )
+    except Exception:
+        if telemetry:
+            telemetry.record(report_stage, model, started, scheduler.last_call_stats(), ok=False)
+        raise
+    content = response['choices'][0]['message']['content'].strip()
+    if outcome is not None:
+        outcome["finish_reason"] = response['choices'][0].get('finish_reason')
+    usage = response.get('usage') or {}
+    scheduler.refund(model, reserved_tokens - usage.get('total_tokens', reserved_tokens))
+    prompt_tokens = usage.get('prompt_tokens') or count_message_tokens(params["messages"], model)
+    completion_tokens = usage.get('completion_tokens') or count_tokens(content, model)
+    cost = billed_cost(provider, estimate_chat_cost(model, prompt_tokens, completion_tokens))
+    if ledger:
+        ledger.record(
+            report_stage,
+            count_message_tokens(params["messages"], model),
+            completion_tokens,
+            baseline_prompt_tokens,
+            provider_cached_tokens=(usage.get('prompt_tokens_details') or {}).get('cached_tokens', 0),
+        )
+    if telemetry:
+        telemetry.record(report_stage, model, started, scheduler.last_call_stats(), prompt_tokens, completion_tokens, cost=cost)
+    if cache:
+        cache.put_text(stage, key, content, cost)
+    return content
+
+# Raised inside the background worker when the user cancels the generation
+class GenerationCancelled(Exception):
+    pass
+
+def build_front_matter(topic, chapter_titles):
+    front_matter = f"# {topic}\n\n"
+    front_matter += f"![Cover Page]({cover_image_name})\n\n"
+    front_matter += "### Author: OpenAI's GPT-4o\n"
+    front_matter += "### Designer: DALL·E 3\n\n"
+    front_matter += "## Table of Contents\n\n"
+    for chapter_title in chapter_titles:
+        front_matter += f"- {chapter_title}\n"
+    front_matter += "\n"
+    return front_matter
+
+def build_back_matter():
+    return "Thank you for reading.\n"
+
+# The merged book in pieces, so it can be joined once or written out without building one big string
+def iter_book_markdown(topic, chapters):
+    yield build_front_matter(topic, [chapter["title"] for chapter in chapters])
+    for chapter in chapters:
+        # Assume the chapter content already includes the chapter title and image
+        yield f"\n\n{chapter['content']}\n\n"
+    yield build_back_matter()
+
+
+# Raised when a pipeline stage cannot continue, the message is meant for the user
+class GenerationError(Exception):
+    pass
+
+# GUI-free generation pipeline for one book: research, TOC, chapters, images and merge.
+# Progress is reported through on_event(kind, *payload) so the Tk app, the CLI or a test
+# can all drive the same code. It never touches any widget and can run on any thread.
+class BookGenerator:
+    def __init__(self, topic, tavily_api_key, cache=None, on_event=None, cancel_event=None,
+                 chapter_executor=None, scheduler=None, output_root=".", provider=None, image_executor=None):
+        self.topic = topic
+        self.tavily_api_key = tavily_api_key
+        self.cache = cache
+        self.on_event = on_event
+        self.cancel_event = cancel_event or threading.Event()
+        # Shared pools let several books run under one global concurrency limit
+        self.chapter_executor = chapter_executor
+        self.scheduler = scheduler or get_scheduler()
+        self.provider = provider or get_provider()
+        self.book_folder = book_folder_for_topic(topic, output_root)
+        self.manifest = None
+        # Images are stored by content hash, their variants are built in image_executor (a process pool)
+        self.image_store = ImageStore(self.book_folder, image_executor)
+        self.toc = []
+        self.chapter_titles = []
+        self.chapters = []
+        self.chapter_summaries = []
+        self.research_index = ResearchIndex()
+        self.redundancy_index = RedundancyIndex(redundancy_threshold)
+        self.token_ledger = TokenLedger()
+        self.telemetry = RunTelemetry()
+        self.researched_queries = set()
+        # Speculative chapters, see speculate_chapters
+        self.speculating = False
+        self.speculation_stop = threading.Event()
+        self.speculation_approved_titles = None
+        self.speculation_local = threading.local()
+        self.initialize_agents()
+
+    def initialize_agents(self):
+        # Initialize agents
+        self.researcher = ResearcherAgent(
+            self.tavily_api_key, self.cache, self.scheduler, self.check_cancelled, self.telemetry, self.provider
+        )
+        self.content_organizer = ContentOrganizerAgent(self.cache, self.scheduler, self.check_cancelled, self.telemetry, self.provider)
+        self.writer = WriterAgent(self.cache, self.scheduler, self.check_cancelled, self.token_ledger, self.telemetry, self.provider)
+        self.designer = DesignerAgent(self.cache, self.scheduler, self.telemetry, self.provider)
+
+    def post_event(self, kind, *payload):
+        if self.on_event:
+            self.on_event(kind, *payload)
+
+    def post_status(self, message, progress):
+        self.post_event("status", message, progress)
+
+    def check_cancelled(self):
+        # A speculative chapter whose TOC line was edited is dropped on its own thread
+        discard_event = getattr(self.speculation_local, "discard_event", None)
+        if self.cancel_event.is_set() or (discard_event is not None and discard_event.is_set()):
+            raise GenerationCancelled()
+
+    def prepare_book_folder(self):
+        os.makedirs(self.book_folder, exist_ok=True)
+
+    def run(self, toc=None, include_images=False, max_in_flight=default_max_concurrent_chapters, stream=False, resume=False):
+        # Whole book without a review step, a pre-approved TOC skips research and TOC generation
+        self.prepare_book_folder()
+        if resume:
+            self.manifest = RunManifest.load(self.book_folder)
+            if self.manifest and self.manifest.toc and not toc:
+                toc = self.manifest.toc
+        if not toc:
+            toc = self.research_and_toc()
+        final_md_content = self.generate_content(toc, include_images, max_in_flight, stream, resume)
+        return self.save_merged_markdown(final_md_content)
+
+    def research_and_toc(self):
+        self.post_status("Generating TOC", 0)
+
+        # Research Information
+        research_task = f"{self.topic}"
+        research_data = self.researcher.execute_task(research_task)
+        if not research_data:
+            raise GenerationError("Failed to fetch research data from Tavily API.")
+        self.check_cancelled()
+
+        # Generate and review TOC
+        toc = self.generate_toc(research_data)
+        if not toc or all(not line.strip() for line in toc):
+            raise GenerationError("Failed to generate Table of Contents. Please try again or check your API keys.")
+        self.check_cancelled()
+
+        # Checkpoint the proposed TOC so the run can be resumed from the review step
+        self.toc = toc
+        self.manifest = RunManifest.load_or_create(self.book_folder)
+        self.manifest.record_toc(self.topic, toc)
+        self.post_event("toc_ready", toc)
+        return toc
+
+    def generate_toc(self, research_data):
+        toc_response = self.content_organizer.execute_task({
+            "query": self.topic,
+            "answer": research_data.get("answer", ""),
+            "results": research_data.get("results", [])
+        })
+        toc = toc_response.strip().split('\n')
+        return toc
+
+    def generate_content(self, toc, include_images, max_in_flight, stream=False, resume=False):
+        topic = self.topic
+        self.toc = list(toc)
+        self.prepare_book_folder()
+        if self.manifest is None:
+            self.manifest = RunManifest.load_or_create(self.book_folder)
+        # Chapters unchanged since the previous run are kept unless the chapters cache is bypassed
+        reuse = resume or not (self.cache and self.cache.is_bypassed("chapters"))
+        previous_include_images = self.manifest.include_images
+        self.manifest.start_run(topic, toc, include_images, reuse)
+        self.chapter_titles = toc_chapter_titles(toc)
+        if reuse:
+            self.reuse_unchanged_chapters(include_images, previous_include_images)
+        self.token_ledger = self.writer.ledger = TokenLedger()
+        self.redundancy_index = RedundancyIndex(redundancy_threshold)
+        self.telemetry.begin_generation()
+        spent_at_start = self.cache.stats()["spent_cost"] if self.cache else 0.0
+        self.post_status("Generating Content", 15)  # TOC generation complete
+
+        num_chapters = len(self.chapter_titles)
+        if include_images:
+            total_files = num_chapters * 2 + 2  # Chapters + Images + Merged + Cover
+        else:
+            total_files = num_chapters + 1  # Chapters + Merged
+        self.reset_progress(15, 85 / total_files)  # Start from 15% after TOC generation
+
+        self.post_status("Researching Chapters", 15)
+        self.research_chapters(toc)
+        self.check_cancelled()
+        self.post_status("Generating Content", 15)
+
+        # Images are generated and downloaded alongside the chapters, each one starts as soon as its summary exists
+        image_pipeline = None
+        if include_images:
+            def on_image_saved(image_name, digest):
+                self.manifest.image_done(image_name, digest)
+                self.advance_progress("Generating Images")
+
+            image_pipeline = self.designer.start_pipeline(self.image_store, self.cancel_event, on_image_saved)
+            if self.image_reusable(cover_image_name):
+                self.advance_progress("Generating Images")
+            else:
+                image_pipeline.submit_cover(topic)
+        try:
+            self.fast_generation(toc, include_images, max_in_flight, stream, image_pipeline)
+            self.check_cancelled()
+            if redundancy_rewrites:
+                self.rewrite_redundant_passages(max_in_flight)
+                self.check_cancelled()
+            if image_pipeline:
+                with self.progress_lock:
+                    self.current_progress = max(self.current_progress, 75)
+                self.post_status("Generating Images", self.current_progress)
+                image_pipeline.wait()
+                # The chapters and the merged book link to the web variants
+                self.image_store.wait()
+                self.check_cancelled()
+                self.link_chapter_images()
+                self.post_event("info", "Cover page and chapter images generated.")
+        finally:
+            if image_pipeline:
+                image_pipeline.shutdown()
+                self.image_store.close()
+            if self.cache:
+                self.manifest.set_run_cost(self.cache.stats()["spent_cost"] - spent_at_start)
+            # The trace is written for cancelled and failed runs too
+            self.telemetry.end_generation()
+            self.telemetry.export(self.book_folder)
+            print(f"Telemetry for {topic}: {self.telemetry.status_line()}")
+
+        # Update status
+        self.post_status("Finalizing Content", 90)
+
+        final_md_content = self.merge_chapters_into_single_content()
+        if include_images:
+            # Images of chapters that were dropped or regenerated
+            self.image_store.remove_unused(self.manifest.image_hashes().values())
+        print(self.token_ledger.format_report(topic))
+        self.manifest.set_token_report(self.token_ledger.report())
+        self.manifest.finish_run()
+        self.post_event("content_ready", final_md_content, stream)
+        return final_md_content
+
+    def reuse_unchanged_chapters(self, include_images, previous_include_images):
+        # Diff the approved TOC against the chapters of the previous run. A chapter whose normalised
+        # title and neighbours are unchanged is kept, renumbered chapters are renamed on disk.
+        plan = {}
+        if include_images == previous_include_images:
+            plan = plan_chapter_reuse(self.manifest.chapter_entries(), self.chapter_titles)
+        previous_chapters = self.manifest.chapter_entries()
+        reused = {}
+        for index, old_key in plan.items():
+            chapter = self.manifest.reusable_chapter(old_key)
+            if chapter:
+                reused[index] = (old_key, previous_chapters[old_key]["title"]) + chapter
+
+        new_keys = {sanitize_filename(title) for title in self.chapter_titles}
+        keep_images = {cover_image_name}
+        renamed_images = []
+        for index, (old_key, old_title, chapter_content, chapter_summary) in reused.items():
+            new_key = sanitize_filename(self.chapter_titles[index])
+            old_image = chapter_image_name(old_title)
+            if new_key == old_key:
+                keep_images.add(old_image)
+            elif include_images and self.image_reusable(old_image):
+                # The image stays where it is in the asset store, only the name it is known by changes
+                renamed_images.append((chapter_image_name(self.chapter_titles[index]), self.manifest.image_hash(old_image)))
+        self.manifest.reset_chapters(keep_images)
+        for image_name, digest in renamed_images:
+            self.manifest.image_done(image_name, digest)
+
+        for index, (old_key, old_title, chapter_content, chapter_summary) in reused.items():
+            chapter_title = self.chapter_titles[index]
+            new_key = sanitize_filename(chapter_title)
+            if new_key != old_key:
+                chapter_content = retitle_chapter_content(chapter_content, old_title, chapter_title)
+                atomic_write_text(self.manifest.chapter_file(new_key), chapter_content)
+                if old_key not in new_keys and os.path.exists(self.manifest.chapter_file(old_key)):
+                    os.remove(self.manifest.chapter_file(old_key))
+            self.manifest.chapter_done(
+                new_key, chapter_title, index, chapter_content, chapter_summary, chapter_context(self.chapter_titles, index)
+            )
+        if previous_chapters:
+            print(f"TOC diff: {len(reused)} of {len(self.chapter_titles)} chapters unchanged, "
+                  f"{len(self.chapter_titles) - len(reused)} to write")
+
+    def link_chapter_images(self):
+        # Chapters link their image by name while it is generated. Once it is stored the chapter file is
+        # pointed at its web variant, so the chapter files, the editor and the library show the image.
+        image_hashes = self.manifest.image_hashes()
+        for index, chapter in enumerate(self.chapters):
+            digest = image_hashes.get(chapter_image_name(chapter["title"]))
+            target = self.image_store.link(digest) if digest else None
+            if not target:
+                continue
+            chapter_content = link_chapter_image(chapter["content"], chapter["title"], target)
+            if chapter_content == chapter["content"]:
+                continue
+            safe_chapter_title = sanitize_filename(chapter["title"])
+            atomic_write_text(self.manifest.chapter_file(safe_chapter_title), chapter_content)
+            self.manifest.chapter_done(
+                safe_chapter_title, chapter["title"], index, chapter_content, chapter["summary"],
+                chapter_context(self.chapter_titles, index)
+            )
+            chapter["content"] = chapter_content
+
+    def research_chapters(self, toc):
+        # One search for the topic and one per chapter, run in parallel under the Tavily budget.
+        # Results are indexed by query, so chapter prompts and their cache keys do not depend on timing.
+        queries = [self.topic] + [chapter_search_query(self.topic, title) for title in toc_chapter_titles(toc)]
+        # Queries already searched for this book, e.g. while the TOC was reviewed, are not repeated
+        queries = [query for query in dict.fromkeys(queries) if query not in self.researched_queries]
+        self.researched_queries.update(queries)
+        executor = ThreadPoolExecutor(max_workers=max_concurrent_searches)
+        try:
+            futures = [executor.submit(self.researcher.search_results, query) for query in queries]
+            for query, future in zip(queries, futures):
+                self.research_index.add_results(future.result(), query)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        stats = self.research_index.stats()
+        print(f"Research index: {stats['sources']} sources from {len(queries)} searches, {stats['duplicates']} duplicates skipped")
+
+    def speculate_chapters(self, toc, include_images, max_in_flight, spend_limit=speculative_spend_limit):
+        # Writes the proposed chapters while the TOC is under review. Finished chapters are recorded
+        # in the manifest like in a normal run, so generate_content reuses every chapter whose TOC
+        # line survived the review and rewrites only the edited ones. Runs until all chapters are
+        # written, the spend limit is reached or stop_speculation is called.
+        if self.cache and self.cache.is_bypassed("chapters"):
+            return
+        self.speculating = True
+        chapter_titles = toc_chapter_titles(toc)
+        self.chapter_titles = chapter_titles
+        if self.manifest is None:
+            self.manifest = RunManifest.load_or_create(self.book_folder)
+        self.manifest.speculation_started(include_images)
+        # The research is needed by the real run as well, only the chapters count as speculative spend
+        self.research_chapters(toc)
+        start_cost = self.telemetry.summary()["cost"]
+        chapter_estimate = billed_cost(
+            self.provider, estimate_chat_cost("gpt-4o", 3000, 1500) + estimate_chat_cost("gpt-4o", 800, summary_max_tokens)
+        )
+        executor = ThreadPoolExecutor(max_workers=max(1, max_in_flight))
+        running = {}
+        next_index = 0
+        written = 0
+        try:
+            while True:
+                self.check_cancelled()
+                spent = self.telemetry.summary()["cost"] - start_cost
+                if self.speculation_stop.is_set():
+                    # Chapters whose line was edited or deleted are dropped, the others may finish
+                    approved = self.speculation_approved_titles
+                    keep = unchanged_chapters(chapter_titles, approved) if approved is not None else set()
+                    for index, discard_event in running.values():
+                        if index not in keep:
+                            discard_event.set()
+                else:
+                    while (next_index < len(chapter_titles) and len(running) < max_in_flight
+                           and spent + (len(running) + 1) * chapter_estimate <= spend_limit):
+                        discard_event = threading.Event()
+                        future = executor.submit(
+                            self.speculate_chapter, next_index, chapter_titles[next_index], include_images, discard_event
+                        )
+                        running[future] = (next_index, discard_event)
+                        next_index += 1
+                if not running:
+                    break
+                if self.speculation_stop.is_set():
+                    self.post_status(f"Finishing chapters written during the review ({len(running)} left)", 15)
+                else:
+                    self.post_status(
+                        f"Writing chapters during TOC review ({written}/{len(chapter_titles)}, ${spent:.2f} of ${spend_limit:.2f})", 0
+                    )
+                done, _ = wait(running, timeout=0.2, return_when=FIRST_COMPLETED)
+                for future in done:
+                    running.pop(future)
+                    written += 1 if future.result() else 0
+        finally:
+            for index, discard_event in running.values():
+                discard_event.set()
+            executor.shutdown(wait=True, cancel_futures=True)
+            self.speculating = False
+        print(f"Speculative chapters: {written} of {len(chapter_titles)} written during the TOC review, "
+              f"${self.telemetry.summary()['cost'] - start_cost:.2f} spent")
+
+    def speculate_chapter(self, index, chapter_title, include_images, discard_event):
+        # Returns True when the chapter was written, failures only cost the speculation
+        self.speculation_local.discard_event = discard_event
+        try:
+            self.generate_and_save_chapter(index, chapter_title, include_images)
+            return True
+        except GenerationCancelled:
+            return False
+        except Exception as e:
+            print(f"Speculative chapter {chapter_title} failed: {e}")
+            return False
+        finally:
+            self.speculation_local.discard_event = None
+
+    def stop_speculation(self, toc=None):
+        # Called from any thread with the approved TOC, or without one to drop every speculative chapter in flight
+        self.speculation_approved_titles = toc_chapter_titles(toc) if toc is not None else None
+        self.speculation_stop.set()
+
+    def reset_progress(self, start, increment):
+        self.progress_lock = threading.Lock()
+        self.current_progress = start
+        self.progress_increment = increment
+
+    def advance_progress(self, message):
+        # Called from chapter and image worker threads
+        with self.progress_lock:
+            self.current_progress = min(self.current_progress + self.progress_increment, 100)
+            progress = self.current_progress
+        self.post_status(message, progress)
+
+    def fast_generation(self, toc, include_images, max_in_flight, stream=False, image_pipeline=None):
+        chapter_titles = self.chapter_titles
+        # Lets the editor list the chapters before their text arrives
+        self.post_event("chapters_started", self.topic, chapter_titles)
+
+        def on_chapter_done(index, chapter_title, chapter_content, chapter_summary):
+            self.post_event("chapter_ready", index, chapter_title, chapter_content)
+
+            # Update progress for each chapter
+            self.advance_progress("Generating Content")
+
+            if image_pipeline:
+                # The chapter image only needs the title and summary, so it can start right away
+                if self.image_reusable(chapter_image_name(chapter_title)):
+                    self.advance_progress("Generating Images")
+                else:
+                    image_pipeline.submit_chapter(chapter_title, chapter_summary)
+
+        results = self.generate_chapters_concurrently(
+            chapter_titles, include_images, max_in_flight, on_chapter_done, stream
+        )
+
+        # Keep chapters and summaries in TOC order regardless of completion order
+        self.chapters = []
+        self.chapter_summaries = []
+        for chapter_title, (chapter_content, chapter_summary) in zip(chapter_titles, results):
+            self.chapter_summaries.append(chapter_summary)
+            self.chapters.append({"title": chapter_title, "content": chapter_content, "summary": chapter_summary})
+
+    def generate_chapters_concurrently(self, chapter_titles, include_images, max_in_flight, on_chapter_done=None, stream=False):
+        # Run at most max_in_flight chapters at once, results are returned in the same order as chapter_titles.
+        # With a shared executor the limit is the executor's, shared with the other books using it.
+        results = [None] * len(chapter_titles)
+        executor = self.chapter_executor or ThreadPoolExecutor(max_workers=max_in_flight)
+        futures = {}
+        try:
+            for index, chapter_title in enumerate(chapter_titles):
+                future = executor.submit(self.generate_and_save_chapter, index, chapter_title, include_images, stream)
+                futures[future] = index
+            pending = set(futures)
+            while pending:
+                # Wake up regularly so a cancel request is noticed while chapters are in flight
+                done, pending = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+                self.check_cancelled()
+                for future in done:
+                    index = futures[future]
+                    results[index] = future.result()
+                    if on_chapter_done:
+                        on_chapter_done(index, chapter_titles[index], *results[index])
+        finally:
+            # Drop queued chapters on cancel or error, in-flight requests finish and are discarded
+            if executor is self.chapter_executor:
+                for future in futures:
+                    future.cancel()
+            else:
+                executor.shutdown(wait=False, cancel_futures=True)
+        return results
+
+    def generate_and_save_chapter(self, index, chapter_title, include_images, stream=False):
+        self.check_cancelled()
+        safe_chapter_title = sanitize_filename(chapter_title)
+        chapter_file = os.path.join(self.book_folder, f"{safe_chapter_title}.md")
+        if not os.path.exists(os.path.dirname(chapter_file)):
+            os.makedirs(os.path.dirname(chapter_file), exist_ok=True)
+
+        # Reuse the chapter from a previous run when it finished and was not changed since
+        reused = self.manifest.reusable_chapter(safe_chapter_title)
+        if reused:
+            print(f"Reusing finished chapter from disk: {chapter_title}")
+            if stream:
+                self.post_event("chapter_text", index, reused[0])
+            self.index_chapter(index, chapter_title, reused[0])
+            return reused
+
+        self.manifest.chapter_started(safe_chapter_title, chapter_title, index)
+        neighbours = self.chapter_neighbours(index)
+        # What the chapters finished so far cover. This depends on which chapters finished first, so it
+        # is left out of the chapter's cache key (see WriterAgent.write_chapter).
+        covered = self.redundancy_index.covered_topics(index, covered_topics_chars)
+        if not stream:
+            chapter_content, chapter_summary = self.generate_chapter(chapter_title, include_images, neighbours=neighbours, covered=covered)
+            self.check_cancelled()
+            atomic_write_text(chapter_file, chapter_content)
+        else:
+            # Streaming: every piece goes to a partial file and to listeners as soon as it arrives,
+            # the chapter file is only replaced once the chapter is complete
+            partial_file = f"{chapter_file}.part"
+            try:
+                with open(partial_file, "w", encoding="utf-8") as file:
+                    def on_text(text):
+                        self.check_cancelled()
+                        file.write(text)
+                        file.flush()
+                        self.post_event("chapter_text", index, text)
+
+                    chapter_content, chapter_summary = self.generate_chapter(chapter_title, include_images, on_text, neighbours, covered)
+                    os.fsync(file.fileno())
+                os.replace(partial_file, chapter_file)
+            except BaseException:
+                if os.path.exists(partial_file):
+                    os.remove(partial_file)
+                raise
+        self.manifest.chapter_done(
+            safe_chapter_title, chapter_title, index, chapter_content, chapter_summary, chapter_context(self.chapter_titles, index)
+        )
+        self.telemetry.chapter_written()
+        self.index_chapter(index, chapter_title, chapter_content)
+        return chapter_content, chapter_summary
+
+    def index_chapter(self, index, chapter_title, chapter_content):
+        for flag in self.redundancy_index.add_chapter(index, chapter_title, chapter_content):
+            print(
+                f"Repeated passage ({flag['similarity']:.0%} overlap): {self.redundancy_index.chapter_title(flag['chapter'])} "
+                f"repeats {self.redundancy_index.chapter_title(flag['other_chapter'])}"
+            )
+
+    def rewrite_redundant_passages(self, max_in_flight):
+        # Only the flagged passages are sent back to the writer, the rest of each chapter stays as it is
+        plan = self.redundancy_index.rewrite_plan()
+        jobs = [(index, flag) for index, flags in plan.items() for flag in flags][:max_redundancy_rewrites]
+        if not jobs:
+            return
+        self.post_status(f"Rewriting {len(jobs)} repeated passages", self.current_progress)
+        executor = self.chapter_executor or ThreadPoolExecutor(max_workers=max_in_flight)
+        futures = [executor.submit(self.rewrite_passage, index, flag) for index, flag in jobs]
+        try:
+            rewrites = [future.result() for future in futures]
+        finally:
+            if executor is self.chapter_executor:
+                for future in futures:
+                    future.cancel()
+            else:
+                executor.shutdown(wait=False, cancel_futures=True)
+
+        rewritten_chapters = {}
+        for (index, flag), rewritten in zip(jobs, rewrites):
+            chapter_content = rewritten_chapters.get(index, self.chapters[index]["content"])
+            if rewritten and flag["text"] in chapter_content:
+                rewritten_chapters[index] = chapter_content.replace(flag["text"], rewritten, 1)
+        for index, chapter_content in rewritten_chapters.items():
+            chapter_title = self.chapter_titles[index]
+            safe_chapter_title = sanitize_filename(chapter_title)
+            atomic_write_text(self.manifest.chapter_file(safe_chapter_title), chapter_content)
+            self.manifest.chapter_edited(safe_chapter_title, chapter_content)
+            self.chapters[index]["content"] = chapter_content
+            self.index_chapter(index, chapter_title, chapter_content)
+            self.post_event("chapter_ready", index, chapter_title, chapter_content)
+        print(f"Rewrote {len(jobs)} repeated passages in {len(rewritten_chapters)} chapters")
+
+    def rewrite_passage(self, index, flag):
+        rewritten = self.writer.rewrite_passage(
+            self.topic, self.chapter_titles[index], flag["text"], self.chapter_titles[flag["other_chapter"]], flag["other_text"]
+        )
+        # A passage stays a passage, headings in the answer are dropped
+        blocks = re.split(r"\n\s*\n", normalize_markdown(rewritten))
+        return "\n\n".join(block for block in blocks if block and not block.startswith("#"))
+
+    def chapter_neighbours(self, index):
+        # Titles of the previous and next chapter without their numbers, so renumbering does not change the prompt
+        previous_title = strip_chapter_number(self.chapter_titles[index - 1]) if index > 0 else ""
+        next_title = strip_chapter_number(self.chapter_titles[index + 1]) if index + 1 < len(self.chapter_titles) else ""
+        return previous_title, next_title
+
+    def generate_chapter(self, chapter_title, include_images, on_text=None, neighbours=("", ""), covered=""):
+        chapter_image_markdown = ""
+        if include_images:
+            # The image is linked by its name until it is stored, see link_chapter_images
+            chapter_image_markdown = f"![{chapter_title} Image]({chapter_image_name(chapter_title)})\n\n"
+        # Only the sources most relevant to this chapter go into the prompt, chosen from what its own search
+        # and the topic search found, so the prompt stays the same when other chapters of the TOC change
+        research_data = self.research_index.research_for(
+            chapter_search_query(self.topic, chapter_title), research_sources_per_chapter, research_source_chars, (self.topic,)
+        )
+        pieces = []
+
+        def add_pieces(new_pieces):
+            # Only complete lines come out of the normaliser
+            for piece in new_pieces:
+                if piece:
+                    if on_text:
+                        on_text(piece)
+                    pieces.append(piece)
+
+        add_pieces([chapter_image_markdown])
+        normalizer = MarkdownNormalizer()
+        outcome = {}
+        stream = on_text is not None
+        answer = self.writer.write_chapter(self.topic, chapter_title, research_data, neighbours, stream, outcome, covered)
+        for piece in (answer if stream else [answer]):
+            add_pieces(normalizer.feed(piece))
+
+        # A chapter cut off by max_tokens or ending mid-sentence gets its missing end in a smaller follow-up
+        # request. The unfinished line is dropped, the continuation starts on a new line in its place.
+        for _ in range(max_chapter_continuations):
+            if outcome.get("finish_reason") != "length":
+                add_pieces(normalizer.finish_fence_line())
+            reason = truncation_reason(normalizer, outcome.get("finish_reason"))
+            if not reason:
+                break
+            self.check_cancelled()
+            print(f"Chapter was cut off ({reason}), requesting the rest: {chapter_title}")
+            normalizer.discard_partial_line()
+            outcome = {}
+            written_text = "".join(pieces)
+            baseline_prompt_tokens = count_message_tokens(chapter_messages(self.topic, chapter_title, research_data, *neighbours))
+            answer = self.writer.continue_chapter(
+                self.topic, chapter_title, written_text, normalizer.fence is not None, stream, outcome, baseline_prompt_tokens
+            )
+            for piece in itertools.chain(["\n"], answer if stream else [answer]):
+                add_pieces(normalizer.feed(piece))
+        add_pieces(normalizer.close())
+        chapter_content = "".join(pieces)
+        chapter_summary = self.writer.summarize(chapter_content)
+        return chapter_content, chapter_summary
+
+    def merge_chapters_into_single_content(self):
+        # Image names are pointed at the web sized variants in the asset store
+        resolve_links = self.image_store.link_resolver(self.manifest.image_hashes() if self.manifest else {})
+        return "".join(resolve_links(piece) for piece in iter_book_markdown(self.topic, self.chapters))
+
+    def image_reusable(self, image_name):
+        digest = self.manifest.image_hash(image_name)
+        if digest is None:
+            return False
+        if self.image_store.has(digest):
+            return True
+        # Books written before the asset store keep each image under its own name in the book folder
+        legacy_path = os.path.join(self.book_folder, image_name)
+        if os.path.exists(legacy_path) and file_hash(legacy_path) == digest:
+            self.image_store.add_file(legacy_path)
+            return True
+        return False
+
+    def save_merged_markdown(self, final_md_content):
+        # Use the sanitized book name for the markdown file
+        book_name = sanitize_filename(self.topic)
+        file_path = os.path.join(self.book_folder, f"{book_name}.md")
+        atomic_write_text(file_path, final_md_content)
+        return file_path
+
+# Custom Agent Classes
+
+class ResearcherAgent:
+    def __init__(self, tavily_api_key, cache=None, scheduler=None, check_cancelled=None, telemetry=None, provider=None):
+        self.tavily_api_key = tavily_api_key
+        self.cache = cache
+        self.scheduler = scheduler or get_scheduler()
+        self.check_cancelled = check_cancelled
+        self.telemetry = telemetry
+        self.provider = provider or get_provider()
+        self.name = "Researcher"
+        self.role = "Gather information"
+        self.goal = "Collect and synthesize comprehensive and reliable data relevant to the ebook's topic"
+        self.backstory = "Expert in data gathering and internet research, with a keen eye for detail"
+        self.verbose = True
+        self.llm = "gpt-4o"
+        self.allow_delegation = True
+        self.tools = ["advanced_llm", "web_access", "tavily_api"]
+
+    def execute_task(self, task):
+        print(f"\n{self.name} is executing the task: {task}\n")
+        try:
+            tavily_data = self.search(task)
+            if tavily_data is not None:
+                research_data = self.validate_data(tavily_data)
+                if not research_data.get("answer"):
+                    research_data['answer'] = self.generate_answer_from_results(research_data.get("results", []), task)
+                print(research_data)
+                return research_data
+            else:
+                return None
+        except requests.exceptions.RequestException as e:
+            print(f"Exception during Tavily API call: {e}")
+            return None
+
+    def search(self, query):
+        # Raw Tavily response, served from the cache when the same query was searched before
+        key = ResponseCache.make_key("tavily", query)
+        if self.cache:
+            cached = self.cache.get_json("research", key)
+            if cached is not None:
+                if self.telemetry:
+                    self.telemetry.record("research", "tavily", time.monotonic(), cached=True)
+                return cached
+        started = time.monotonic()
+        try:
+            tavily_response = self.scheduler.call(
+                "tavily", self.post_search, query, priority=priority_research, check_cancelled=self.check_cancelled
+            )
+        except (RetryableHTTPError, requests.exceptions.RequestException) as e:
+            if self.telemetry:
+                self.telemetry.record("research", "tavily", started, self.scheduler.last_call_stats(), ok=False)
+            if isinstance(e, requests.exceptions.RequestException):
+                raise
+            print(f"Error fetching data from Tavily API: {e}")
+            return None
+        ok = tavily_response.status_code == 200
+        if self.telemetry:
+            cost = billed_cost(self.provider, tavily_search_price) if ok else 0.0
+            self.telemetry.record("research", "tavily", started, self.scheduler.last_call_stats(), cost=cost, ok=ok)
+        if not ok:
+            print(f"Error fetching data from Tavily API: {tavily_response.status_code} - {tavily_response.text}")
+            return None
+        tavily_data = tavily_response.json()
+        if self.cache:
+            self.cache.put_json("research", key, tavily_data, billed_cost(self.provider, tavily_search_price))
+        return tavily_data
+
+    def search_results(self, query):
+        # Result list for a query, empty when the search failed
+        try:
+            tavily_data = self.search(query)
+        except requests.exceptions.RequestException as e:
+            print(f"Exception during Tavily API call: {e}")
+            return []
+        if tavily_data is None:
+            return []
+        return self.validate_data(tavily_data)["results"]
+
+    def post_search(self, query):
+        tavily_response = self.provider.post_search(self.tavily_api_key, query, http_timeout(tavily_request_timeout))
+        self.scheduler.observe_headers("tavily", tavily_response.headers)
+        if tavily_response.status_code == 429 or tavily_response.status_code >= 500:
+            raise RetryableHTTPError(
+                f"{tavily_response.status_code} - {tavily_response.text}", tavily_response.status_code, tavily_response.headers
+            )
+        return tavily_response
+
+    def validate_data(self, tavily_data):
+        validated_data = {
+            "answer": tavily_data.get("answer", ""),
+            "query": tavily_data.get("query", ""),
+            "images": tavily_data.get("images", []),
+            "results": tavily_data.get("results", []),
+            "response_time": tavily_data.get("response_time", ""),
+            "follow_up_questions": tavily_data.get("follow_up_questions", [])
+        }
+        return validated_data
+
+    def generate_answer_from_results(self, results, query):
+        if not results:
+            return ""
+        search_snippets = "\n".join([result.get('snippet', '') for result in results if result.get('snippet')])
+        messages = [
+            {"role": "system", "content": "You are an assistant that summarizes search results into a coherent answer."},
+            {"role": "user", "content": f"Based on the following search results, provide a comprehensive answer to the query '{query}':\n\n{search_snippets}"},
+        ]
+        answer = cached_chat_completion(
+            self.cache,
+            "research",
+            self.scheduler,
+            priority_research,
+            self.check_cancelled,
+            telemetry=self.telemetry,
+            provider=self.provider,
+            model="gpt-4o",
+            messages=messages,
+            max_tokens=500,
+            temperature=0.7,
+        )
+        return answer
+
+class ContentOrganizerAgent:
+    def __init__(self, cache=None, scheduler=None, check_cancelled=None, telemetry=None, provider=None):
+        self.cache = cache
+        self.scheduler = scheduler or get_scheduler()
+        self.check_cancelled = check_cancelled
+        self.telemetry = telemetry
+        self.provider = provider or get_provider()
+
+    def execute_task(self, data):
+        if not data['answer'] and not data['results']:
+            return "Unable to generate Table of Contents due to lack of research data."
+        messages = [
+            {"role": "system", "content": "You are an assistant that helps generate a table of contents for an e-book."},
+            {"role": "user", "content": f"Based on the following research data, generate a detailed table of contents for an e-book on '{data['query']}':\n\n{data['answer']}\n\nTable of contents should only have chapters, but no sub chapters or sections. Table of content should be systematic, should have high level topics and gradually increase the depth on the topic rather than a random list. Chapters should have CHAPTER 01 - Chapter name, CHAPTER 02 - Chapter name and so on as prefix. Do not include the text Table of contents as a chapter. Do not generate prefatory or introductory statements. Just show the output."},
+        ]
+        toc = cached_chat_completion(
+            self.cache,
+            "toc",
+            self.scheduler,
+            priority_toc,
+            self.check_cancelled,
+            telemetry=self.telemetry,
+            provider=self.provider,
+            model="gpt-4o",
+            messages=messages,
+            max_tokens=500,
+            temperature=0.7,
+        )
+        return toc
+
+class WriterAgent:
+    def __init__(self, cache=None, scheduler=None, check_cancelled=None, ledger=None, telemetry=None, provider=None):
+        self.cache = cache
+        self.scheduler = scheduler or get_scheduler()
+        self.check_cancelled = check_cancelled
+        self.ledger = ledger
+        self.telemetry = telemetry
+        self.provider = provider or get_provider()
+
+    def chat_params(self, messages, max_tokens=1500):
+        return dict(model="gpt-4o", messages=messages, max_tokens=max_tokens, temperature=0.7)
+
+    def execute_task(self, messages, priority=priority_chapter, max_tokens=1500, report_stage="chapters", baseline_prompt_tokens=None,
+                     outcome=None, cache_key=None):
+        content = cached_chat_completion(
+            self.cache,
+            "chapters",
+            self.scheduler,
+            priority,
+            self.check_cancelled,
+            self.ledger,
+            report_stage,
+            baseline_prompt_tokens,
+            self.telemetry,
+            self.provider,
+            outcome,
+            cache_key,
+            **self.chat_params(messages, max_tokens)
+        )
+        return content
+
+    def write_chapter(self, topic, chapter_title, research_data, neighbours=("", ""), stream=False, outcome=None, covered=""):
+        # Returns the chapter text, or a generator of text pieces when streaming.
+        # outcome receives the finish_reason, so a chapter cut off at max_tokens can be completed.
+        # The prompt is as long as it always was, moving the instructions to the front only lets the
+        # provider cache them, which the token report shows as prompt tokens cached by the provider
+        messages = chapter_messages(topic, chapter_title, research_data, *neighbours, covered)
+        # The covered note depends on which chapters finished first, so the cache key is that of the
+        # prompt without it and a rerun finds the chapter whatever order the chapters finish in
+        cache_key = chat_cache_key(self.chat_params(chapter_messages(topic, chapter_title, research_data, *neighbours)))
+        if stream:
+            return self.stream_task(messages, outcome=outcome, cache_key=cache_key)
+        return self.execute_task(messages, outcome=outcome, cache_key=cache_key)
+
+    def continue_chapter(self, topic, chapter_title, written_text, in_code_block=False, stream=False, outcome=None,
+                         baseline_prompt_tokens=None):
+        # Only the missing end of a chapter, see continuation_messages.
+        # baseline_prompt_tokens is the prompt of the full chapter, which a rewrite would send again.
+        messages = continuation_messages(topic, chapter_title, written_text, in_code_block)
+        if stream:
+            return self.stream_task(messages, baseline_prompt_tokens, chapter_continuation_tokens, "continuations", outcome)
+        return self.execute_task(
+            messages, priority_chapter, chapter_continuation_tokens, "continuations", baseline_prompt_tokens, outcome
+        )
+
+    def rewrite_passage(self, topic, chapter_title, passage, other_title, other_passage):
+        return self.execute_task(
+            rewrite_messages(topic, chapter_title, passage, other_title, other_passage),
+            priority_chapter,
+            count_tokens(passage) * 2 + 100,
+            "rewrites",
+        )
+
+    def summarize(self, chapter_content):
+        # Summaries are written from a compact extract of the chapter, not the full text
+        extract = compact_extract(chapter_content)
+        return self.execute_task(
+            summary_messages(extract),
+            priority_summary,
+            summary_max_tokens,
+            "summaries",
+            count_message_tokens(summary_messages(chapter_content)),
+        )
+
+    def stream_task(self, messages, baseline_prompt_tokens=None, max_tokens=1500, report_stage="chapters", outcome=None,
+                    cache_stage="chapters", cache_key=None):
+        # Yield the completion piece by piece as the API streams it.
+        # With cache_stage None the answer is neither read from nor stored in the cache, only its cost is counted.
+        params = self.chat_params(messages, max_tokens)
+        key = cache_key or chat_cache_key(params)
+        started = time.monotonic()
+        if self.cache and cache_stage:
+            cached = self.cache.get_text(cache_stage, key)
+            if cached is not None:
+                prompt_tokens = count_message_tokens(messages)
+                completion_tokens = count_tokens(cached)
+                if self.ledger:
+                    self.ledger.record(report_stage, prompt_tokens, completion_tokens, baseline_prompt_tokens, cached=True)
+                if self.telemetry:
+                    self.telemetry.record(report_stage, params["model"], started, None, prompt_tokens, completion_tokens, cached=True)
+                yield cached
+                return
+        # The scheduler covers opening the stream, a stream that breaks halfway is not retried
+        reserved_tokens = reserved_chat_tokens(params)
+        try:
+            response = self.scheduler.call(
+                params["model"],
+                self.provider.chat_completion,
+                priority=priority_chapter,
+                tokens=reserved_tokens,
+                check_cancelled=self.check_cancelled,
+                request_timeout=http_timeout(openai_request_timeout),
+                stream=True,
+                **params
+            )
+        finally:
+            call_stats = self.scheduler.last_call_stats()
+        pieces = []
+        completed = False
+        try:
+            for chunk in response:
+                content = chunk['choices'][0].get('delta', {}).get('content')
+                if content:
+                    pieces.append(content)
+                    yield content
+                finish_reason = chunk['choices'][0].get('finish_reason')
+                if finish_reason and outcome is not None:
+                    outcome["finish_reason"] = finish_reason
+            completed = True
+        finally:
+            # Streamed responses carry no usage, so tokens and cost are estimated locally.
+            # Only complete responses are cached, an interrupted stream still counts as spent.
+            content = "".join(pieces).strip()
+            prompt_tokens = count_message_tokens(params["messages"], params["model"])
+            completion_tokens = count_tokens(content, params["model"])
+            # The unused part of max_tokens goes back to the token budget
+            self.scheduler.refund(params["model"], reserved_tokens - (prompt_tokens + completion_tokens))
+            cost = billed_cost(self.provider, estimate_chat_cost(params["model"], prompt_tokens, completion_tokens))
+            if self.ledger:
+                self.ledger.record(report_stage, prompt_tokens, completion_tokens, baseline_prompt_tokens)
+            if self.telemetry:
+                self.telemetry.record(
+                    report_stage, params["model"], started, call_stats, prompt_tokens, completion_tokens, cost=cost, ok=completed
+                )
+            if self.cache:
+                if completed and cache_stage:
+                    self.cache.put_text(cache_stage, key, content, cost)
+                else:
+                    self.cache.record_cost(cost)
+
+class DesignerAgent:
+    def __init__(self, cache=None, scheduler=None, telemetry=None, provider=None):
+        self.cache = cache
+        self.scheduler = scheduler or get_scheduler()
+        self.telemetry = telemetry
+        self.provider = provider or get_provider()
+        self.image_params = {"model": "dall-e-3", "n": 1, "size": "1024x1024", "quality": "hd", "style": "vivid"}
+        self.name = "Designer"
+        self.role = "Generate cover page design"
+        self.goal = "Create a relevant, minimal, and beautiful cover page using DALL-E 3"
+        self.backstory = "Creative designer with a knack for generating stunning visuals"
+        self.verbose = True
+        self.llm = "dalle-3"
+        self.allow_delegation = True
+        self.tools = ["advanced_llm", "image_generation"]
+
+    def generate_cover_prompt(self, book_title):
+        return f"Create an artwork design on subject '{book_title}'. The design should be minimal, beautiful, and relevant to the topic. The artwork should not be too imaginary. The artwork should not have actual book, book cover, book mockups and texts."
+
+    def generate_chapter_prompt(self, chapter_title, chapter_summary):
+        # Base prompt text
+        base_prompt = f"Create an artwork design for the chapter titled '{chapter_title}'. The design should be minimal, beautiful, and relevant to the topic. The artwork should not be too imaginary. The artwork should not have actual book, book cover, book mockups and texts. Here is a brief summary of the chapter: "
+        
+        # Calculate the maximum allowed length for the summary
+        max_summary_length = 3800 - len(base_prompt)
+        
+        # Long text is reduced to its headings and lead sentences, then truncated if still necessary
+        if len(chapter_summary) > max_summary_length:
+            chapter_summary = compact_extract(chapter_summary, max_summary_length // 4)
+        if len(chapter_summary) > max_summary_length:
+            chapter_summary = chapter_summary[:max_summary_length] + "..."
+        
+        return base_prompt + chapter_summary
+
+    def start_pipeline(self, image_store, cancel_event=None, on_image_saved=None):
+        return ImagePipeline(self, image_store, cancel_event, on_image_saved)
+
+    def execute_task(self, book_folder, topic, toc, chapters, cancel_event=None):
+        # Returns {image name: content hash} of the images saved to the book's asset store
+        image_store = ImageStore(book_folder)
+        saved = {}
+        pipeline = self.start_pipeline(image_store, cancel_event, saved.__setitem__)
+        try:
+            # Generate cover page design
+            pipeline.submit_cover(topic)
+
+            # Generate prompts and images for each chapter
+            for chapter in chapters:
+                pipeline.submit_chapter(chapter['title'], chapter.get('summary') or chapter['content'])
+            pipeline.wait()
+        finally:
+            pipeline.shutdown()
+            image_store.close()
+        return saved
+
+    def create_image(self, prompt, check_cancelled=None):
+        print(f"Prompt for DALL-E 3: {prompt}")
+
+        # Use DALL-E 3 to generate the image, images wait behind TOC and chapter calls in the scheduler
+        started = time.monotonic()
+        try:
+            completion_response = self.scheduler.call(
+                self.image_params["model"],
+                self.provider.create_image,
+                priority=priority_image,
+                check_cancelled=check_cancelled,
+                request_timeout=http_timeout(openai_request_timeout),
+                prompt=prompt,
+                **self.image_params
+            )
+        except Exception:
+            if self.telemetry:
+                self.telemetry.record("images", self.image_params["model"], started, self.scheduler.last_call_stats(), ok=False)
+            raise
+        if self.telemetry:
+            self.telemetry.record(
+                "images", self.image_params["model"], started, self.scheduler.last_call_stats(), images=1, cost=self.image_cost()
+            )
+        return completion_response['data'][0]['url']
+
+    def image_cache_key(self, prompt):
+        return ResponseCache.make_key(self.image_params["model"], prompt, self.image_params)
+
+    def image_cost(self):
+        return billed_cost(
+            self.provider, image_prices.get((self.image_params["model"], self.image_params["size"], self.image_params["quality"]), 0.0)
+        )
+
+    def download_image(self, image_url, image_path, check_cancelled=None):
+        started = time.monotonic()
+        try:
+            saved = self.scheduler.call(
+                "download", self.stream_image_to_file, image_url, image_path,
+                priority=priority_download, check_cancelled=check_cancelled
+            )
+        except (RetryableHTTPError, requests.exceptions.RequestException) as e:
+            print(f"Failed to download {image_url}: {e}")
+            saved = False
+        if self.telemetry:
+            self.telemetry.record("downloads", "download", started, self.scheduler.last_call_stats(), ok=saved)
+        return saved
+
+    def stream_image_to_file(self, image_url, image_path):
+        # Stream the image to a temporary file in chunks, then move it into place
+        temp_path = image_path + ".part"
+        try:
+            with self.provider.get_image(image_url, http_timeout(image_download_timeout)) as image_response:
+                if image_response.status_code == 429 or image_response.status_code >= 500:
+                    raise RetryableHTTPError(f"HTTP {image_response.status_code}", image_response.status_code, image_response.headers)
+                if image_response.status_code != 200:
+                    return False
+                with open(temp_path, "wb") as file:
+                    for chunk in image_response.iter_content(chunk_size=image_download_chunk_size):
+                        file.write(chunk)
+            os.replace(temp_path, image_path)
+            return True
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+# Two stage image pipeline: DALL-E requests run in parallel under the shared scheduler,
+# each finished request hands its URL to a separate download pool so downloads overlap with generation
+class ImagePipeline:
+    def __init__(self, designer, image_store, cancel_event=None, on_image_saved=None):
+        # on_image_saved(image_name, digest) is called once the image is in the asset store
+        self.designer = designer
+        self.image_store = image_store
+        self.cancel_event = cancel_event
+        self.on_image_saved = on_image_saved
+        self.generation_executor = ThreadPoolExecutor(max_workers=max_concurrent_images)
+        self.download_executor = ThreadPoolExecutor(max_workers=max_concurrent_downloads)
+        self.futures = []
+        self.futures_lock = threading.Lock()
+
+    def submit_cover(self, topic):
+        self.submit(self.designer.generate_cover_prompt(topic), cover_image_name, "cover page design")
+
+    def submit_chapter(self, chapter_title, chapter_summary):
+        prompt = self.designer.generate_chapter_prompt(chapter_title, chapter_summary)
+        self.submit(prompt, chapter_image_name(chapter_title), f"image for chapter: {chapter_title}")
+
+    def submit(self, prompt, image_name, description):
+        self.track(self.generation_executor.submit(self.generate, prompt, image_name, description))
+
+    def track(self, future):
+        with self.futures_lock:
+            self.futures.append(future)
+
+    def is_cancelled(self):
+        return self.cancel_event is not None and self.cancel_event.is_set()
+
+    def check_cancelled(self):
+        if self.is_cancelled():
+            raise GenerationCancelled()
+
+    def generate(self, prompt, image_name, description):
+        if self.is_cancelled():
+            return
+        cache = self.designer.cache
+        key = self.designer.image_cache_key(prompt)
+        if cache:
+            # DALL-E URLs expire, so the cache keeps the image bytes
+            image_bytes = cache.get("images", key)
+            if image_bytes is not None:
+                digest = self.image_store.add_bytes(image_bytes)
+                print(f"Reused cached {description} as {image_name}")
+                if self.on_image_saved:
+                    self.on_image_saved(image_name, digest)
+                return
+        image_url = self.designer.create_image(prompt, self.check_cancelled)
+        if self.is_cancelled():
+            if cache:
+                cache.record_cost(self.designer.image_cost())
+            return
+        self.track(self.download_executor.submit(self.download, image_url, image_name, description, key))
+
+    def download(self, image_url, image_name, description, key):
+        cache = self.designer.cache
+        if self.is_cancelled():
+            if cache:
+                cache.record_cost(self.designer.image_cost())
+            return
+        # Downloaded under a temporary name, the store renames it after its content
+        image_path = self.image_store.temp_path()
+        if self.designer.download_image(image_url, image_path, self.check_cancelled):
+            if cache:
+                with open(image_path, "rb") as file:
+                    cache.put("images", key, file.read(), self.designer.image_cost())
+            digest = self.image_store.add_file(image_path)
+            print(f"Saved {description} as {image_name}")
+            if self.on_image_saved:
+                self.on_image_saved(image_name, digest)
+        else:
+            print(f"Failed to download the {description}.")
+            if cache:
+                cache.record_cost(self.designer.image_cost())
+
+    def wait(self):
+        # Wait for every generation and download, including downloads queued while waiting
+        while True:
+            with self.futures_lock:
+                pending = [future for future in self.futures if not future.done()]
+            if not pending:
+                break
+            wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+            if self.is_cancelled():
+                raise GenerationCancelled()
+        with self.futures_lock:
+            futures = list(self.futures)
+        for future in futures:
+            future.result()
+
+    def shutdown(self):
+        self.generation_executor.shutdown(wait=False, cancel_futures=True)
+        self.download_executor.shutdown(wait=False, cancel_futures=True)
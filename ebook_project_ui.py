@@ -1,64 +1,104 @@
-import os
-import re
-import requests
 import tkinter as tk
 from tkinter import filedialog, messagebox, scrolledtext
 from tkinter import ttk
-import openai
-from dotenv import load_dotenv
+import os
 import time
-
-# Load environment variables from .env file
-load_dotenv()
-tavily_api_url = "https://api.tavily.com/search"
-
-# Initialize OpenAI client
-def initialize_openai_client():
-    openai_api_key = os.getenv("OPENAI_API_KEY")
-    if openai_api_key:
-        openai.api_key = openai_api_key
-        return True
-    else:
-        messagebox.showerror("Error", "OpenAI API key not found in .env file.")
-        return False
-
-# Read the Tavily API key
-def read_tavily_api_key():
-    tavily_api_key = os.getenv("TAVILY_API_KEY")
-    if tavily_api_key:
-        return tavily_api_key
-    else:
-        messagebox.showerror("Error", "Tavily API key not found in .env file.")
-        return None
-
-# Function to sanitize filenames
-def sanitize_filename(filename):
-    # Remove invalid characters
-    filename = re.sub(r'[<>:"/\\|?*]', '', filename)
-    # Replace spaces with underscores
-    filename = filename.replace(' ', '_')
-    # Remove non-ASCII characters
-    filename = filename.encode('ascii', 'ignore').decode('ascii')
-    # Truncate filename to a reasonable length
-    return filename[:255]
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from response_cache import open_response_cache, cache_stages
+from run_manifest import RunManifest
+from book_export import BookExporter, ExportError
+from book_document import BookDocument
+from autosave import AutosaveService, autosave_delay_ms
+from book_library import BookLibrary, library_root
+from proofreader import Proofreader, text_paragraphs
+from prompt_builder import count_tokens, selection_tool_messages
+from providers import api_keys_required
+from ebook_engine import (
+    BookGenerator,
+    GenerationCancelled,
+    GenerationError,
+    WriterAgent,
+    default_max_concurrent_chapters,
+    initialize_openai_client,
+    read_tavily_api_key,
+    sanitize_filename,
+    speculative_generation,
+    speculative_spend_limit,
+    toc_chapter_titles,
+)
+
+# How often the UI drains events posted by the background worker
+event_poll_interval_ms = 100
+# Pause in typing before the Library tab searches
+library_search_delay_ms = 250
 
 # GUI Application Class
 class EBookGeneratorApp:
     def __init__(self, root):
         self.root = root
         self.root.title("E-Book Generator")
-        if not initialize_openai_client():
-            return
-        self.tavily_api_key = read_tavily_api_key()
-        if not self.tavily_api_key:
-            return
+        # The keys are only needed by the live provider, the mock provider runs without them
+        if api_keys_required():
+            if not initialize_openai_client():
+                messagebox.showerror("Error", "OpenAI API key not found in .env file.")
+                return
+            self.tavily_api_key = read_tavily_api_key()
+            if not self.tavily_api_key:
+                messagebox.showerror("Error", "Tavily API key not found in .env file.")
+                return
+        else:
+            self.tavily_api_key = os.getenv("TAVILY_API_KEY", "")
         self.book_folder = ""
+        self.engine = None
         self.toc = []
         self.chapters = []
         self.chapter_summaries = []
+        # Final Content is edited one chapter at a time, see book_document.py
+        self.document = None
+        self.active_segment = None
         self.total_cost = 0.0
         self.generate_images = tk.BooleanVar()
+        self.max_concurrent_chapters = tk.IntVar(value=default_max_concurrent_chapters)
+        self.stream_chapters = tk.BooleanVar(value=True)
+        self.speculate_chapters = tk.BooleanVar(value=speculative_generation)
+        self.speculative_spend_limit = tk.DoubleVar(value=speculative_spend_limit)
+        # Content generation waiting for the speculative chapters to wind down
+        self.pending_stage = None
         self.generation_mode = "Fast generation"
+        self.response_cache = open_response_cache()
+        self.use_cache = {stage: tk.BooleanVar(value=not self.response_cache.is_bypassed(stage)) for stage in cache_stages}
+        self.timer_running = False
+
+        # Background worker state, Tk widgets are only touched from the main thread
+        self.events = queue.Queue()
+        self.cancel_event = threading.Event()
+        self.worker_thread = None
+
+        # Edits are saved in the background a moment after they are made
+        self.autosaver = AutosaveService(
+            on_saved=lambda saved, merged_path: self.post_event("autosaved", saved, merged_path),
+            on_error=lambda e: self.post_event("autosave_failed", str(e)),
+        )
+        self.autosave_job = None
+
+        # Index of the generated books, updated on its own thread so the disk is never read on the Tk thread
+        self.library = BookLibrary()
+        self.library_executor = ThreadPoolExecutor(max_workers=1)
+        self.library_results = []
+        self.library_search_job = None
+
+        # AI tools of the Final Content editor: the proofreader only sends paragraphs it has not
+        # checked yet, a selection tool streams its answer into the selection
+        self.proofreader = Proofreader(self.response_cache)
+        self.tools_executor = ThreadPoolExecutor(max_workers=2)
+        self.proofreading = False
+        self.suggestion_tags = {}
+        self.tool_segment = None
+        self.tool_original = ""
+        self.tool_started = False
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
 
         # Create the header frame
         self.header_frame = ttk.Frame(self.root)
@@ -77,6 +117,18 @@ class EBookGeneratorApp:
         self.timer_label = ttk.Label(self.header_frame, text="Time: 00:00")
         self.timer_label.pack(side=tk.LEFT, padx=5)
 
+        # Add cost label
+        self.cost_label = ttk.Label(self.header_frame, text="Cost: $0.00")
+        self.cost_label.pack(side=tk.LEFT, padx=5)
+
+        # Add live throughput and critical path of the running generation
+        self.telemetry_label = ttk.Label(self.header_frame, text="")
+        self.telemetry_label.pack(side=tk.LEFT, padx=5)
+
+        # Add cancel button
+        self.cancel_button = ttk.Button(self.header_frame, text="Cancel", command=self.cancel_generation, state=tk.DISABLED)
+        self.cancel_button.pack(side=tk.LEFT, padx=5)
+
         # Create the notebook (tabs)
         self.notebook = ttk.Notebook(self.root)
         self.notebook.pack(fill='both', expand=True)
@@ -85,16 +137,23 @@ class EBookGeneratorApp:
         self.generation_frame = ttk.Frame(self.notebook)
         self.toc_review_frame = ttk.Frame(self.notebook)
         self.final_content_frame = ttk.Frame(self.notebook)
+        self.library_frame = ttk.Frame(self.notebook)
 
         # Add tabs to the notebook
         self.notebook.add(self.generation_frame, text='E-Book Generation')
         self.notebook.add(self.toc_review_frame, text='TOC Review')
         self.notebook.add(self.final_content_frame, text='Final Content')
+        self.notebook.add(self.library_frame, text='Library')
 
         # Initialize UI elements
         self.create_generation_tab()
         self.create_toc_review_tab()
         self.create_final_content_tab()
+        self.create_library_tab()
+
+        # Start draining worker events
+        self.root.after(event_poll_interval_ms, self.poll_events)
+        self.refresh_library()
 
     def create_generation_tab(self):
         # Topic Frame
@@ -112,24 +171,47 @@ class EBookGeneratorApp:
             text="Generate images for chapters and cover page",
             variable=self.generate_images
         ).pack(anchor=tk.W)
+        ttk.Checkbutton(
+            options_frame,
+            text="Stream chapters into the Final Content editor while they are written",
+            variable=self.stream_chapters
+        ).pack(anchor=tk.W)
+        speculation_frame = ttk.Frame(options_frame)
+        speculation_frame.pack(anchor=tk.W)
+        ttk.Checkbutton(
+            speculation_frame,
+            text="Start writing chapters while the TOC is reviewed, spending at most $",
+            variable=self.speculate_chapters
+        ).pack(side=tk.LEFT)
+        ttk.Spinbox(
+            speculation_frame,
+            from_=0,
+            to=100,
+            increment=0.25,
+            width=6,
+            textvariable=self.speculative_spend_limit
+        ).pack(side=tk.LEFT)
+        cache_frame = ttk.Frame(options_frame)
+        cache_frame.pack(anchor=tk.W, pady=5)
+        ttk.Label(cache_frame, text="Reuse cached responses for:").pack(side=tk.LEFT)
+        for stage in cache_stages:
+            ttk.Checkbutton(cache_frame, text=stage.capitalize(), variable=self.use_cache[stage]).pack(side=tk.LEFT, padx=5)
+        concurrency_frame = ttk.Frame(options_frame)
+        concurrency_frame.pack(anchor=tk.W, pady=5)
+        ttk.Label(concurrency_frame, text="Chapters generated in parallel:").pack(side=tk.LEFT)
+        ttk.Spinbox(
+            concurrency_frame,
+            from_=1,
+            to=16,
+            width=5,
+            textvariable=self.max_concurrent_chapters
+        ).pack(side=tk.LEFT, padx=5)
 
         # Action Buttons Frame
         action_frame = ttk.Frame(self.generation_frame)
         action_frame.pack(pady=10, padx=10)
-        ttk.Button(action_frame, text="Start Generation", command=self.start_generation).pack()
-
-        # Features in the Pipeline Section
-        pipeline_frame = ttk.Frame(self.generation_frame)
-        pipeline_frame.pack(pady=10, padx=10, fill='x')
-
-        ttk.Label(pipeline_frame, text="Features in the pipeline", font=("Arial", 10, "bold")).pack(anchor=tk.W)
-        features = [
-            "- Proof reader in the Final Content tab",
-            "- Exporting to PDF",
-            "- More AI tools in the Final Content text editor like rewrite, summarize, expand and check grammar."
-        ]
-        for feature in features:
-            ttk.Label(pipeline_frame, text=feature, foreground="gray").pack(anchor=tk.W, padx=10)
+        ttk.Button(action_frame, text="Start Generation", command=self.start_generation).pack(side=tk.LEFT, padx=5)
+        ttk.Button(action_frame, text="Resume", command=self.resume_generation).pack(side=tk.LEFT, padx=5)
 
     def create_toc_review_tab(self):
         # TOC Label
@@ -174,18 +256,84 @@ class EBookGeneratorApp:
         self.add_toolbar_button(second_row_frame, "Numbered List", lambda: self.insert_md_syntax("1. ", ""))
         self.add_toolbar_button(second_row_frame, "Task List", lambda: self.insert_md_syntax("- [ ] ", ""))
 
+        # Third row: AI tools, the selection tools replace the selected text with their answer
+        tools_frame = ttk.Frame(self.final_content_frame)
+        tools_frame.pack(pady=5, padx=10, fill='x')
+
+        self.add_toolbar_button(tools_frame, "Rewrite", lambda: self.run_selection_tool("rewrite"))
+        self.add_toolbar_button(tools_frame, "Summarize", lambda: self.run_selection_tool("summarize"))
+        self.add_toolbar_button(tools_frame, "Expand", lambda: self.run_selection_tool("expand"))
+        self.add_toolbar_button(tools_frame, "Check Grammar", lambda: self.run_selection_tool("grammar"))
+        self.add_toolbar_button(tools_frame, "Proofread", self.proofread_document)
+        self.tools_label = ttk.Label(tools_frame, text="", foreground="gray")
+        self.tools_label.pack(side=tk.LEFT, padx=5)
+
         # Horizontal separator
         ttk.Separator(self.final_content_frame, orient='horizontal').pack(fill='x', padx=10, pady=5)
 
+        # Chapter navigator next to the editor, only the selected chapter is loaded into the editor
+        editor_pane = ttk.PanedWindow(self.final_content_frame, orient=tk.HORIZONTAL)
+        editor_pane.pack(fill='both', expand=True, padx=10, pady=5)
+        navigator_frame = ttk.Frame(editor_pane)
+        self.chapter_list = tk.Listbox(navigator_frame, exportselection=False, width=32)
+        chapter_list_scrollbar = ttk.Scrollbar(navigator_frame, orient=tk.VERTICAL, command=self.chapter_list.yview)
+        self.chapter_list.config(yscrollcommand=chapter_list_scrollbar.set)
+        self.chapter_list.pack(side=tk.LEFT, fill='both', expand=True)
+        chapter_list_scrollbar.pack(side=tk.LEFT, fill='y')
+        self.chapter_list.bind("<<ListboxSelect>>", self.on_chapter_selected)
+        editor_pane.add(navigator_frame, weight=1)
+
         # Content Text Area with increased font size
         font_settings = ("TkDefaultFont", 14)  # Increased by 4 points from the original
-        self.content_text_area = scrolledtext.ScrolledText(self.final_content_frame, wrap=tk.WORD, font=font_settings)
-        self.content_text_area.pack(fill='both', expand=True, padx=10, pady=5)
+        self.content_text_area = scrolledtext.ScrolledText(editor_pane, wrap=tk.WORD, font=font_settings)
+        self.content_text_area.bind("<<Modified>>", self.on_editor_modified)
+        # Proofreading suggestions are underlined, clicking one offers the correction
+        self.content_text_area.tag_configure("suggestion", underline=True, foreground="red")
+        self.content_text_area.tag_bind("suggestion", "<Button-1>", self.on_suggestion_clicked)
+        self.content_text_area.tag_configure("tool_output", background="#e8f0ff")
+        editor_pane.add(self.content_text_area, weight=4)
 
         # Action Buttons
         button_frame = ttk.Frame(self.final_content_frame)
         button_frame.pack(pady=5)
+        ttk.Button(button_frame, text="Save", command=self.save_as_markdown).pack(side=tk.LEFT, padx=5)
         ttk.Button(button_frame, text="Download as MD", command=self.download_as_md).pack(side=tk.LEFT, padx=5)
+        ttk.Button(button_frame, text="Export PDF", command=lambda: self.export_book(["pdf"])).pack(side=tk.LEFT, padx=5)
+        ttk.Button(button_frame, text="Export EPUB", command=lambda: self.export_book(["epub"])).pack(side=tk.LEFT, padx=5)
+        self.autosave_label = ttk.Label(button_frame, text="", foreground="gray")
+        self.autosave_label.pack(side=tk.LEFT, padx=5)
+
+    def create_library_tab(self):
+        ttk.Label(self.library_frame, text="Search the books generated so far:").pack(anchor=tk.W, padx=10, pady=5)
+
+        search_frame = ttk.Frame(self.library_frame)
+        search_frame.pack(fill='x', padx=10, pady=5)
+        self.library_query = tk.StringVar()
+        self.library_query.trace_add("write", lambda *args: self.schedule_library_search())
+        search_entry = ttk.Entry(search_frame, textvariable=self.library_query, width=60)
+        search_entry.pack(side=tk.LEFT, fill='x', expand=True)
+        search_entry.bind("<Return>", lambda event: self.search_library())
+        ttk.Button(search_frame, text="Search", command=self.search_library).pack(side=tk.LEFT, padx=5)
+        ttk.Button(search_frame, text="Refresh", command=self.refresh_library).pack(side=tk.LEFT, padx=5)
+
+        # Books when the search is empty, matching chapters otherwise
+        results_frame = ttk.Frame(self.library_frame)
+        results_frame.pack(fill='both', expand=True, padx=10, pady=5)
+        self.library_tree = ttk.Treeview(results_frame, columns=("book", "chapter", "match"), show="headings")
+        for column, heading, width in (("book", "Book", 220), ("chapter", "Chapter", 220), ("match", "Match", 480)):
+            self.library_tree.heading(column, text=heading)
+            self.library_tree.column(column, width=width, anchor=tk.W)
+        library_scrollbar = ttk.Scrollbar(results_frame, orient=tk.VERTICAL, command=self.library_tree.yview)
+        self.library_tree.config(yscrollcommand=library_scrollbar.set)
+        self.library_tree.pack(side=tk.LEFT, fill='both', expand=True)
+        library_scrollbar.pack(side=tk.LEFT, fill='y')
+        self.library_tree.bind("<Double-1>", lambda event: self.open_selected_book())
+
+        button_frame = ttk.Frame(self.library_frame)
+        button_frame.pack(pady=5)
+        ttk.Button(button_frame, text="Open", command=self.open_selected_book).pack(side=tk.LEFT, padx=5)
+        self.library_label = ttk.Label(button_frame, text="", foreground="gray")
+        self.library_label.pack(side=tk.LEFT, padx=5)
 
     def add_toolbar_button(self, parent, text, command):
         ttk.Button(parent, text=text, command=command).pack(side=tk.LEFT, padx=2)
@@ -203,190 +351,755 @@ class EBookGeneratorApp:
             self.content_text_area.insert(cursor_pos, f"{prefix}{suffix}")
 
     def start_generation(self):
+        if self.is_generating():
+            messagebox.showinfo("Info", "Generation is already running.")
+            return
+
         topic = self.topic_entry.get().strip()
         if len(topic) < 5:
             messagebox.showerror("Error", "Topic must be at least 5 characters long.")
             return
 
-        self.book_folder = sanitize_filename(topic.replace(" ", "_"))
-        if not os.path.exists(self.book_folder):
-            os.makedirs(self.book_folder)
+        self.engine = self.create_engine(topic)
+        self.book_folder = self.engine.book_folder
+        self.engine.prepare_book_folder()
 
         # Clear TOC and content areas
         self.toc_text_area.delete('1.0', tk.END)
-        self.content_text_area.delete('1.0', tk.END)
+        self.clear_document()
 
         # Start the timer
         self.start_timer()
 
-        # Initialize agents
-        self.initialize_agents()
-        if not self.researcher:
-            return
-
         # Update status
         self.update_status("Generating TOC", 0)
 
-        # Research Information
-        research_task = f"{topic}"
-        research_data = self.researcher.execute_task(research_task)
-        if not research_data:
-            messagebox.showerror("Error", "Failed to fetch research data from Tavily API.")
-            return
+        # Research and TOC generation run in the background worker
+        self.apply_cache_settings()
+        if self.speculate_chapters.get():
+            self.run_in_background(
+                self.research_and_speculate, self.generate_images.get(), self.get_max_concurrent_chapters(),
+                self.get_speculative_spend_limit()
+            )
+        else:
+            self.run_in_background(self.engine.research_and_toc)
 
-        # Generate and review TOC
-        self.toc = self.generate_toc(topic, research_data)
-        if not self.toc or all(not line.strip() for line in self.toc):
-            messagebox.showerror("Error", "Failed to generate Table of Contents. Please try again or check your API keys.")
-            return
-        self.toc_text_area.insert(tk.END, "\n".join(self.toc))
-        self.update_status("Ready", 0)  # Update status to Ready after TOC generation
-        self.notebook.select(self.toc_review_frame)
-
-    def initialize_agents(self):
-        # Initialize agents
-        self.researcher = ResearcherAgent(self.tavily_api_key)
-        if not self.researcher:
-            messagebox.showerror("Error", "Failed to initialize ResearcherAgent.")
-            return
-        self.content_organizer = ContentOrganizerAgent()
-        self.writer = WriterAgent()
-        self.designer = DesignerAgent()
-
-    def generate_toc(self, topic, research_data):
-        toc_response = self.content_organizer.execute_task({
-            "query": topic,
-            "answer": research_data.get("answer", ""),
-            "results": research_data.get("results", [])
-        })
-        toc = toc_response.strip().split('\n')
-        return toc
+    def research_and_speculate(self, include_images, max_in_flight, spend_limit):
+        # Runs on the background worker: the proposed chapters are written while the TOC is reviewed
+        toc = self.engine.research_and_toc()
+        self.engine.speculate_chapters(toc, include_images, max_in_flight, spend_limit)
+
+    def get_speculative_spend_limit(self):
+        try:
+            return max(0.0, float(self.speculative_spend_limit.get()))
+        except (tk.TclError, ValueError):
+            return speculative_spend_limit
+
+    def create_engine(self, topic, output_root="."):
+        # The engine reports back through post_event, so it never touches Tk from its threads
+        return BookGenerator(topic, self.tavily_api_key, self.response_cache, self.post_event, self.cancel_event, output_root=output_root)
+
+    def apply_cache_settings(self):
+        self.response_cache.bypass = {stage for stage, use in self.use_cache.items() if not use.get()}
 
     def continue_after_toc_review(self):
+        speculating = self.engine is not None and self.engine.speculating
+        if self.is_generating() and not speculating:
+            messagebox.showinfo("Info", "Generation is already running.")
+            return
+        if not self.engine:
+            messagebox.showerror("Error", "Please start a generation first.")
+            return
+
         toc_content = self.toc_text_area.get("1.0", tk.END).strip()
         self.toc = toc_content.split('\n')
         self.notebook.select(self.final_content_frame)
 
+        # Read widget state here, the worker thread must not touch Tk
+        include_images = self.generate_images.get()
+        max_in_flight = self.get_max_concurrent_chapters()
+        stream = self.stream_chapters.get()
+
+        if not self.timer_running:
+            self.start_timer()
+
         # Update status
         self.update_status("Generating Content", 15)  # TOC generation complete
 
-        self.fast_generation()
-        if self.generate_images.get():
-            self.update_status("Generating Images", 75)
-            self.designer.execute_task(self.book_folder, self.topic_entry.get().strip(), self.toc, self.chapters)
-            messagebox.showinfo("Info", "Cover page and chapter images generated.")
-        
-        # Update status
-        self.update_status("Finalizing Content", 90)
+        self.apply_cache_settings()
+        if speculating:
+            # Chapters of edited lines are dropped, the rest finish and are reused by the generation
+            self.engine.stop_speculation(list(self.toc))
+            self.update_status("Finishing chapters written during the review", 15)
+            self.pending_stage = (self.engine.generate_content, list(self.toc), include_images, max_in_flight, stream)
+            return
+        self.run_in_background(self.engine.generate_content, list(self.toc), include_images, max_in_flight, stream)
+
+    def resume_generation(self):
+        if self.is_generating():
+            messagebox.showinfo("Info", "Generation is already running.")
+            return
 
-        final_md_content = self.merge_chapters_into_single_content(self.topic_entry.get().strip())
-        self.content_text_area.insert(tk.END, final_md_content)
+        topic = self.topic_entry.get().strip()
+        if len(topic) < 5:
+            messagebox.showerror("Error", "Topic must be at least 5 characters long.")
+            return
+
+        engine = self.create_engine(topic)
+        manifest = RunManifest.load(engine.book_folder)
+        if not manifest or not manifest.toc:
+            messagebox.showerror("Error", f"No saved run found in {engine.book_folder}.")
+            return
+
+        self.engine = engine
+        self.engine.manifest = manifest
+        self.book_folder = engine.book_folder
+        self.toc = manifest.toc
+        self.toc_text_area.delete('1.0', tk.END)
+        self.toc_text_area.insert(tk.END, "\n".join(self.toc))
+        if manifest.data["status"] == "toc_review":
+            # Nothing was generated yet, go back to the TOC review
+            self.notebook.select(self.toc_review_frame)
+            return
+
+        # Finished chapters and images are reloaded from disk, only missing or stale ones are regenerated
+        self.generate_images.set(manifest.include_images)
+        self.clear_document()
         self.notebook.select(self.final_content_frame)
+        self.start_timer()
+        self.update_status("Resuming", 15)
+        self.apply_cache_settings()
+        self.run_in_background(
+            self.engine.generate_content, self.toc, manifest.include_images,
+            self.get_max_concurrent_chapters(), self.stream_chapters.get(), True
+        )
 
-        # Save the merged content as a markdown file
-        self.save_as_markdown()
+    def get_max_concurrent_chapters(self):
+        try:
+            return max(1, int(self.max_concurrent_chapters.get()))
+        except (tk.TclError, ValueError):
+            return default_max_concurrent_chapters
+
+    # Chapter navigator, the editor holds one segment of the document at a time
+
+    def load_document(self, document, index=0):
+        self.document = document
+        self.active_segment = None
+        self.chapter_list.delete(0, tk.END)
+        for label in document.labels():
+            self.chapter_list.insert(tk.END, label)
+        self.show_segment(index)
+
+    def clear_document(self):
+        self.document = None
+        self.active_segment = None
+        self.chapter_list.delete(0, tk.END)
+        self.set_editor_text("")
+
+    def set_editor_text(self, text):
+        self.content_text_area.delete('1.0', tk.END)
+        self.content_text_area.insert('1.0', text)
+        self.content_text_area.edit_modified(False)
+
+    def show_segment(self, index):
+        self.sync_editor()
+        self.active_segment = index
+        self.set_editor_text(self.document.text(index))
+        self.chapter_list.selection_clear(0, tk.END)
+        self.chapter_list.selection_set(index)
+        self.chapter_list.see(index)
+        self.highlight_suggestions()
+
+    def on_chapter_selected(self, event):
+        selection = self.chapter_list.curselection()
+        if self.tool_segment is not None and selection and selection[0] != self.active_segment:
+            # The selection tool writes into the editor, it keeps its chapter until it is done
+            self.chapter_list.selection_clear(0, tk.END)
+            self.chapter_list.selection_set(self.active_segment)
+            self.tools_label.config(text="Wait until the selection tool has finished.", foreground="gray")
+            return
+        if self.document and selection and selection[0] != self.active_segment:
+            self.show_segment(selection[0])
+
+    def on_editor_modified(self, event):
+        # Tk reports changes of the modified flag, the text itself is only read back by sync_editor
+        if self.document and self.active_segment is not None and self.content_text_area.edit_modified():
+            self.document.mark_dirty(self.active_segment)
+            self.refresh_chapter_list()
+            self.schedule_autosave()
+
+    def sync_editor(self):
+        # Copy the edited segment back into the document
+        if self.document and self.active_segment is not None and self.content_text_area.edit_modified():
+            self.document.set_text(self.active_segment, self.content_text_area.get('1.0', 'end-1c'))
+            self.content_text_area.edit_modified(False)
+
+    def refresh_chapter_list(self):
+        for index, label in enumerate(self.document.labels()):
+            if self.chapter_list.get(index) != label:
+                self.chapter_list.delete(index)
+                self.chapter_list.insert(index, label)
+        if self.active_segment is not None:
+            self.chapter_list.selection_set(self.active_segment)
+
+    def append_chapter_text(self, index, text):
+        # Streamed text goes to the document, and to the editor when that chapter is shown
+        segment = self.document.chapter_segment(index)
+        self.document.append_text(segment, text)
+        if segment == self.active_segment:
+            modified = self.content_text_area.edit_modified()
+            self.content_text_area.insert('end-1c', text)
+            self.content_text_area.edit_modified(modified)
+
+    def load_finished_chapter(self, index, chapter_content):
+        segment = self.document.chapter_segment(index)
+        self.document.load_chapter(index, chapter_content)
+        # A chapter that was not streamed appears in the editor when it is shown and still empty
+        if segment == self.active_segment and not self.content_text_area.edit_modified() \
+                and self.content_text_area.compare('end-1c', '==', '1.0'):
+            self.set_editor_text(self.document.text(segment))
+
+    # AI tools: requests run on the tools threads, their results come back as events
+
+    def proofread_document(self):
+        if not self.document:
+            messagebox.showerror("Error", "Generate or open a book before proofreading it.")
+            return
+        if self.proofreading:
+            messagebox.showinfo("Info", "Proofreading is already running.")
+            return
+        if self.is_generating():
+            messagebox.showinfo("Info", "Wait until the current task has finished.")
+            return
+        self.sync_editor()
+        paragraphs = self.book_paragraphs()
+        dirty = self.proofreader.dirty(paragraphs)
+        if not dirty:
+            self.proofread_finished(0, 0)
+            return
+        self.proofreading = True
+        self.tools_label.config(text=f"Proofreading {len(dirty)} of {len(paragraphs)} paragraphs", foreground="gray")
+
+        def proofread():
+            try:
+                sent = self.proofreader.check(dirty, on_progress=lambda done, total: self.post_event("proofread_progress", done, total))
+                self.post_event("proofread_ready", len(dirty), sent)
+            except Exception as e:
+                self.post_event("proofread_failed", str(e))
+        self.tools_executor.submit(proofread)
+
+    def book_paragraphs(self):
+        paragraphs = []
+        for index in range(self.document.chapter_count):
+            paragraphs.extend(paragraph["text"] for paragraph in text_paragraphs(self.document.text(self.document.chapter_segment(index))))
+        return paragraphs
+
+    def proofread_finished(self, checked, sent):
+        self.proofreading = False
+        self.update_cost()
+        if not self.document:
+            return
+        self.sync_editor()
+        suggestions = 0
+        chapters = 0
+        for index in range(self.document.chapter_count):
+            text = self.document.text(self.document.chapter_segment(index))
+            count = sum(len(self.proofreader.suggestions(paragraph["text"])) for paragraph in text_paragraphs(text))
+            suggestions += count
+            chapters += 1 if count else 0
+        self.tools_label.config(
+            text=f"{checked} changed paragraphs checked ({sent} sent), {suggestions} suggestions in {chapters} chapters",
+            foreground="gray",
+        )
+        self.highlight_suggestions()
+
+    def highlight_suggestions(self):
+        # Underlines the known suggestions of the segment in the editor, the text itself is not changed
+        for tag in self.suggestion_tags:
+            self.content_text_area.tag_delete(tag)
+        self.suggestion_tags = {}
+        self.content_text_area.tag_remove("suggestion", "1.0", tk.END)
+        for paragraph in text_paragraphs(self.content_text_area.get("1.0", "end-1c")):
+            for suggestion in self.proofreader.suggestions(paragraph["text"]):
+                offset = paragraph["text"].find(suggestion["original"])
+                if offset < 0:
+                    continue
+                start = f"{paragraph['line']}.0 + {offset} chars"
+                end = f"{start} + {len(suggestion['original'])} chars"
+                tag = f"suggestion_{len(self.suggestion_tags)}"
+                self.content_text_area.tag_add(tag, start, end)
+                self.content_text_area.tag_add("suggestion", start, end)
+                self.suggestion_tags[tag] = (paragraph["text"], suggestion)
+
+    def on_suggestion_clicked(self, event):
+        index = self.content_text_area.index(f"@{event.x},{event.y}")
+        tags = [tag for tag in self.content_text_area.tag_names(index) if tag in self.suggestion_tags]
+        if not tags:
+            return
+        tag = tags[0]
+        paragraph, suggestion = self.suggestion_tags[tag]
+        menu = tk.Menu(self.root, tearoff=0)
+        menu.add_command(label=f"Replace with: {suggestion['replacement']}", command=lambda: self.apply_suggestion(tag))
+        menu.add_command(label="Ignore", command=lambda: self.ignore_suggestion(tag))
+        if suggestion["reason"]:
+            menu.add_separator()
+            menu.add_command(label=suggestion["reason"], state=tk.DISABLED)
+        menu.tk_popup(event.x_root, event.y_root)
+
+    def apply_suggestion(self, tag):
+        paragraph, suggestion = self.suggestion_tags.pop(tag)
+        ranges = self.content_text_area.tag_ranges(tag)
+        self.content_text_area.tag_delete(tag)
+        # Text edited since the check is left alone
+        if len(ranges) != 2 or self.content_text_area.get(*ranges) != suggestion["original"]:
+            self.tools_label.config(text="The text changed since it was proofread.", foreground="gray")
+            return
+        self.content_text_area.delete(*ranges)
+        self.content_text_area.insert(ranges[0], suggestion["replacement"])
+        self.proofreader.apply(paragraph, suggestion)
+
+    def ignore_suggestion(self, tag):
+        paragraph, suggestion = self.suggestion_tags.pop(tag)
+        ranges = self.content_text_area.tag_ranges(tag)
+        self.content_text_area.tag_delete(tag)
+        if len(ranges) == 2:
+            self.content_text_area.tag_remove("suggestion", *ranges)
+        self.proofreader.ignore(paragraph, suggestion)
+
+    def run_selection_tool(self, tool):
+        if not self.document or self.active_segment is None:
+            messagebox.showerror("Error", "Generate or open a book first.")
+            return
+        if self.tool_segment is not None:
+            messagebox.showinfo("Info", "The selection tool is still writing.")
+            return
+        if self.is_generating():
+            messagebox.showinfo("Info", "Wait until the current task has finished.")
+            return
+        try:
+            start = self.content_text_area.index(tk.SEL_FIRST)
+            end = self.content_text_area.index(tk.SEL_LAST)
+        except tk.TclError:
+            messagebox.showinfo("Info", "Select the text the tool should work on first.")
+            return
+        selected_text = self.content_text_area.get(start, end)
+        if not selected_text.strip():
+            return
 
-        # Update progress to 100%
-        self.update_status("Complete", 100)
+        # The answer replaces the text between the marks once it starts arriving
+        self.content_text_area.mark_set("tool_start", start)
+        self.content_text_area.mark_gravity("tool_start", tk.LEFT)
+        self.content_text_area.mark_set("tool_end", end)
+        self.content_text_area.mark_gravity("tool_end", tk.RIGHT)
+        self.tool_segment = self.active_segment
+        self.tool_original = selected_text
+        self.tool_started = False
+        self.tools_label.config(text=f"{tool.capitalize()}: waiting for the answer", foreground="gray")
+
+        segment = self.document.segments[self.active_segment]
+        chapter_title = segment["title"] if segment["file"] else ""
+        messages = selection_tool_messages(tool, selected_text, self.document.topic, chapter_title)
+        max_tokens = count_tokens(selected_text) * (3 if tool == "expand" else 2) + 200
+        # Every press gets a new answer, so the tools skip the cache. Their tokens and cost go to the
+        # book's token report and telemetry.
+        writer = WriterAgent(
+            self.response_cache,
+            ledger=self.engine.token_ledger if self.engine else None,
+            telemetry=self.engine.telemetry if self.engine else None,
+        )
 
-        # Stop the timer
-        self.stop_timer()
+        def stream():
+            try:
+                for piece in writer.stream_task(messages, max_tokens=max_tokens, report_stage="editor", cache_stage=None):
+                    self.post_event("tool_text", piece)
+                self.post_event("tool_done")
+            except Exception as e:
+                self.post_event("tool_failed", str(e))
+        self.tools_executor.submit(stream)
+
+    def insert_tool_text(self, text):
+        if self.tool_segment is None:
+            return
+        if not self.tool_started:
+            # The selection is replaced when the first text arrives
+            text = text.lstrip()
+            if not text:
+                return
+            self.content_text_area.delete("tool_start", "tool_end")
+            self.tool_started = True
+        self.content_text_area.insert("tool_end", text, ("tool_output",))
+        self.content_text_area.see("tool_end")
+
+    def finish_selection_tool(self, error=None):
+        if self.tool_segment is None:
+            return
+        if error or not self.tool_started:
+            # The original text comes back
+            if self.tool_started:
+                self.content_text_area.delete("tool_start", "tool_end")
+                self.content_text_area.insert("tool_start", self.tool_original)
+            self.tools_label.config(text=f"The selection tool failed: {error or 'no answer'}", foreground="red")
+        else:
+            # Whitespace around the selection is kept as it was
+            answer = self.content_text_area.get("tool_start", "tool_end").strip()
+            leading = self.tool_original[:len(self.tool_original) - len(self.tool_original.lstrip())]
+            trailing = self.tool_original[len(self.tool_original.rstrip()):]
+            self.content_text_area.delete("tool_start", "tool_end")
+            self.content_text_area.insert("tool_start", f"{leading}{answer}{trailing}")
+            self.tools_label.config(text="Done, the selection was replaced.", foreground="gray")
+        self.content_text_area.tag_remove("tool_output", "1.0", tk.END)
+        self.tool_segment = None
+        self.tool_original = ""
+        self.tool_started = False
+
+    # Autosave: the edited text is collected here on the Tk thread and written by the autosave service's thread
+
+    def schedule_autosave(self):
+        # Typing keeps the modified flag set, so edits are saved at most once per delay
+        if self.autosave_job is None:
+            self.autosave_job = self.root.after(autosave_delay_ms, self.autosave)
+
+    def autosave(self):
+        self.autosave_job = None
+        if not self.document:
+            return
+        if self.is_generating():
+            # Chapter files still belong to the generator
+            self.schedule_autosave()
+            return
+        self.sync_editor()
+        if self.document.is_dirty():
+            self.autosaver.submit(self.document.take_changes(), self.engine.manifest if self.engine else None)
+            self.refresh_chapter_list()
+
+    def flush_autosave(self):
+        # Hands the unsaved edits to the autosave service now instead of after the delay
+        if self.autosave_job is not None:
+            self.root.after_cancel(self.autosave_job)
+            self.autosave_job = None
+        if self.document and not self.is_generating():
+            self.sync_editor()
+            if self.document.is_dirty():
+                self.autosaver.submit(self.document.take_changes(), self.engine.manifest if self.engine else None)
+
+    def on_close(self):
+        self.flush_autosave()
+        self.autosaver.close()
+        self.tools_executor.shutdown(wait=False, cancel_futures=True)
+        self.proofreader.close()
+        self.library_executor.shutdown(wait=True)
+        self.library.close()
+        self.root.destroy()
+
+    # Library: the index is refreshed on the library thread, searches are quick enough for the Tk thread
+
+    def refresh_library(self, book_folder=None):
+        # Only book_folder is checked when given, otherwise every book folder
+        def refresh():
+            try:
+                changed = self.library.update_book(book_folder) if book_folder else self.library.refresh(library_root)
+                self.post_event("library_refreshed", changed)
+            except Exception as e:
+                print(f"Failed to refresh the library: {e}")
+        self.library_executor.submit(refresh)
+
+    def schedule_library_search(self):
+        if self.library_search_job is not None:
+            self.root.after_cancel(self.library_search_job)
+        self.library_search_job = self.root.after(library_search_delay_ms, self.search_library)
+
+    def search_library(self):
+        if self.library_search_job is not None:
+            self.root.after_cancel(self.library_search_job)
+            self.library_search_job = None
+        query = self.library_query.get().strip()
+        start_time = time.time()
+        self.library_tree.delete(*self.library_tree.get_children())
+        if query:
+            self.library_results = self.library.search(query)
+            rows = [(result["topic"], result["chapter"] or "(title and contents)", result["snippet"]) for result in self.library_results]
+        else:
+            self.library_results = self.library.books()
+            rows = [
+                (book["topic"], f"{book['chapters']} chapters, {book['status']}",
+                 f"Updated {time.strftime('%Y-%m-%d %H:%M', time.localtime(book['updated']))}, cost ${book['cost']:.2f}")
+                for book in self.library_results
+            ]
+        for index, row in enumerate(rows):
+            self.library_tree.insert("", tk.END, iid=str(index), values=row)
+        self.library_label.config(text=f"{len(rows)} results in {(time.time() - start_time) * 1000:.0f} ms")
+
+    def open_selected_book(self):
+        selection = self.library_tree.selection()
+        if selection:
+            result = self.library_results[int(selection[0])]
+            self.open_library_book(result["folder"], result.get("chapter"))
+
+    def open_library_book(self, book_folder, matched_chapter=None):
+        # The TOC and chapter texts come from the index, only the manifest is read from the book folder
+        if self.is_generating():
+            messagebox.showinfo("Info", "Wait until the current task has finished.")
+            return
+        book = self.library.load_book(book_folder)
+        if not book:
+            messagebox.showerror("Error", f"{book_folder} is not in the library, refresh it and try again.")
+            return
+        self.flush_autosave()
+
+        self.engine = self.create_engine(book["topic"], os.path.dirname(book["folder"]))
+        self.engine.manifest = RunManifest.load(book["folder"])
+        self.book_folder = book["folder"]
+        self.toc = book["toc"]
+        self.topic_entry.delete(0, tk.END)
+        self.topic_entry.insert(0, book["topic"])
+        self.generate_images.set(book["include_images"])
+        self.toc_text_area.delete('1.0', tk.END)
+        self.toc_text_area.insert(tk.END, "\n".join(self.toc))
 
-    def fast_generation(self):
-        num_chapters = len(self.toc)
-        if self.generate_images.get():
-            total_files = num_chapters * 2 + 2  # Chapters + Images + Merged + Cover
+        chapter_titles = toc_chapter_titles(self.toc)
+        document = BookDocument(self.book_folder, book["topic"], chapter_titles)
+        self.chapters = []
+        for index, chapter_title in enumerate(chapter_titles):
+            if chapter_title in book["chapters"]:
+                document.load_chapter(index, book["chapters"][chapter_title])
+                self.chapters.append({"title": chapter_title, "content": book["chapters"][chapter_title]})
+        self.chapter_summaries = []
+        # A search result opens at the chapter that matched
+        if matched_chapter in chapter_titles:
+            self.load_document(document, document.chapter_segment(chapter_titles.index(matched_chapter)))
         else:
-            total_files = num_chapters + 1  # Chapters + Merged
-
-        progress_increment = 85 / total_files
-        current_progress = 15  # Start from 15% after TOC generation
-
-        for chapter_title in self.toc:
-            if "SECTION" in chapter_title.upper():
-                continue  # Skip sections
-            safe_chapter_title = sanitize_filename(chapter_title)
-            chapter_content, chapter_summary = self.generate_chapter(chapter_title)
-            chapter_file = os.path.join(self.book_folder, f"{safe_chapter_title}.md")
-            if not os.path.exists(os.path.dirname(chapter_file)):
-                os.makedirs(os.path.dirname(chapter_file))
-            with open(chapter_file, "w") as file:
-                file.write(chapter_content)
-            self.chapter_summaries.append(chapter_summary)
-            self.chapters.append({"title": chapter_title, "content": chapter_content})
-            self.root.update()
-
-            # Update progress for each chapter
-            current_progress += progress_increment
-            self.update_status("Generating Content", current_progress)
-
-            if self.generate_images.get():
-                # Update progress for each image
-                current_progress += progress_increment
-                self.update_status("Generating Images", current_progress)
-
-    def generate_chapter(self, chapter_title):
-        # Replace [Book Name] and [Chapter Title] with actual book and chapter name during the generation
-        task = f"Write a detailed content for {self.topic_entry.get().strip()} book with chapter called {chapter_title}. Use simple and understandable English. Follow the research data and do not create imaginary content. Use your creative freedom, it is suggested but not important to divide it into structured segments similar to an academic book, including any relevant examples, facts, quotes, and notable people or brands only if applicable. Conduct research on the web to gather accurate information and provide references for any key points made. Each chapter should be around 750 to 1000 words. Use your creative freedom, it is suggested but not important that each segments might include the following elements, all or a few or even none: Start with an engaging introduction that provides a brief overview of the segment. Include practical examples to illustrate key points. Incorporate factual information and quotes from credible sources or notable figures. Mention notable people or brands related to the subject matter. Add a short exercise or interactive activity at the end to engage readers and reinforce learning. Provide references for all the key points made to ensure accuracy and credibility. End with a conclusion with a summary that recaps the main points discussed in the chapter. Make sure that you go through past and future topics from the table of contents so that there are no redundant content in this chapter. Do not add prefatory statements, your own status, notes, apologizes and inconvenience, like you don't have access to internet, feel free to adjust, I cannot provide direct reference from web, fact checking or follow ups like sure, here is a detailed structure for your book. Do not keep unended sentences. Do not generate any elements if you don't have enough information. Make the content print ready without any remarks or feedback from your side. Output should be a well formatted mark down for example H1 for Chapter title, H2, H3 and other headings for other segment titles."
-        chapter_content = self.writer.execute_task(task, {})
-        chapter_content = chapter_content.replace("```markdown", "").replace("```", "")
-        safe_chapter_title = sanitize_filename(chapter_title)
-        chapter_image_path = f"{safe_chapter_title}_image.png"
-        if self.generate_images.get():
-            # Use a relative path for the chapter image
-            chapter_image_markdown = f"![{chapter_title} Image]({chapter_image_path})\n\n"
-            chapter_content = chapter_image_markdown + chapter_content
-        summary_task = f"Summarize the following chapter content in 2-3 sentences:\n\n{chapter_content}"
-        chapter_summary = self.writer.execute_task(summary_task, {})
-        return chapter_content, chapter_summary
-
-    def merge_chapters_into_single_content(self, topic):
-        final_md_content = f"# {topic}\n\n"
-        final_md_content += "![Cover Page](cover_page.png)\n\n"
-        final_md_content += "### Author: OpenAI's GPT-4o\n"
-        final_md_content += "### Designer: DALL·E 3\n\n"
-        final_md_content += "## Table of Contents\n\n"
-        for chapter in self.chapters:
-            final_md_content += f"- {chapter['title']}\n"
-        final_md_content += "\n"
-        for chapter in self.chapters:
-            # Assume the chapter content already includes the chapter title and image
-            final_md_content += f"\n\n{chapter['content']}\n\n"
-        final_md_content += "Thank you for reading.\n"
-        return final_md_content
+            self.load_document(document, 1 if chapter_titles else 0)
+        self.update_status(f"Opened {book['topic']}", 0)
+        if book["status"] == "toc_review" or not book["chapters"]:
+            self.notebook.select(self.toc_review_frame)
+        else:
+            self.notebook.select(self.final_content_frame)
 
     def save_as_markdown(self):
-        # Use the sanitized book name for the markdown file
-        book_name = sanitize_filename(self.topic_entry.get().strip())
-        file_path = os.path.join(self.book_folder, f"{book_name}.md")
-        content = self.content_text_area.get("1.0", tk.END)
+        # Only edited chapters are written to their files, the merged book file is streamed from the document
+        if not self.document:
+            messagebox.showerror("Error", "There is no content to save yet.")
+            return
+        self.sync_editor()
         try:
-            with open(file_path, 'w', encoding='utf-8') as f:
-                f.write(content)
-            messagebox.showinfo("Success", f"File saved successfully at {file_path}")
+            future = self.autosaver.submit(self.document.take_changes(), self.engine.manifest if self.engine else None)
+            saved, file_path = future.result()
+            self.refresh_chapter_list()
+            message = f"File saved successfully at {file_path}"
+            if saved:
+                message += f"\n{saved} edited chapters saved to their own files."
+            messagebox.showinfo("Success", message)
         except Exception as e:
             messagebox.showerror("Error", f"Failed to save file: {e}")
 
+    def content_saved(self, future):
+        # Called on the autosave thread
+        try:
+            self.post_event("content_saved", *future.result())
+        except Exception as e:
+            self.post_event("content_save_failed", str(e))
+
     def download_as_md(self):
+        if not self.document:
+            messagebox.showerror("Error", "There is no content to download yet.")
+            return
         # Use the sanitized book name for the markdown file
         book_name = sanitize_filename(self.topic_entry.get().strip())
-        file_path = os.path.join(self.book_folder, f"{book_name}.md")
-        
-        # Check if file already exists and append a number if necessary
-        base_file_path = file_path
-        counter = 1
-        while os.path.exists(file_path):
-            file_path = os.path.join(self.book_folder, f"{book_name}_{counter:02}.md")
-            counter += 1
-
-        content = self.content_text_area.get("1.0", tk.END)
+        file_path = filedialog.asksaveasfilename(
+            initialdir=self.book_folder or ".",
+            initialfile=f"{book_name}.md",
+            defaultextension=".md",
+            filetypes=[("Markdown", "*.md"), ("All files", "*.*")],
+        )
+        if not file_path:
+            return
+
+        self.sync_editor()
         try:
-            with open(file_path, 'w', encoding='utf-8') as f:
-                f.write(content)
+            self.document.write_merged(file_path)
             messagebox.showinfo("Success", f"File downloaded successfully as {file_path}")
         except Exception as e:
             messagebox.showerror("Error", f"Failed to download file: {e}")
 
+    def export_book(self, formats):
+        if self.is_generating():
+            messagebox.showinfo("Info", "Wait until the current task has finished.")
+            return
+        if not self.document:
+            messagebox.showerror("Error", "Generate or resume a book before exporting it.")
+            return
+        # The document is exported, so edits made since the generation are included
+        self.sync_editor()
+        content = self.document.markdown()
+        output_name = sanitize_filename(self.topic_entry.get().strip())
+        self.update_status(f"Exporting {', '.join(formats).upper()}", 0)
+        self.run_in_background(self.run_export, content, formats, output_name)
+
+    def run_export(self, content, formats, output_name):
+        # Runs on the background worker, chapters are rendered in a process pool
+        def check_cancelled():
+            if self.cancel_event.is_set():
+                raise GenerationCancelled()
+
+        def on_progress(done, total):
+            self.post_event("status", f"Rendering chapters {done}/{total}", done * 100 / total)
+
+        exporter = BookExporter(self.book_folder)
+        paths = exporter.export(content, formats, output_name, check_cancelled, on_progress)
+        self.post_event("status", "Exported", 100)
+        self.post_event(
+            "info",
+            "Exported to:\n" + "\n".join(paths.values())
+            + f"\n\n{exporter.stats['rendered']} parts rendered, {exporter.stats['reused']} reused from the last export"
+        )
+
+    # Background worker and UI event queue
+
+    def is_generating(self):
+        return self.worker_thread is not None and self.worker_thread.is_alive()
+
+    def run_in_background(self, stage, *args):
+        self.cancel_event.clear()
+        self.cancel_button.config(state=tk.NORMAL)
+
+        def worker():
+            try:
+                stage(*args)
+            except GenerationCancelled:
+                self.post_event("cancelled")
+            except (GenerationError, ExportError) as e:
+                self.post_event("error", str(e))
+            except Exception as e:
+                print(f"Exception in background worker: {e}")
+                self.post_event("error", f"Generation failed: {e}")
+            finally:
+                self.post_event("worker_finished")
+
+        self.worker_thread = threading.Thread(target=worker, daemon=True)
+        self.worker_thread.start()
+
+    def post_event(self, kind, *payload):
+        # Safe to call from any thread, events are handled on the Tk main thread
+        self.events.put((kind, payload))
+
+    def cancel_generation(self):
+        if self.is_generating():
+            self.cancel_event.set()
+            self.cancel_button.config(state=tk.DISABLED)
+            self.update_status("Cancelling", self.progress_var.get())
+
+    def poll_events(self):
+        try:
+            while True:
+                kind, payload = self.events.get_nowait()
+                self.handle_event(kind, payload)
+        except queue.Empty:
+            pass
+        self.root.after(event_poll_interval_ms, self.poll_events)
+
+    def handle_event(self, kind, payload):
+        if kind == "status":
+            self.update_status(*payload)
+            self.update_cost()
+        elif kind == "toc_ready":
+            self.toc = payload[0]
+            self.toc_text_area.insert(tk.END, "\n".join(self.toc))
+            self.update_status("Ready", 0)  # Update status to Ready after TOC generation
+            self.notebook.select(self.toc_review_frame)
+        elif kind == "chapters_started":
+            topic, chapter_titles = payload
+            # Show the first chapter, so streamed text is visible as it arrives
+            self.load_document(BookDocument(self.book_folder, topic, chapter_titles), 1 if chapter_titles else 0)
+        elif kind == "chapter_text":
+            index, text = payload
+            self.append_chapter_text(index, text)
+        elif kind == "chapter_ready":
+            index, chapter_title, chapter_content = payload
+            self.load_finished_chapter(index, chapter_content)
+            print(f"Chapter ready: {chapter_title}")
+        elif kind == "content_ready":
+            final_md_content, streamed = payload
+            self.chapters = self.engine.chapters
+            self.chapter_summaries = self.engine.chapter_summaries
+            for index, chapter in enumerate(self.chapters):
+                self.load_finished_chapter(index, chapter["content"])
+            self.notebook.select(self.final_content_frame)
+
+            # Save the merged content as a markdown file on the autosave thread, the status bar
+            # reports when it is written
+            self.sync_editor()
+            future = self.autosaver.submit(self.document.take_changes(), self.engine.manifest)
+            future.add_done_callback(self.content_saved)
+
+            # Update progress to 100%
+            self.update_status("Complete, saving", 100)
+
+            # Stop the timer
+            self.stop_timer()
+        elif kind == "content_saved":
+            saved, file_path = payload
+            self.refresh_chapter_list()
+            self.update_status(f"Complete, saved to {file_path}", 100)
+        elif kind == "content_save_failed":
+            # autosave_failed shows the error, the changes are retried with the next save
+            self.update_status("Complete, saving failed", 100)
+        elif kind == "info":
+            messagebox.showinfo("Info", payload[0])
+        elif kind == "autosaved":
+            saved, merged_path = payload
+            self.autosave_label.config(text=f"Autosaved at {time.strftime('%H:%M:%S')}", foreground="gray")
+            if saved:
+                self.refresh_library(os.path.dirname(merged_path))
+        elif kind == "library_refreshed":
+            self.search_library()
+        elif kind == "proofread_progress":
+            done, total = payload
+            self.tools_label.config(text=f"Proofreading: {done} of {total} requests done", foreground="gray")
+        elif kind == "proofread_ready":
+            self.proofread_finished(*payload)
+        elif kind == "proofread_failed":
+            self.proofreading = False
+            self.tools_label.config(text=f"Proofreading failed: {payload[0]}", foreground="red")
+        elif kind == "tool_text":
+            self.insert_tool_text(payload[0])
+        elif kind == "tool_done":
+            self.finish_selection_tool()
+            self.update_cost()
+            self.update_telemetry()
+        elif kind == "tool_failed":
+            self.finish_selection_tool(payload[0])
+            self.update_cost()
+        elif kind == "autosave_failed":
+            # The changes are retried with the next save
+            self.autosave_label.config(text=f"Autosave failed: {payload[0]}", foreground="red")
+        elif kind == "error":
+            self.pending_stage = None
+            self.stop_timer()
+            self.update_status("Failed", self.progress_var.get())
+            messagebox.showerror("Error", payload[0])
+        elif kind == "cancelled":
+            self.pending_stage = None
+            self.stop_timer()
+            self.update_status("Cancelled", self.progress_var.get())
+        elif kind == "worker_finished":
+            self.cancel_button.config(state=tk.DISABLED)
+            self.update_cost()
+            self.update_telemetry()
+            # The finished task may have written chapters or changed the manifest
+            if self.book_folder:
+                self.refresh_library(self.book_folder)
+            if self.pending_stage:
+                stage, self.pending_stage = self.pending_stage, None
+                self.update_status("Generating Content", 15)
+                self.run_in_background(*stage)
+
+    def update_cost(self):
+        stats = self.response_cache.stats()
+        self.total_cost = stats["spent_cost"]
+        self.cost_label.config(
+            text=f"Cost: ${self.total_cost:.2f} (cache {stats['total_hits']} hits / {stats['total_misses']} misses, saved ${stats['saved_cost']:.2f})"
+        )
+
     def update_status(self, message, progress):
         self.status_label.config(text=f"Status: {message}")
         self.progress_var.set(progress)
@@ -402,194 +1115,16 @@ class EBookGeneratorApp:
             elapsed_time = int(time.time() - self.start_time)
             minutes, seconds = divmod(elapsed_time, 60)
             self.timer_label.config(text=f"Time: {minutes:02}:{seconds:02}")
+            self.update_telemetry()
             self.root.after(1000, self.update_timer)
 
+    def update_telemetry(self):
+        if self.engine:
+            self.telemetry_label.config(text=self.engine.telemetry.status_line())
+
     def stop_timer(self):
         self.timer_running = False
 
-# Custom Agent Classes
-
-class ResearcherAgent:
-    def __init__(self, tavily_api_key):
-        self.tavily_api_key = tavily_api_key
-        self.name = "Researcher"
-        self.role = "Gather information"
-        self.goal = "Collect and synthesize comprehensive and reliable data relevant to the ebook's topic"
-        self.backstory = "Expert in data gathering and internet research, with a keen eye for detail"
-        self.verbose = True
-        self.llm = "gpt-4o"
-        self.allow_delegation = True
-        self.tools = ["advanced_llm", "web_access", "tavily_api"]
-
-    def execute_task(self, task):
-        print(f"\n{self.name} is executing the task: {task}\n")
-        try:
-            tavily_response = requests.post(
-                tavily_api_url,
-                headers={"Content-Type": "application/json"},
-                json={"query": task, "api_key": self.tavily_api_key}
-            )
-            if tavily_response.status_code == 200:
-                tavily_data = tavily_response.json()
-                research_data = self.validate_data(tavily_data)
-                if not research_data.get("answer"):
-                    research_data['answer'] = self.generate_answer_from_results(research_data.get("results", []), task)
-                print(research_data)
-                return research_data
-            else:
-                print(f"Error fetching data from Tavily API: {tavily_response.status_code} - {tavily_response.text}")
-                return None
-        except requests.exceptions.RequestException as e:
-            print(f"Exception during Tavily API call: {e}")
-            return None
-
-    def validate_data(self, tavily_data):
-        validated_data = {
-            "answer": tavily_data.get("answer", ""),
-            "query": tavily_data.get("query", ""),
-            "images": tavily_data.get("images", []),
-            "results": tavily_data.get("results", []),
-            "response_time": tavily_data.get("response_time", ""),
-            "follow_up_questions": tavily_data.get("follow_up_questions", [])
-        }
-        return validated_data
-
-    def generate_answer_from_results(self, results, query):
-        if not results:
-            return ""
-        search_snippets = "\n".join([result.get('snippet', '') for result in results if result.get('snippet')])
-        messages = [
-            {"role": "system", "content": "You are an assistant that summarizes search results into a coherent answer."},
-            {"role": "user", "content": f"Based on the following search results, provide a comprehensive answer to the query '{query}':\n\n{search_snippets}"},
-        ]
-        response = openai.ChatCompletion.create(
-            model="gpt-4o",
-            messages=messages,
-            max_tokens=500,
-            temperature=0.7,
-        )
-        answer = response['choices'][0]['message']['content'].strip()
-        return answer
-
-class ContentOrganizerAgent:
-    def __init__(self):
-        pass
-
-    def execute_task(self, data):
-        if not data['answer'] and not data['results']:
-            return "Unable to generate Table of Contents due to lack of research data."
-        messages = [
-            {"role": "system", "content": "You are an assistant that helps generate a table of contents for an e-book."},
-            {"role": "user", "content": f"Based on the following research data, generate a detailed table of contents for an e-book on '{data['query']}':\n\n{data['answer']}\n\nTable of contents should only have chapters, but no sub chapters or sections. Table of content should be systematic, should have high level topics and gradually increase the depth on the topic rather than a random list. Chapters should have CHAPTER 01 - Chapter name, CHAPTER 02 - Chapter name and so on as prefix. Do not include the text Table of contents as a chapter. Do not generate prefatory or introductory statements. Just show the output."},
-        ]
-        response = openai.ChatCompletion.create(
-            model="gpt-4o",
-            messages=messages,
-            max_tokens=500,
-            temperature=0.7,
-        )
-        toc = response['choices'][0]['message']['content'].strip()
-        return toc
-
-class WriterAgent:
-    def __init__(self):
-        pass
-
-    def execute_task(self, task, research_data):
-        messages = [
-            {"role": "system", "content": "You are an assistant that writes content for e-books."},
-            {"role": "user", "content": f"{task}\n\nResearch Data:\n{research_data}"},
-        ]
-        response = openai.ChatCompletion.create(
-            model="gpt-4o",
-            messages=messages,
-            max_tokens=1500,
-            temperature=0.7,
-        )
-        content = response['choices'][0]['message']['content'].strip()
-        return content
-
-class DesignerAgent:
-    def __init__(self):
-        self.name = "Designer"
-        self.role = "Generate cover page design"
-        self.goal = "Create a relevant, minimal, and beautiful cover page using DALL-E 3"
-        self.backstory = "Creative designer with a knack for generating stunning visuals"
-        self.verbose = True
-        self.llm = "dalle-3"
-        self.allow_delegation = True
-        self.tools = ["advanced_llm", "image_generation"]
-
-    def generate_cover_prompt(self, book_title):
-        return f"Create an artwork design on subject '{book_title}'. The design should be minimal, beautiful, and relevant to the topic. The artwork should not be too imaginary. The artwork should not have actual book, book cover, book mockups and texts."
-
-    def generate_chapter_prompt(self, chapter_title, chapter_summary):
-        # Base prompt text
-        base_prompt = f"Create an artwork design for the chapter titled '{chapter_title}'. The design should be minimal, beautiful, and relevant to the topic. The artwork should not be too imaginary. The artwork should not have actual book, book cover, book mockups and texts. Here is a brief summary of the chapter: "
-        
-        # Calculate the maximum allowed length for the summary
-        max_summary_length = 3800 - len(base_prompt)
-        
-        # Truncate the summary if necessary
-        if len(chapter_summary) > max_summary_length:
-            chapter_summary = chapter_summary[:max_summary_length] + "..."
-        
-        return base_prompt + chapter_summary
-
-    def execute_task(self, book_folder, topic, toc, chapters):
-        # Generate cover page design
-        cover_prompt = self.generate_cover_prompt(topic)
-        print(f"Prompt for DALL-E 3: {cover_prompt}")
-
-        # Use DALL-E 3 to generate the cover page design
-        completion_response = openai.Image.create(
-            model="dall-e-3",
-            prompt=cover_prompt,
-            n=1,
-            size="1024x1024",
-            quality="hd",
-            style="vivid"
-        )
-
-        # Save the generated image
-        image_url = completion_response['data'][0]['url']
-        image_response = requests.get(image_url)
-        if image_response.status_code == 200:
-            cover_image_path = os.path.join(book_folder, "cover_page.png")
-            with open(cover_image_path, "wb") as file:
-                file.write(image_response.content)
-            print(f"Cover page design saved as {cover_image_path}")
-        else:
-            print("Failed to download the cover page design.")
-
-        # Generate prompts and images for each chapter
-        for chapter in chapters:
-            chapter_title = chapter['title']
-            chapter_prompt = self.generate_chapter_prompt(chapter_title, chapter['content'])
-            print(f"Prompt for DALL-E 3: {chapter_prompt}")
-
-            # Use DALL-E 3 to generate the chapter image
-            completion_response = openai.Image.create(
-                model="dall-e-3",
-                prompt=chapter_prompt,
-                n=1,
-                size="1024x1024",
-                quality="hd",
-                style="vivid"
-            )
-
-            # Save the generated image
-            image_url = completion_response['data'][0]['url']
-            image_response = requests.get(image_url)
-            if image_response.status_code == 200:
-                safe_chapter_title = sanitize_filename(chapter_title)
-                image_path = os.path.join(book_folder, f"{safe_chapter_title}_image.png")
-                with open(image_path, "wb") as file:
-                    file.write(image_response.content)
-                print(f"Chapter image saved as {image_path}")
-            else:
-                print(f"Failed to download the image for chapter: {chapter_title}")
-
 if __name__ == "__main__":
     root = tk.Tk()
     app = EBookGeneratorApp(root)
@@ -0,0 +1,56 @@
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+# One connection pooled HTTP session shared by every outbound call: OpenAI, Tavily and image downloads.
+# Connections are kept alive between calls, so only the first call to a host pays for the TCP and TLS handshake.
+
+# Hosts that keep a pool, and open connections per host (callers wait for a free one beyond that)
+http_pool_hosts = int(os.getenv("HTTP_POOL_HOSTS", "8"))
+http_max_connections_per_host = int(os.getenv("HTTP_MAX_CONNECTIONS_PER_HOST", "16"))
+# Seconds allowed for opening a connection, the read timeout is chosen per call
+http_connect_timeout = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+
+# openai 0.28 closes its session every few minutes, which would drop the pooled connections
+# of every other caller, so the shared session ignores close()
+class SharedSession(requests.Session):
+    def close(self):
+        pass
+
+def create_http_session(pool_hosts=http_pool_hosts, max_connections_per_host=http_max_connections_per_host):
+    session = SharedSession()
+    # Retries are left to the API scheduler, pool_block caps the connections per host
+    adapter = HTTPAdapter(
+        pool_connections=pool_hosts,
+        pool_maxsize=max_connections_per_host,
+        max_retries=0,
+        pool_block=True,
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+default_session = None
+default_session_lock = threading.Lock()
+
+def get_http_session():
+    global default_session
+    with default_session_lock:
+        if default_session is None:
+            default_session = create_http_session()
+        return default_session
+
+# (connect, read) timeout pair for requests
+def http_timeout(read_timeout):
+    return (http_connect_timeout, read_timeout)
+
+# Call function(response) for every response the shared session receives, e.g. to read rate limit headers
+def add_response_observer(function):
+    def hook(response, *args, **kwargs):
+        try:
+            function(response)
+        except Exception as e:
+            print(f"Response observer failed: {e}")
+        return response
+    get_http_session().hooks["response"].append(hook)
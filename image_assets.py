@@ -0,0 +1,239 @@
+import os
+import re
+import uuid
+import hashlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait
+
+# Pillow is optional, without it only the originals are stored
+try:
+    from PIL import Image, features
+except ImportError:
+    Image = features = None
+
+# Content addressed store for a book's images, kept in the book's assets folder.
+#
+# Every image is stored once under the hash of its bytes, whatever chapter it belongs to, so
+# repeated images share one file and a renamed chapter only needs its manifest entry changed.
+# Chapters and the cover are linked by name (cover_page.png, <chapter>_image.png) while the image
+# is generated. The manifest maps each name to a hash, and links are resolved to a variant once
+# the image is stored (chapter files) or when the merged book or an export is written:
+#
+#   thumb  small JPEG for previews
+#   web    WebP (JPEG when Pillow lacks WebP), used by the merged Markdown
+#   print  high quality JPEG at full size, the source of the PDF and EPUB exports
+#
+# The variants are built in a pool of processes. Once they exist the original PNG is deleted,
+# unless KEEP_ORIGINAL_IMAGES is set.
+
+assets_folder_name = "assets"
+image_variant_workers = int(os.getenv("IMAGE_VARIANT_WORKERS", str(min(4, os.cpu_count() or 1))))
+keep_original_images = os.getenv("KEEP_ORIGINAL_IMAGES", "0") == "1"
+
+# Longest side in pixels, format and quality of each variant
+image_variants = {
+    "thumb": (int(os.getenv("IMAGE_THUMB_PX", "256")), "JPEG", 75),
+    "web": (int(os.getenv("IMAGE_WEB_PX", "768")), "WEBP", int(os.getenv("IMAGE_WEB_QUALITY", "80"))),
+    "print": (int(os.getenv("IMAGE_PRINT_PX", "2048")), "JPEG", int(os.getenv("IMAGE_PRINT_QUALITY", "92"))),
+}
+# Variants to fall back on when the wanted one does not exist (yet), the original comes last
+variant_fallbacks = {
+    "thumb": ("thumb", "web", "print"),
+    "web": ("web", "print"),
+    "print": ("print",),
+    None: (),
+}
+variant_extensions = {"JPEG": ".jpg", "WEBP": ".webp"}
+# Worker processes are spawned, not forked: a fork of the app (Tk loop, worker threads, scheduler
+# lock) could inherit a lock held by another thread and hang
+process_context = multiprocessing.get_context("spawn")
+
+asset_name_pattern = re.compile(r"^([0-9a-f]{32})(?:-(thumb|web|print))?\.(png|jpg|webp)$")
+markdown_image_pattern = re.compile(r"(!\[[^\]]*\]\()([^)\s]+)(\))")
+
+def asset_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+def variant_format(variant):
+    image_format = image_variants[variant][1]
+    if image_format == "WEBP" and (features is None or not features.check("webp")):
+        return "JPEG"
+    return image_format
+
+def variant_filename(digest, variant):
+    return f"{digest[:32]}-{variant}{variant_extensions[variant_format(variant)]}"
+
+# Runs in the worker processes
+def build_variants(job):
+    with Image.open(job["source"]) as image:
+        image.load()
+        if image.mode in ("RGBA", "LA", "P"):
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+        # Largest first, so a reader falling back to print never finds it missing
+        for variant, target, max_px, image_format, quality in job["variants"]:
+            resized = image.copy()
+            resized.thumbnail((max_px, max_px))
+            temp_path = f"{target}.{os.getpid()}.tmp"
+            options = {"optimize": True, "progressive": True} if image_format == "JPEG" else {"method": 4}
+            resized.save(temp_path, image_format, quality=quality, **options)
+            os.replace(temp_path, target)
+    if not job["keep_original"]:
+        os.remove(job["source"])
+    return job["digest"]
+
+class ImageStore:
+    def __init__(self, book_folder, executor=None):
+        self.book_folder = book_folder
+        self.folder = os.path.join(book_folder, assets_folder_name)
+        # A shared process pool lets several books build variants under one limit
+        self.executor = executor
+        self.own_executor = None
+        self.futures = []
+        self.lock = threading.Lock()
+
+    def relative_path(self, filename):
+        return f"{assets_folder_name}/{filename}"
+
+    def original_path(self, digest):
+        return os.path.join(self.folder, f"{digest[:32]}.png")
+
+    def variant_path(self, digest, variant):
+        return os.path.join(self.folder, variant_filename(digest, variant))
+
+    def has(self, digest):
+        # The print variant replaces the original once it is built
+        return os.path.exists(self.original_path(digest)) or os.path.exists(self.variant_path(digest, "print"))
+
+    def path(self, digest, variant=None):
+        # Best existing file for a variant, None when the image is not stored
+        for candidate in variant_fallbacks[variant]:
+            path = self.variant_path(digest, candidate)
+            if os.path.exists(path):
+                return path
+        path = self.original_path(digest)
+        if os.path.exists(path):
+            return path
+        if variant is None:
+            return self.path(digest, "print")
+        return None
+
+    def temp_path(self):
+        # Where a download is written before its hash is known
+        os.makedirs(self.folder, exist_ok=True)
+        return os.path.join(self.folder, f"{uuid.uuid4().hex}.download")
+
+    def add_file(self, path):
+        # Moves the file into the store and returns its hash. A file the store already holds is
+        # deleted instead, so the same image is never kept twice.
+        digest = hashlib.sha256()
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(1024 * 1024), b""):
+                digest.update(block)
+        digest = digest.hexdigest()
+        with self.lock:
+            if self.has(digest):
+                os.remove(path)
+                return digest
+            os.makedirs(self.folder, exist_ok=True)
+            os.replace(path, self.original_path(digest))
+            self.submit_variants(digest)
+        return digest
+
+    def add_bytes(self, data):
+        digest = asset_digest(data)
+        with self.lock:
+            if self.has(digest):
+                return digest
+        temp_path = self.temp_path()
+        with open(temp_path, "wb") as file:
+            file.write(data)
+        return self.add_file(temp_path)
+
+    def submit_variants(self, digest):
+        if Image is None:
+            return
+        variants = []
+        for variant in ("print", "web", "thumb"):
+            max_px, _, quality = image_variants[variant]
+            variants.append((variant, self.variant_path(digest, variant), max_px, variant_format(variant), quality))
+        job = {"digest": digest, "source": self.original_path(digest), "variants": variants, "keep_original": keep_original_images}
+        executor = self.executor
+        if executor is None:
+            if self.own_executor is None:
+                self.own_executor = ProcessPoolExecutor(max_workers=max(1, image_variant_workers), mp_context=process_context)
+            executor = self.own_executor
+        self.futures.append(executor.submit(build_variants, job))
+
+    def wait(self):
+        # Waits for the queued variants, an image whose variants failed keeps its original
+        with self.lock:
+            futures, self.futures = self.futures, []
+        wait(futures)
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Failed to build image variants: {e}")
+
+    def close(self):
+        self.wait()
+        if self.own_executor is not None:
+            self.own_executor.shutdown(wait=True)
+            self.own_executor = None
+
+    def link(self, digest, variant="web"):
+        # Link to the best stored file for a variant, relative to the book folder
+        path = self.path(digest, variant)
+        return self.relative_path(os.path.basename(path)) if path else None
+
+    def link_resolver(self, image_hashes, variant="web"):
+        # Returns a function that points the image links of a Markdown text at the stored files.
+        # image_hashes maps image names to hashes, see RunManifest.image_hashes. Links to images
+        # that are not stored are left alone.
+        targets = {}
+        for name, digest in image_hashes.items():
+            target = self.link(digest, variant)
+            if target:
+                targets[name] = target
+
+        def resolve(markdown_text):
+            if not targets:
+                return markdown_text
+            return markdown_image_pattern.sub(
+                lambda match: match.group(1) + targets.get(match.group(2), match.group(2)) + match.group(3), markdown_text
+            )
+        return resolve
+
+    def source_path(self, source, image_hashes, variant="print"):
+        # File behind an image link: an image name from the manifest, a link into the store
+        # (another variant of the same image may be wanted) or a plain file in the book folder
+        if source in image_hashes:
+            path = self.path(image_hashes[source], variant)
+            if path:
+                return path
+        match = asset_name_pattern.match(os.path.basename(source))
+        if match and os.path.dirname(os.path.normpath(source)) == assets_folder_name:
+            path = self.path(match.group(1), variant)
+            if path:
+                return path
+        path = os.path.normpath(os.path.join(self.book_folder, source))
+        return path if os.path.isfile(path) else None
+
+    def remove_unused(self, digests):
+        # Deletes stored images no longer referenced by any chapter, and abandoned downloads
+        if not os.path.isdir(self.folder):
+            return 0
+        keep = {digest[:32] for digest in digests}
+        removed = 0
+        for name in os.listdir(self.folder):
+            match = asset_name_pattern.match(name)
+            if (match and match.group(1) not in keep) or name.endswith(".download"):
+                os.remove(os.path.join(self.folder, name))
+                removed += 1
+        return removed
@@ -0,0 +1,242 @@
+import json
+import re
+import time
+import zlib
+import random
+import struct
+import hashlib
+import threading
+import openai
+
+# Local stand-in for OpenAI and Tavily. Answers are derived from a hash of the request, so the same
+# request always gets the same text, search results and PNG. Latency and rate limit errors are simulated
+# and the provider keeps count of how many calls ran at the same time.
+
+mock_words = (
+    "practical insight method example history research principle design community practice season "
+    "evidence approach detail pattern result habit system tool reader experience guide study"
+).split()
+
+def request_seed(*parts):
+    material = json.dumps(parts, sort_keys=True, default=str)
+    return int(hashlib.sha256(material.encode("utf-8")).hexdigest()[:16], 16)
+
+# Minimal valid PNG (one solid colour), so the image pipeline has real bytes to save
+def solid_png(width, height, rgb):
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+    row = b"\x00" + bytes(rgb) * width
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(row * height))
+        + chunk(b"IEND", b"")
+    )
+
+class MockResponse:
+    def __init__(self, status_code=200, data=None, content=b"", headers=None, chunk_delay=0.0):
+        self.status_code = status_code
+        self.data = data
+        self.content = content
+        self.headers = headers or {}
+        self.text = json.dumps(data) if data is not None else ""
+        self.chunk_delay = chunk_delay
+
+    def json(self):
+        return self.data
+
+    def iter_content(self, chunk_size=65536):
+        for start in range(0, len(self.content), chunk_size):
+            if self.chunk_delay:
+                time.sleep(self.chunk_delay)
+            yield self.content[start:start + chunk_size]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+class MockProvider:
+    name = "mock"
+    # Nothing is paid for, mock runs report a cost of $0.00
+    billed = False
+    # Runs without OPENAI_API_KEY and TAVILY_API_KEY
+    needs_api_keys = False
+
+    def __init__(self, latency=0.05, jitter=0.5, rate_limit_rate=0.0, toc_chapters=10, chapter_words=800,
+                 stream_chunk_delay=0.001, image_latency=None, image_size=256, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_rate = rate_limit_rate
+        self.toc_chapters = toc_chapters
+        self.chapter_words = chapter_words
+        self.stream_chunk_delay = stream_chunk_delay
+        self.image_latency = latency * 4 if image_latency is None else image_latency
+        self.image_size = image_size
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.rate_limited = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.busy_seconds = 0.0
+
+    # Bookkeeping
+
+    def begin(self, kind):
+        with self.lock:
+            self.calls[kind] = self.calls.get(kind, 0) + 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            fail = self.rate_limit_rate and self.random.random() < self.rate_limit_rate
+            if fail:
+                self.rate_limited += 1
+        return time.monotonic(), fail
+
+    def end(self, started):
+        with self.lock:
+            self.in_flight -= 1
+            self.busy_seconds += time.monotonic() - started
+
+    def simulate_latency(self, base, seed):
+        jitter = 1 + self.jitter * ((seed % 1000) / 1000 - 0.5)
+        time.sleep(max(0.0, base * jitter))
+
+    def stats(self):
+        with self.lock:
+            return {
+                "calls": dict(self.calls),
+                "rate_limited": self.rate_limited,
+                "peak_in_flight": self.peak_in_flight,
+                "busy_seconds": self.busy_seconds,
+            }
+
+    # Content
+
+    def words(self, seed, count):
+        generator = random.Random(seed)
+        return [generator.choice(mock_words) for _ in range(count)]
+
+    def chat_text(self, messages, seed):
+        prompt = messages[-1]["content"]
+        if "table of contents" in prompt.lower():
+            return "\n".join(
+                f"CHAPTER {number:02} - {' '.join(self.words(seed + number, 3)).title()}"
+                for number in range(1, self.toc_chapters + 1)
+            )
+        if prompt.startswith("Summarize"):
+            return " ".join(self.words(seed, 45)).capitalize() + "."
+        if "provide a comprehensive answer" in prompt:
+            return " ".join(self.words(seed, 120)).capitalize() + "."
+        if "Rewrite the passage" in prompt:
+            return " ".join(self.words(seed, 70)).capitalize() + "."
+        if prompt.startswith("Proofread the numbered paragraphs"):
+            # Every paragraph with a doubled word gets a correction
+            corrections = {}
+            for number, paragraph in re.findall(r"^\[(\d+)\]\n(.*?)(?=\n\n\[\d+\]\n|\Z)", prompt, re.MULTILINE | re.DOTALL):
+                doubled = re.search(r"\b(\w+) \1\b", paragraph)
+                if doubled:
+                    corrections[number] = [{"original": doubled.group(0), "replacement": doubled.group(1), "reason": "repeated word"}]
+            return json.dumps(corrections)
+        if "Answer with the new text only" in prompt:
+            return " ".join(self.words(seed, 40)).capitalize() + "."
+        if "was cut off" in prompt:
+            return "## Conclusion\n\n" + " ".join(self.words(seed, 60)).capitalize() + "."
+        title = prompt.split("chapter called ", 1)[-1].split(".", 1)[0] if "chapter called " in prompt else "Chapter"
+        paragraphs = [f"# {title}"]
+        remaining = self.chapter_words
+        section = 1
+        while remaining > 0:
+            count = min(remaining, 90)
+            if section % 3 == 1:
+                paragraphs.append(f"## Section {section // 3 + 1}")
+            paragraphs.append(" ".join(self.words(seed + section, count)).capitalize() + ".")
+            remaining -= count
+            section += 1
+        return "\n\n".join(paragraphs)
+
+    # Provider interface
+
+    def chat_completion(self, **params):
+        seed = request_seed(params.get("model"), params.get("messages"), params.get("max_tokens"))
+        started, fail = self.begin("chat")
+        try:
+            self.simulate_latency(self.latency, seed)
+            if fail:
+                raise openai.error.RateLimitError("Mock rate limit", http_status=429, headers={"retry-after": "0.05"})
+            text = self.chat_text(params["messages"], seed)
+        except Exception:
+            self.end(started)
+            raise
+        # Answers longer than max_tokens are cut off, like the real API does
+        finish_reason = "stop"
+        if params.get("max_tokens") and len(text) // 4 > params["max_tokens"]:
+            text = text[:params["max_tokens"] * 4]
+            finish_reason = "length"
+        if params.get("stream"):
+            # The call stays in flight until the stream is consumed
+            return self.stream_chunks(text, started, finish_reason)
+        self.end(started)
+        prompt_tokens = sum(len(message["content"]) // 4 for message in params["messages"])
+        return {
+            "choices": [{"message": {"role": "assistant", "content": text}, "finish_reason": finish_reason}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(text) // 4, "total_tokens": prompt_tokens + len(text) // 4},
+        }
+
+    def stream_chunks(self, text, started, finish_reason="stop"):
+        try:
+            pieces = text.split(" ")
+            for number, piece in enumerate(pieces):
+                if self.stream_chunk_delay and number % 20 == 0:
+                    time.sleep(self.stream_chunk_delay)
+                yield {"choices": [{"delta": {"content": piece + (" " if number + 1 < len(pieces) else "")}}]}
+            yield {"choices": [{"delta": {}, "finish_reason": finish_reason}]}
+        finally:
+            self.end(started)
+
+    def create_image(self, **params):
+        seed = request_seed(params.get("prompt"))
+        started, fail = self.begin("image")
+        try:
+            self.simulate_latency(self.image_latency, seed)
+            if fail:
+                raise openai.error.RateLimitError("Mock rate limit", http_status=429, headers={"retry-after": "0.05"})
+            return {"data": [{"url": f"mock://images/{seed:x}.png"}]}
+        finally:
+            self.end(started)
+
+    def post_search(self, api_key, query, timeout):
+        seed = request_seed(query)
+        started, fail = self.begin("search")
+        try:
+            self.simulate_latency(self.latency, seed)
+            if fail:
+                return MockResponse(429, {"detail": "Mock rate limit"}, headers={"retry-after": "0.05"})
+            # Sources come from a small shared pool, so related queries find overlapping pages
+            terms = [word for word in query.lower().replace(":", " ").split() if len(word) > 2]
+            results = []
+            for number, term in enumerate(terms[:5]):
+                source = request_seed(term) % 50
+                results.append({
+                    "title": f"Source {source} about {term}",
+                    "url": f"https://example.com/source/{source}",
+                    "content": " ".join(self.words(source, 60)),
+                    "score": round(1 - number * 0.1, 2),
+                })
+            data = {"answer": " ".join(self.words(seed, 60)), "query": query, "results": results}
+            return MockResponse(200, data)
+        finally:
+            self.end(started)
+
+    def get_image(self, url, timeout):
+        seed = request_seed(url)
+        started, fail = self.begin("download")
+        try:
+            self.simulate_latency(self.latency / 2, seed)
+            if fail:
+                return MockResponse(429, headers={"retry-after": "0.05"})
+            rgb = ((seed >> 16) & 255, (seed >> 8) & 255, seed & 255)
+            return MockResponse(200, content=solid_png(self.image_size, self.image_size, rgb))
+        finally:
+            self.end(started)
@@ -0,0 +1,209 @@
+import re
+import threading
+
+# tiktoken is optional, without it token counts fall back to a characters based estimate
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Prompt building for the writer calls, a local token estimate to budget them and a per-book
+# ledger of the tokens sent and saved.
+#
+# The long chapter instructions are the same for every chapter of every book, so they go first,
+# in the system message, and only the chapter specific request follows. That identical prefix is
+# what provider-side prompt caching can reuse across calls.
+
+writer_system_message = "You are an assistant that writes content for e-books."
+
+chapter_instructions = "Use simple and understandable English. Follow the research data and do not create imaginary content. Use your creative freedom, it is suggested but not important to divide it into structured segments similar to an academic book, including any relevant examples, facts, quotes, and notable people or brands only if applicable. Conduct research on the web to gather accurate information and provide references for any key points made. Each chapter should be around 750 to 1000 words. Use your creative freedom, it is suggested but not important that each segments might include the following elements, all or a few or even none: Start with an engaging introduction that provides a brief overview of the segment. Include practical examples to illustrate key points. Incorporate factual information and quotes from credible sources or notable figures. Mention notable people or brands related to the subject matter. Add a short exercise or interactive activity at the end to engage readers and reinforce learning. Provide references for all the key points made to ensure accuracy and credibility. End with a conclusion with a summary that recaps the main points discussed in the chapter. Make sure that you go through past and future topics from the table of contents so that there are no redundant content in this chapter. Do not add prefatory statements, your own status, notes, apologizes and inconvenience, like you don't have access to internet, feel free to adjust, I cannot provide direct reference from web, fact checking or follow ups like sure, here is a detailed structure for your book. Do not keep unended sentences. Do not generate any elements if you don't have enough information. Make the content print ready without any remarks or feedback from your side. Output should be a well formatted mark down for example H1 for Chapter title, H2, H3 and other headings for other segment titles."
+
+# Token budget of the chapter extract that summaries and image prompts are made from
+summary_extract_tokens = 600
+summary_max_tokens = 200
+# Token budget of the chapter ending sent with a continuation request
+continuation_tail_tokens = 300
+
+encodings = {}
+encodings_lock = threading.Lock()
+
+def get_encoding(model):
+    # None when the encoding cannot be loaded, e.g. offline before tiktoken has downloaded it
+    with encodings_lock:
+        if model not in encodings:
+            try:
+                try:
+                    encodings[model] = tiktoken.encoding_for_model(model)
+                except KeyError:
+                    encodings[model] = tiktoken.get_encoding("o200k_base")
+            except Exception as e:
+                print(f"Failed to load the token encoding for {model}, estimating tokens instead: {e}")
+                encodings[model] = None
+        return encodings[model]
+
+def count_tokens(text, model="gpt-4o"):
+    if not text:
+        return 0
+    encoding = get_encoding(model) if tiktoken is not None else None
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return max(1, len(text) // 4)
+
+def count_message_tokens(messages, model="gpt-4o"):
+    # Each message also costs a few tokens of framing
+    return sum(count_tokens(message["content"], model) + 4 for message in messages) + 2
+
+# Names of the chapters before and after this one, so the model can avoid repeating them
+def neighbour_note(previous_title, next_title):
+    notes = []
+    if previous_title:
+        notes.append(f"The previous chapter is {previous_title}.")
+    if next_title:
+        notes.append(f"The next chapter is {next_title}.")
+    if not notes:
+        return ""
+    return " " + " ".join(notes) + " Do not repeat their content."
+
+# Sections of the chapters already written, from RedundancyIndex.covered_topics
+def covered_note(covered):
+    if not covered:
+        return ""
+    return f"\n\nOther chapters already cover these sections, do not repeat them:\n{covered}"
+
+def chapter_messages(topic, chapter_title, research_data, previous_title="", next_title="", covered=""):
+    return [
+        {"role": "system", "content": f"{writer_system_message}\n\n{chapter_instructions}"},
+        {"role": "user", "content": f"Write a detailed content for {topic} book with chapter called {chapter_title}.{neighbour_note(previous_title, next_title)}{covered_note(covered)}\n\nResearch Data:\n{research_data}"},
+    ]
+
+def summary_messages(chapter_text):
+    return [
+        {"role": "system", "content": writer_system_message},
+        {"role": "user", "content": f"Summarize the following chapter content in 2-3 sentences:\n\n{chapter_text}"},
+    ]
+
+# Follow-up request for a chapter whose answer was cut off. Instead of the research data it sends the
+# chapter's headings and its last paragraphs, so the answer only has to cover what is missing.
+def continuation_messages(topic, chapter_title, written_text, in_code_block=False, tail_tokens=continuation_tail_tokens):
+    headings = "\n".join(line.strip() for line in written_text.splitlines() if line.startswith("#"))
+    tail = []
+    used = 0
+    for block in reversed(re.split(r"\n\s*\n", written_text.strip())):
+        used += count_tokens(block)
+        if tail and used > tail_tokens:
+            break
+        tail.insert(0, block)
+    tail = "\n\n".join(tail)
+    note = " The text stops inside a code block, finish and close it first." if in_code_block else ""
+    return [
+        {"role": "system", "content": f"{writer_system_message}\n\n{chapter_instructions}"},
+        {"role": "user", "content": f"The chapter called {chapter_title} of the {topic} book was cut off.{note}\n\nHeadings written so far:\n{headings}\n\nThe chapter currently ends with:\n{tail}\n\nContinue the chapter from exactly where it ends, starting on a new line. Do not repeat any text or heading that is already written. Write the remaining sections and end the chapter properly."},
+    ]
+
+# Targeted rewrite of one passage that repeats another chapter, without the research data and instructions
+def rewrite_messages(topic, chapter_title, passage, other_title, other_passage):
+    return [
+        {"role": "system", "content": writer_system_message},
+        {"role": "user", "content": f"A passage of the chapter called {chapter_title} of the {topic} book repeats what the chapter called {other_title} already says:\n\n{other_passage}\n\nRewrite the passage below so it adds something new for its own chapter instead of repeating that. Keep about the same length and the Markdown formatting, and answer with the rewritten passage only, without headings.\n\nPassage:\n{passage}"},
+    ]
+
+# Proofreading of numbered paragraphs, the answer is a JSON object with the corrections per paragraph number
+proofread_system_message = "You are a careful proofreader of e-book manuscripts written in Markdown."
+
+def proofread_messages(paragraphs):
+    numbered = "\n\n".join(f"[{number}]\n{paragraph}" for number, paragraph in enumerate(paragraphs, start=1))
+    return [
+        {"role": "system", "content": proofread_system_message},
+        {"role": "user", "content": f"Proofread the numbered paragraphs below for spelling, grammar, punctuation and clearly wrong word choices. Do not change the style, the Markdown formatting or anything that is already correct. Answer with a JSON object only, mapping each paragraph number that needs corrections to a list of objects with \"original\" (the exact text to replace, as short as possible), \"replacement\" and \"reason\" (a few words). Leave out paragraphs without mistakes, answer {{}} when there are none.\n\n{numbered}"},
+    ]
+
+# Instructions of the editor's selection tools
+selection_tool_instructions = {
+    "rewrite": "Rewrite the selected text so it reads better, keeping its meaning, length and Markdown formatting.",
+    "summarize": "Summarize the selected text in a few sentences, keeping its Markdown formatting.",
+    "expand": "Expand the selected text with more detail, explanation and examples, keeping its style and Markdown formatting.",
+    "grammar": "Correct the spelling, grammar and punctuation of the selected text and change nothing else.",
+}
+
+def selection_tool_messages(tool, selected_text, topic="", chapter_title=""):
+    where = f" from the chapter called {chapter_title} of the {topic} book" if chapter_title else ""
+    return [
+        {"role": "system", "content": writer_system_message},
+        {"role": "user", "content": f"{selection_tool_instructions[tool]} Answer with the new text only, without any remarks.\n\nSelected text{where}:\n{selected_text}"},
+    ]
+
+# Headings plus the first sentence of every paragraph, cut off at max_tokens.
+# Enough for a summary or an image prompt at a fraction of the chapter's tokens.
+def compact_extract(markdown_text, max_tokens=summary_extract_tokens, model="gpt-4o"):
+    parts = []
+    used = 0
+    for block in re.split(r"\n\s*\n", markdown_text):
+        block = block.strip()
+        if not block or block.startswith("!["):
+            continue
+        if block.startswith("#"):
+            line = block.splitlines()[0].lstrip("#").strip()
+        else:
+            text = " ".join(line.strip().lstrip("-*>0123456789. ").strip() for line in block.splitlines())
+            line = re.split(r"(?<=[.!?])\s", text, maxsplit=1)[0]
+        if not line:
+            continue
+        tokens = count_tokens(line, model) + 1
+        if used + tokens > max_tokens:
+            break
+        parts.append(line)
+        used += tokens
+    return "\n".join(parts)
+
+# Prompt and completion tokens per stage of one book, with what compaction and the cache saved
+class TokenLedger:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+
+    def record(self, stage, prompt_tokens, completion_tokens, baseline_prompt_tokens=None, cached=False, provider_cached_tokens=0):
+        # baseline_prompt_tokens is what the same call cost before its prompt was compacted
+        baseline_prompt_tokens = prompt_tokens if baseline_prompt_tokens is None else baseline_prompt_tokens
+        with self.lock:
+            totals = self.stages.setdefault(stage, {
+                "calls": 0,
+                "cache_hits": 0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "prompt_tokens_saved": 0,
+                "completion_tokens_saved": 0,
+                "provider_cached_tokens": 0,
+            })
+            totals["calls"] += 1
+            if cached:
+                totals["cache_hits"] += 1
+                totals["prompt_tokens_saved"] += baseline_prompt_tokens
+                totals["completion_tokens_saved"] += completion_tokens
+            else:
+                totals["prompt_tokens"] += prompt_tokens
+                totals["completion_tokens"] += completion_tokens
+                totals["prompt_tokens_saved"] += max(0, baseline_prompt_tokens - prompt_tokens)
+                totals["provider_cached_tokens"] += provider_cached_tokens
+
+    def report(self):
+        with self.lock:
+            stages = {stage: dict(totals) for stage, totals in self.stages.items()}
+        total = {}
+        for totals in stages.values():
+            for name, value in totals.items():
+                total[name] = total.get(name, 0) + value
+        return {"stages": stages, "total": total}
+
+    def format_report(self, title):
+        report = self.report()
+        lines = [f"Token report for {title} (tokens counted {'with tiktoken' if tiktoken else 'approximately'}):"]
+        for stage, totals in sorted(report["stages"].items()) + [("total", report["total"])]:
+            if not totals:
+                continue
+            lines.append(
+                f"  {stage}: {totals['calls']} calls ({totals['cache_hits']} cached), "
+                f"sent {totals['prompt_tokens']} prompt + {totals['completion_tokens']} completion, "
+                f"saved {totals['prompt_tokens_saved']} prompt + {totals['completion_tokens_saved']} completion, "
+                f"{totals['provider_cached_tokens']} prompt tokens cached by the provider"
+            )
+        return "\n".join(lines)
@@ -0,0 +1,199 @@
+import os
+import re
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from response_cache import ResponseCache
+from run_manifest import content_hash
+from api_scheduler import get_scheduler, priority_chapter
+from providers import get_provider
+from prompt_builder import count_message_tokens, count_tokens, proofread_messages
+from ebook_engine import billed_cost, cached_chat_completion, estimate_chat_cost
+
+# Proofreading of the Final Content, one paragraph at a time.
+#
+# The text is split into paragraphs and every paragraph is known by the hash of its text. A
+# paragraph proofread before, in this session or an earlier one (the corrections are kept in the
+# response cache under the paragraph's hash), is not sent again, so checking a whole book after a
+# small edit only sends the paragraphs that changed. Those are sent in batches of numbered
+# paragraphs, several batches at a time, and the answer lists the corrections per paragraph.
+
+proofread_model = os.getenv("PROOFREAD_MODEL", "gpt-4o-mini")
+proofread_workers = int(os.getenv("PROOFREAD_WORKERS", "4"))
+# Paragraph tokens per request
+proofread_batch_tokens = int(os.getenv("PROOFREAD_BATCH_TOKENS", "1500"))
+proofread_stage = "proofread"
+
+fence_pattern = re.compile(r"^\s*(```|~~~)")
+
+# Paragraphs of a Markdown text with the line they start on (1 based, like Tk text indexes).
+# Headings are paragraphs of their own, code blocks, images and tables are skipped.
+def text_paragraphs(text):
+    paragraphs = []
+    lines = []
+    start_line = 1
+    in_code_block = False
+
+    def flush():
+        block = "\n".join(lines)
+        if block.strip() and not block.startswith("![") and not block.startswith("|"):
+            paragraphs.append({"line": start_line, "text": block})
+        lines.clear()
+
+    for line_number, line in enumerate(text.split("\n"), start=1):
+        if fence_pattern.match(line):
+            flush()
+            in_code_block = not in_code_block
+            continue
+        if in_code_block:
+            continue
+        if not line.strip() or line.startswith("#"):
+            flush()
+            if line.startswith("#"):
+                paragraphs.append({"line": line_number, "text": line})
+            continue
+        if not lines:
+            start_line = line_number
+        lines.append(line)
+    flush()
+    return paragraphs
+
+def paragraph_hash(paragraph):
+    return content_hash(paragraph)
+
+# The JSON object of a proofreading answer, a ```json fence around it is allowed
+def parse_corrections(answer):
+    answer = answer.strip()
+    if answer.startswith("```"):
+        answer = answer.split("\n", 1)[-1].rsplit("```", 1)[0]
+    corrections = json.loads(answer)
+    if not isinstance(corrections, dict):
+        raise ValueError("the answer is not a JSON object")
+    return corrections
+
+# Corrections that can be applied to the paragraph: the original text must be in it and change
+def valid_suggestions(paragraph, corrections):
+    suggestions = []
+    for correction in corrections if isinstance(corrections, list) else []:
+        if not isinstance(correction, dict):
+            continue
+        original = correction.get("original")
+        replacement = correction.get("replacement")
+        if not isinstance(original, str) or not isinstance(replacement, str) or not original or original == replacement:
+            continue
+        if original in paragraph:
+            suggestions.append({"original": original, "replacement": replacement, "reason": str(correction.get("reason", ""))})
+    return suggestions
+
+class Proofreader:
+    def __init__(self, cache=None, scheduler=None, provider=None, model=proofread_model, max_workers=proofread_workers):
+        self.cache = cache
+        self.scheduler = scheduler or get_scheduler()
+        self.provider = provider or get_provider()
+        self.model = model
+        self.executor = ThreadPoolExecutor(max_workers=max(1, max_workers))
+        self.lock = threading.Lock()
+        # Suggestions by paragraph hash, an empty list for a paragraph without mistakes
+        self.results = {}
+
+    def cache_key(self, paragraph):
+        # The prompt of the paragraph on its own, so the key does not depend on the batch it was sent in
+        return ResponseCache.make_key(self.model, proofread_messages([paragraph]))
+
+    def suggestions(self, paragraph):
+        with self.lock:
+            return list(self.results.get(paragraph_hash(paragraph), []))
+
+    def record(self, paragraph, suggestions):
+        with self.lock:
+            self.results[paragraph_hash(paragraph)] = suggestions
+
+    def ignore(self, paragraph, suggestion):
+        with self.lock:
+            suggestions = self.results.get(paragraph_hash(paragraph))
+            if suggestions and suggestion in suggestions:
+                suggestions.remove(suggestion)
+
+    def apply(self, paragraph, suggestion):
+        # Returns the corrected paragraph. It keeps the other suggestions and is not sent again.
+        corrected = paragraph.replace(suggestion["original"], suggestion["replacement"], 1)
+        with self.lock:
+            others = [other for other in self.results.get(paragraph_hash(paragraph), []) if other is not suggestion]
+            self.results[paragraph_hash(corrected)] = [other for other in others if other["original"] in corrected]
+        return corrected
+
+    def dirty(self, paragraphs):
+        # Paragraphs not checked yet, each text once
+        seen = set()
+        dirty = []
+        for paragraph in paragraphs:
+            digest = paragraph_hash(paragraph)
+            if digest in seen:
+                continue
+            seen.add(digest)
+            with self.lock:
+                if digest in self.results:
+                    continue
+            dirty.append(paragraph)
+        return dirty
+
+    def check(self, paragraphs, check_cancelled=None, on_progress=None):
+        # Proofreads the paragraphs not checked yet and returns how many of them were sent to the API.
+        # on_progress(done, total) is called as the batches finish.
+        pending = []
+        for paragraph in self.dirty(paragraphs):
+            cached = self.cache.get_json(proofread_stage, self.cache_key(paragraph)) if self.cache else None
+            if cached is not None:
+                self.record(paragraph, cached)
+            else:
+                pending.append(paragraph)
+        batches = []
+        used = 0
+        for paragraph in pending:
+            tokens = count_tokens(paragraph, self.model)
+            if not batches or used + tokens > proofread_batch_tokens:
+                batches.append([])
+                used = 0
+            batches[-1].append(paragraph)
+            used += tokens
+        futures = [self.executor.submit(self.check_batch, batch, check_cancelled) for batch in batches]
+        for done, future in enumerate(as_completed(futures), start=1):
+            future.result()
+            if on_progress:
+                on_progress(done, len(futures))
+        return len(pending)
+
+    def check_batch(self, batch, check_cancelled=None):
+        messages = proofread_messages(batch)
+        prompt_tokens = count_message_tokens(messages, self.model)
+        answer = cached_chat_completion(
+            None,
+            proofread_stage,
+            self.scheduler,
+            priority_chapter,
+            check_cancelled,
+            provider=self.provider,
+            model=self.model,
+            messages=messages,
+            # Room for rewriting about half of the text
+            max_tokens=prompt_tokens // 2 + 200,
+            temperature=0,
+        )
+        cost = billed_cost(self.provider, estimate_chat_cost(self.model, prompt_tokens, count_tokens(answer, self.model)))
+        try:
+            corrections = parse_corrections(answer)
+        except ValueError as e:
+            # The paragraphs stay unchecked and are sent again with the next check
+            print(f"Failed to read proofreading answer: {e}")
+            if self.cache:
+                self.cache.record_cost(cost)
+            return
+        for number, paragraph in enumerate(batch, start=1):
+            suggestions = valid_suggestions(paragraph, corrections.get(str(number), []))
+            self.record(paragraph, suggestions)
+            if self.cache:
+                # Every paragraph carries its share of the batch's cost
+                self.cache.put_json(proofread_stage, self.cache_key(paragraph), suggestions, cost / len(batch))
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,65 @@
+import os
+import threading
+import openai
+from http_transport import get_http_session
+
+# Backends the agents talk to. The live provider calls OpenAI and Tavily, the mock provider
+# (mock_provider.py) answers locally so the whole pipeline can run offline, e.g. for benchmarks.
+#
+# A provider has four methods, mirroring the calls the agents make:
+#   chat_completion(**params)           openai.ChatCompletion.create, returns a dict or a stream of chunks
+#   create_image(**params)              openai.Image.create, returns {"data": [{"url": ...}]}
+#   post_search(api_key, query, timeout)  Tavily search, returns a requests style response
+#   get_image(url, timeout)             streamed download, returns a requests style response (context manager)
+#
+# and a billed flag: costs are only reported for a provider whose calls are paid for.
+
+tavily_api_url = "https://api.tavily.com/search"
+
+class LiveProvider:
+    name = "live"
+    # Calls are paid for, their estimated cost is reported
+    billed = True
+    # OPENAI_API_KEY and TAVILY_API_KEY are required
+    needs_api_keys = True
+
+    def chat_completion(self, **params):
+        return openai.ChatCompletion.create(**params)
+
+    def create_image(self, **params):
+        return openai.Image.create(**params)
+
+    def post_search(self, api_key, query, timeout):
+        return get_http_session().post(
+            tavily_api_url,
+            headers={"Content-Type": "application/json"},
+            json={"query": query, "api_key": api_key},
+            timeout=timeout
+        )
+
+    def get_image(self, url, timeout):
+        return get_http_session().get(url, stream=True, timeout=timeout)
+
+default_provider = None
+default_provider_lock = threading.Lock()
+
+# One provider per process, chosen with EBOOK_PROVIDER (live or mock)
+def get_provider():
+    global default_provider
+    with default_provider_lock:
+        if default_provider is None:
+            if os.getenv("EBOOK_PROVIDER", "live").lower() == "mock":
+                from mock_provider import MockProvider
+                default_provider = MockProvider()
+            else:
+                default_provider = LiveProvider()
+        return default_provider
+
+# Whether the app and the CLI must check the API keys before they start
+def api_keys_required():
+    return getattr(get_provider(), "needs_api_keys", True)
+
+def set_provider(provider):
+    global default_provider
+    with default_provider_lock:
+        default_provider = provider
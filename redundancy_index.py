@@ -0,0 +1,161 @@
+import re
+import random
+import hashlib
+import threading
+from research_index import tokenize
+
+# Local index of the paragraphs of a book's chapters, to find passages that repeat each other.
+#
+# Every paragraph is reduced to its word shingles (runs of shingle_size content words) and a MinHash
+# signature of them. Signatures are split into bands; paragraphs sharing a band are candidates, and
+# a candidate pair from two different chapters whose shingle sets overlap by at least
+# the index threshold (Jaccard) is flagged. Chapters are added as they finish, so a chapter is
+# compared with every chapter finished before it, whatever order they finish in.
+#
+# The index also lists what the finished chapters cover (their section headings), which later
+# chapter prompts get as an "already covered" note.
+
+shingle_size = 3
+signature_size = 64
+band_rows = 4
+# Shorter paragraphs (in content words) are not compared
+min_paragraph_words = 25
+mersenne_prime = (1 << 61) - 1
+
+code_block_pattern = re.compile(r"^(```|~~~).*?^\1[^\n]*$", re.MULTILINE | re.DOTALL)
+
+# Fixed seed, so signatures are the same in every run
+permutation_random = random.Random(20240501)
+permutations = [
+    (permutation_random.randrange(1, mersenne_prime), permutation_random.randrange(0, mersenne_prime))
+    for _ in range(signature_size)
+]
+
+def shingles(text):
+    words = tokenize(text)
+    return {" ".join(words[start:start + shingle_size]) for start in range(len(words) - shingle_size + 1)}
+
+def minhash_signature(shingle_set):
+    hashes = [int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big") for shingle in shingle_set]
+    return [min((a * value + b) % mersenne_prime for value in hashes) for a, b in permutations]
+
+def jaccard(first, second):
+    if not first or not second:
+        return 0.0
+    return len(first & second) / len(first | second)
+
+# Paragraphs of a chapter with the heading of the section they are in. Headings, images,
+# tables and code blocks are not paragraphs.
+def chapter_paragraphs(chapter_content):
+    paragraphs = []
+    section = ""
+    for block in re.split(r"\n\s*\n", code_block_pattern.sub("", chapter_content)):
+        block = block.strip()
+        if not block or block.startswith("![") or block.startswith("|"):
+            continue
+        if block.startswith("#"):
+            section = block.splitlines()[0].lstrip("#").strip()
+            continue
+        paragraphs.append((section, block))
+    return paragraphs
+
+def section_headings(chapter_content):
+    return [line.lstrip("#").strip() for line in chapter_content.splitlines() if re.match(r"^#{2,3}\s", line)]
+
+class RedundancyIndex:
+    def __init__(self, threshold=0.5):
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.chapters = {}
+        self.paragraphs = []
+        self.buckets = {}
+        self.flags = []
+
+    def add_chapter(self, chapter_index, chapter_title, chapter_content):
+        # Indexes a finished chapter and returns the new flags, each a dict with the two
+        # chapters, paragraphs and sections and the similarity
+        new_flags = []
+        with self.lock:
+            if chapter_index in self.chapters:
+                self.remove_chapter(chapter_index)
+            self.chapters[chapter_index] = {"title": chapter_title, "headings": section_headings(chapter_content)}
+            for section, text in chapter_paragraphs(chapter_content):
+                shingle_set = shingles(text)
+                if len(shingle_set) < min_paragraph_words - shingle_size + 1:
+                    continue
+                signature = minhash_signature(shingle_set)
+                paragraph = {"chapter": chapter_index, "section": section, "text": text, "shingles": shingle_set}
+                candidates = {}
+                for band in range(0, signature_size, band_rows):
+                    key = (band, tuple(signature[band:band + band_rows]))
+                    for other in self.buckets.get(key, []):
+                        if other["chapter"] != chapter_index:
+                            candidates[id(other)] = other
+                    self.buckets.setdefault(key, []).append(paragraph)
+                self.paragraphs.append(paragraph)
+                for other in candidates.values():
+                    similarity = jaccard(shingle_set, other["shingles"])
+                    if similarity >= self.threshold:
+                        new_flags.append(self.make_flag(paragraph, other, similarity))
+            self.flags.extend(new_flags)
+        return new_flags
+
+    def make_flag(self, paragraph, other, similarity):
+        # The passage in the later chapter is the one to rewrite, the earlier one stays
+        later, earlier = (paragraph, other) if paragraph["chapter"] > other["chapter"] else (other, paragraph)
+        return {
+            "chapter": later["chapter"],
+            "section": later["section"],
+            "text": later["text"],
+            "other_chapter": earlier["chapter"],
+            "other_section": earlier["section"],
+            "other_text": earlier["text"],
+            "similarity": round(similarity, 3),
+        }
+
+    def remove_chapter(self, chapter_index):
+        # Called with the lock held
+        self.chapters.pop(chapter_index, None)
+        self.paragraphs = [paragraph for paragraph in self.paragraphs if paragraph["chapter"] != chapter_index]
+        for key, paragraphs in list(self.buckets.items()):
+            paragraphs = [paragraph for paragraph in paragraphs if paragraph["chapter"] != chapter_index]
+            if paragraphs:
+                self.buckets[key] = paragraphs
+            else:
+                del self.buckets[key]
+        self.flags = [flag for flag in self.flags if chapter_index not in (flag["chapter"], flag["other_chapter"])]
+
+    def chapter_title(self, chapter_index):
+        with self.lock:
+            chapter = self.chapters.get(chapter_index)
+            return chapter["title"] if chapter else ""
+
+    def rewrite_plan(self):
+        # Flagged passages by chapter, a passage repeating several others is rewritten once
+        # against its most similar one
+        plan = {}
+        with self.lock:
+            for flag in sorted(self.flags, key=lambda flag: -flag["similarity"]):
+                passages = plan.setdefault(flag["chapter"], {})
+                passages.setdefault(flag["text"], flag)
+        return {chapter_index: list(passages.values()) for chapter_index, passages in sorted(plan.items())}
+
+    def covered_topics(self, exclude=None, max_chars=600):
+        # "Chapter: heading; heading" lines of the indexed chapters, shortened to max_chars
+        lines = []
+        used = 0
+        with self.lock:
+            chapters = sorted(self.chapters.items())
+        for chapter_index, chapter in chapters:
+            if chapter_index == exclude or not chapter["headings"]:
+                continue
+            line = f"- {chapter['title']}: {'; '.join(chapter['headings'])}"
+            if used + len(line) > max_chars:
+                break
+            lines.append(line)
+            used += len(line) + 1
+        return "\n".join(lines)
+
+    def stats(self):
+        with self.lock:
+            return {"chapters": len(self.chapters), "paragraphs": len(self.paragraphs), "flags": len(self.flags)}
@@ -0,0 +1,123 @@
+import re
+import math
+import hashlib
+import threading
+
+# Local index of the web sources found while researching a book.
+# Every source is counted once, keyed by its URL and by a hash of its text, so the same page
+# found by several chapter queries (or mirrored under another URL) is only sent once per prompt.
+# Chapters then take the few sources that match their title best instead of everything. They are
+# ranked among the results of the chapter's own search and the topic search only, so a chapter's
+# research text (and its cache key) does not change when other chapters of the TOC are edited.
+
+stop_words = {
+    "the", "and", "for", "with", "that", "this", "from", "are", "was", "were", "you", "your", "how",
+    "what", "why", "when", "who", "its", "into", "about", "can", "has", "have", "not", "but", "all",
+    "chapter", "section", "book",
+}
+
+def tokenize(text):
+    return [word for word in re.findall(r"[a-z0-9]+", text.lower()) if len(word) > 2 and word not in stop_words]
+
+def normalized_text_hash(text):
+    # Case and whitespace differences do not make a new source
+    normalized = " ".join(text.lower().split())
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+
+def make_source(result):
+    # A Tavily result as an indexed source, None for a result without text
+    text = (result.get("content") or result.get("snippet") or "").strip()
+    if not text:
+        return None
+    terms = tokenize(f"{result.get('title', '')} {text}")
+    return {
+        "url": (result.get("url") or "").strip(),
+        "title": (result.get("title") or "").strip(),
+        "text": text,
+        "hash": normalized_text_hash(text),
+        "score": float(result.get("score") or 0.0),
+        "terms": {term: terms.count(term) for term in set(terms)},
+        "length": max(len(terms), 1),
+    }
+
+class ResearchIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Sources of every query in result order, duplicates of other queries included
+        self.results = {}
+        self.by_url = set()
+        self.by_hash = set()
+        self.sources = 0
+        self.duplicates = 0
+
+    def add_results(self, results, query=""):
+        # Add the Tavily results of a query, returns how many sources were new to the book
+        sources = [source for source in map(make_source, results or []) if source]
+        added = 0
+        with self.lock:
+            self.results[query] = sources
+            for source in sources:
+                if (source["url"] and source["url"] in self.by_url) or source["hash"] in self.by_hash:
+                    self.duplicates += 1
+                    continue
+                if source["url"]:
+                    self.by_url.add(source["url"])
+                self.by_hash.add(source["hash"])
+                self.sources += 1
+                added += 1
+        return added
+
+    def candidates(self, queries):
+        # Sources found by the queries, each once, in query and result order
+        seen_urls = set()
+        seen_hashes = set()
+        candidates = []
+        with self.lock:
+            for query in queries:
+                for source in self.results.get(query, []):
+                    if (source["url"] and source["url"] in seen_urls) or source["hash"] in seen_hashes:
+                        continue
+                    if source["url"]:
+                        seen_urls.add(source["url"])
+                    seen_hashes.add(source["hash"])
+                    candidates.append(source)
+        return candidates
+
+    def top_sources(self, query, k, extra_queries=()):
+        # Rank the sources found by query and extra_queries by TF-IDF overlap with query, the search
+        # engine's own score breaks ties. Nothing else the book searched for changes the ranking.
+        candidates = self.candidates([query, *extra_queries])
+        document_frequency = {}
+        for source in candidates:
+            for term in source["terms"]:
+                document_frequency[term] = document_frequency.get(term, 0) + 1
+        query_terms = set(tokenize(query))
+        total = len(candidates)
+        ranked = []
+        for order, source in enumerate(candidates):
+            relevance = 0.0
+            for term in query_terms:
+                count = source["terms"].get(term)
+                if count:
+                    idf = math.log(1 + total / document_frequency[term])
+                    relevance += (count / source["length"]) * idf
+            ranked.append((-relevance, -source["score"], order, source))
+        ranked.sort(key=lambda item: item[:3])
+        return [item[3] for item in ranked[:k]]
+
+    def research_for(self, query, k, max_chars, extra_queries=()):
+        # Compact research notes for a prompt, each source trimmed to max_chars
+        notes = []
+        for number, source in enumerate(self.top_sources(query, k, extra_queries), start=1):
+            text = source["text"]
+            if len(text) > max_chars:
+                text = text[:max_chars].rsplit(" ", 1)[0] + "..."
+            header = f"[{number}] {source['title']}" if source["title"] else f"[{number}]"
+            if source["url"]:
+                header += f" ({source['url']})"
+            notes.append(f"{header}\n{text}")
+        return "\n\n".join(notes)
+
+    def stats(self):
+        with self.lock:
+            return {"sources": self.sources, "duplicates": self.duplicates}
@@ -0,0 +1,156 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+# Persistent cache for API responses (LLM text, Tavily results and image bytes).
+# Entries are keyed by a hash of (model, messages/prompt, parameters), kept in a single
+# SQLite file, evicted least recently used first once the size limit is reached and
+# expired after a time to live.
+
+cache_stages = ("research", "toc", "chapters", "images")
+
+class ResponseCache:
+    def __init__(self, path, max_bytes=2 * 1024 ** 3, ttl_seconds=30 * 24 * 3600, bypass=()):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.bypass = set(bypass)
+        self.lock = threading.Lock()
+        self.hits = {}
+        self.misses = {}
+        self.spent_cost = 0.0
+        self.saved_cost = 0.0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, stage TEXT, value BLOB, size INTEGER, cost REAL, created REAL, accessed REAL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+        self.connection.commit()
+        with self.lock:
+            self.purge_expired()
+            self.total_bytes = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    @staticmethod
+    def make_key(model, payload, params=None):
+        # Stable hash, dict ordering does not change the key
+        material = json.dumps({"model": model, "payload": payload, "params": params or {}}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def is_bypassed(self, stage):
+        return stage in self.bypass
+
+    def get(self, stage, key):
+        if self.is_bypassed(stage):
+            return None
+        with self.lock:
+            row = self.connection.execute("SELECT value, cost, created FROM entries WHERE key = ?", (key,)).fetchone()
+            now = time.time()
+            if row and self.ttl_seconds and now - row[2] > self.ttl_seconds:
+                self.delete(key)
+                row = None
+            if row is None:
+                self.misses[stage] = self.misses.get(stage, 0) + 1
+                return None
+            self.connection.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+            self.connection.commit()
+            self.hits[stage] = self.hits.get(stage, 0) + 1
+            self.saved_cost += row[1] or 0.0
+            return row[0]
+
+    def put(self, stage, key, value, cost=0.0):
+        # Cost is what producing the value paid, it counts as spent now and as saved on every later hit
+        with self.lock:
+            self.spent_cost += cost
+            if self.is_bypassed(stage):
+                return
+            size = len(value)
+            if size > self.max_bytes:
+                return
+            now = time.time()
+            old = self.connection.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            if old:
+                self.total_bytes -= old[0]
+            self.connection.execute(
+                "INSERT OR REPLACE INTO entries (key, stage, value, size, cost, created, accessed) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, stage, sqlite3.Binary(value) if isinstance(value, bytes) else value, size, cost, now, now)
+            )
+            self.total_bytes += size
+            self.evict()
+            self.connection.commit()
+
+    def get_text(self, stage, key):
+        value = self.get(stage, key)
+        if isinstance(value, bytes):
+            return value.decode("utf-8")
+        return value
+
+    def put_text(self, stage, key, text, cost=0.0):
+        self.put(stage, key, text.encode("utf-8"), cost)
+
+    def get_json(self, stage, key):
+        text = self.get_text(stage, key)
+        return json.loads(text) if text is not None else None
+
+    def put_json(self, stage, key, data, cost=0.0):
+        self.put_text(stage, key, json.dumps(data, ensure_ascii=False), cost)
+
+    def delete(self, key):
+        row = self.connection.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+        if row:
+            self.connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self.total_bytes -= row[0]
+            self.connection.commit()
+
+    def evict(self):
+        # Drop least recently used entries until the cache fits in max_bytes
+        while self.total_bytes > self.max_bytes:
+            rows = self.connection.execute("SELECT key, size FROM entries ORDER BY accessed LIMIT 32").fetchall()
+            if not rows:
+                self.total_bytes = 0
+                break
+            for key, size in rows:
+                self.connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self.total_bytes -= size
+                if self.total_bytes <= self.max_bytes:
+                    break
+
+    def purge_expired(self):
+        if self.ttl_seconds:
+            self.connection.execute("DELETE FROM entries WHERE created < ?", (time.time() - self.ttl_seconds,))
+            self.connection.commit()
+
+    def record_cost(self, cost):
+        # For calls that are not cached, e.g. when the stage is bypassed or the call was interrupted
+        with self.lock:
+            self.spent_cost += cost
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": dict(self.hits),
+                "misses": dict(self.misses),
+                "total_hits": sum(self.hits.values()),
+                "total_misses": sum(self.misses.values()),
+                "spent_cost": self.spent_cost,
+                "saved_cost": self.saved_cost,
+                "size_bytes": self.total_bytes,
+            }
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+# Build the cache from environment settings (see .env.example)
+def open_response_cache(bypass=()):
+    path = os.getenv("CACHE_PATH", os.path.join(".ebook_cache", "responses.sqlite3"))
+    max_bytes = int(float(os.getenv("CACHE_MAX_MB", "2048")) * 1024 * 1024)
+    ttl_seconds = int(float(os.getenv("CACHE_TTL_DAYS", "30")) * 24 * 3600)
+    env_bypass = [stage.strip() for stage in os.getenv("CACHE_BYPASS", "").split(",") if stage.strip()]
+    return ResponseCache(path, max_bytes, ttl_seconds, set(bypass) | set(env_bypass))
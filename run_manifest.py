@@ -0,0 +1,229 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+# Journal of a generation run, kept as manifest.json in the book folder.
+# It records the TOC, the state of every chapter and image with content hashes and the
+# money spent, so an interrupted run can be resumed without paying again for finished work.
+
+manifest_filename = "manifest.json"
+manifest_version = 1
+
+def content_hash(data):
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Write to a temporary file next to the target and rename it, so a crash never leaves a half written file
+def atomic_write_text(path, text):
+    atomic_write_chunks(path, [text])
+
+# Same for text that arrives in pieces, the pieces are written one by one
+def atomic_write_chunks(path, chunks):
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as file:
+        for chunk in chunks:
+            file.write(chunk)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+
+class RunManifest:
+    def __init__(self, book_folder, data=None):
+        self.book_folder = book_folder
+        self.path = os.path.join(book_folder, manifest_filename)
+        self.lock = threading.RLock()
+        self.data = data or {
+            "version": manifest_version,
+            "topic": "",
+            "toc": [],
+            "include_images": False,
+            "status": "new",
+            "chapters": {},
+            "images": {},
+            "cost": 0.0,
+            "updated": time.time(),
+        }
+        self.base_cost = self.data.get("cost", 0.0)
+
+    @classmethod
+    def load(cls, book_folder):
+        path = os.path.join(book_folder, manifest_filename)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                data = json.load(file)
+        except (OSError, ValueError) as e:
+            print(f"Failed to read run manifest {path}: {e}")
+            return None
+        if data.get("version") != manifest_version:
+            return None
+        return cls(book_folder, data)
+
+    @classmethod
+    def load_or_create(cls, book_folder):
+        return cls.load(book_folder) or cls(book_folder)
+
+    @property
+    def topic(self):
+        return self.data["topic"]
+
+    @property
+    def toc(self):
+        return list(self.data["toc"])
+
+    @property
+    def include_images(self):
+        return self.data["include_images"]
+
+    def save(self):
+        with self.lock:
+            self.data["updated"] = time.time()
+            atomic_write_text(self.path, json.dumps(self.data, indent=2, ensure_ascii=False))
+
+    def record_toc(self, topic, toc):
+        with self.lock:
+            self.data["topic"] = topic
+            self.data["toc"] = list(toc)
+            self.data["status"] = "toc_review"
+            self.save()
+
+    def start_run(self, topic, toc, include_images, resume=False):
+        # A fresh run forgets previous chapter and image states, a resumed run keeps them
+        with self.lock:
+            self.data["topic"] = topic
+            self.data["toc"] = list(toc)
+            self.data["include_images"] = include_images
+            self.data["status"] = "generating"
+            if not resume:
+                self.data["chapters"] = {}
+                self.data["images"] = {}
+            self.base_cost = self.data.get("cost", 0.0)
+            self.save()
+
+    def speculation_started(self, include_images):
+        # Chapters written during the TOC review belong to a run with these options,
+        # chapters of an earlier run with other options could not be reused anyway
+        with self.lock:
+            if self.data["include_images"] != include_images:
+                self.data["chapters"] = {}
+            self.data["include_images"] = include_images
+            self.save()
+
+    def finish_run(self):
+        with self.lock:
+            self.data["status"] = "complete"
+            self.save()
+
+    def chapter_file(self, safe_chapter_title):
+        return os.path.join(self.book_folder, f"{safe_chapter_title}.md")
+
+    def chapter_started(self, safe_chapter_title, chapter_title, index):
+        with self.lock:
+            self.data["chapters"][safe_chapter_title] = {
+                "title": chapter_title,
+                "index": index,
+                "file": f"{safe_chapter_title}.md",
+                "status": "writing",
+            }
+            self.save()
+
+    def chapter_done(self, safe_chapter_title, chapter_title, index, chapter_content, chapter_summary, context=None):
+        # context is the pair of neighbouring chapter titles the chapter was written with
+        with self.lock:
+            self.data["chapters"][safe_chapter_title] = {
+                "title": chapter_title,
+                "index": index,
+                "file": f"{safe_chapter_title}.md",
+                "status": "done",
+                "content_hash": content_hash(chapter_content),
+                "summary": chapter_summary,
+                "context": context,
+            }
+            self.save()
+
+    def chapter_edited(self, safe_chapter_title, chapter_content):
+        # A chapter saved from the editor stays reusable, a resumed run keeps the edit
+        with self.lock:
+            entry = self.data["chapters"].get(safe_chapter_title)
+            if entry:
+                entry["content_hash"] = content_hash(chapter_content)
+                self.save()
+
+    def chapter_entries(self):
+        with self.lock:
+            return {key: dict(entry) for key, entry in self.data["chapters"].items()}
+
+    def reset_chapters(self, keep_images=()):
+        # Forget every chapter and every image except keep_images (file names)
+        with self.lock:
+            self.data["chapters"] = {}
+            self.data["images"] = {name: entry for name, entry in self.data["images"].items() if name in keep_images}
+            self.save()
+
+    def reusable_chapter(self, safe_chapter_title):
+        # Returns (content, summary) when the chapter finished and its file still matches the recorded hash
+        with self.lock:
+            entry = self.data["chapters"].get(safe_chapter_title)
+        if not entry or entry.get("status") != "done" or entry.get("summary") is None:
+            return None
+        path = self.chapter_file(safe_chapter_title)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as file:
+            chapter_content = file.read()
+        if content_hash(chapter_content) != entry.get("content_hash"):
+            return None
+        return chapter_content, entry["summary"]
+
+    def image_done(self, image_name, digest):
+        # Images are kept in the book's asset store, the manifest maps their names to content hashes
+        with self.lock:
+            self.data["images"][image_name] = {
+                "status": "done",
+                "content_hash": digest,
+            }
+            self.save()
+
+    def image_hash(self, image_name):
+        with self.lock:
+            entry = self.data["images"].get(image_name)
+        if not entry or entry.get("status") != "done":
+            return None
+        return entry.get("content_hash")
+
+    def image_hashes(self):
+        with self.lock:
+            return {name: entry["content_hash"] for name, entry in self.data["images"].items() if entry.get("status") == "done"}
+
+    def set_run_cost(self, cost_since_start):
+        # Costs add up across resumed runs
+        with self.lock:
+            self.data["cost"] = self.base_cost + cost_since_start
+            self.save()
+
+    def set_token_report(self, report):
+        with self.lock:
+            self.data["tokens"] = report
+            self.save()
+
+    def summary(self):
+        with self.lock:
+            chapters = self.data["chapters"].values()
+            done = sum(1 for entry in chapters if entry.get("status") == "done")
+            return {
+                "status": self.data["status"],
+                "chapters_done": done,
+                "images_done": len(self.data["images"]),
+                "cost": self.data.get("cost", 0.0),
+            }
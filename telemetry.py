@@ -0,0 +1,142 @@
+import io
+import os
+import csv
+import json
+import time
+import threading
+from run_manifest import atomic_write_text
+
+# Trace of every agent call in a run: latency, time queued in the scheduler, retries, tokens,
+# images and cost. The trace is exported as telemetry.json and telemetry.csv in the book folder
+# and summarised live (throughput and critical path) in the app's header.
+
+stage_agents = {
+    "research": "Researcher",
+    "toc": "ContentOrganizer",
+    "chapters": "Writer",
+    "summaries": "Writer",
+    "continuations": "Writer",
+    "rewrites": "Writer",
+    "editor": "Writer",
+    "images": "Designer",
+    "downloads": "Designer",
+}
+text_stages = ("research", "toc", "chapters", "summaries", "continuations", "rewrites", "editor")
+image_stages = ("images", "downloads")
+trace_fields = [
+    "stage", "agent", "model", "start", "latency", "queue_wait", "retries",
+    "prompt_tokens", "completion_tokens", "images", "cost", "cached", "ok",
+]
+
+class RunTelemetry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.started_at = time.time()
+        self.spans = []
+        self.chapters_written = 0
+        self.generation_started = None
+        self.generation_finished = None
+
+    def record(self, stage, model, started, call_stats=None, prompt_tokens=0, completion_tokens=0,
+               images=0, cost=0.0, cached=False, ok=True):
+        # started is the time.monotonic() value taken before the call, call_stats come from the scheduler
+        call_stats = call_stats or {}
+        span = {
+            "stage": stage,
+            "agent": stage_agents.get(stage, ""),
+            "model": model,
+            "start": round(started - self.started, 3),
+            "latency": round(time.monotonic() - started, 3),
+            "queue_wait": round(call_stats.get("queue_wait", 0.0), 3),
+            "retries": call_stats.get("retries", 0),
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "images": images,
+            "cost": round(cost, 6),
+            "cached": cached,
+            "ok": ok,
+        }
+        with self.lock:
+            self.spans.append(span)
+
+    def chapter_written(self):
+        with self.lock:
+            self.chapters_written += 1
+
+    def begin_generation(self):
+        with self.lock:
+            self.generation_started = time.monotonic() - self.started
+            self.generation_finished = None
+
+    def end_generation(self):
+        with self.lock:
+            self.generation_finished = time.monotonic() - self.started
+
+    def summary(self):
+        with self.lock:
+            spans = list(self.spans)
+            chapters_written = self.chapters_written
+            window_start = self.generation_started or 0.0
+            window_end = self.generation_finished or (time.monotonic() - self.started)
+
+        stages = {}
+        models = {}
+        text_end = image_end = None
+        completion_tokens = 0
+        for span in spans:
+            totals = stages.setdefault(span["stage"], {
+                "calls": 0, "cached": 0, "failed": 0, "retries": 0, "latency": 0.0, "queue_wait": 0.0,
+                "prompt_tokens": 0, "completion_tokens": 0, "images": 0, "cost": 0.0,
+            })
+            totals["calls"] += 1
+            totals["cached"] += 1 if span["cached"] else 0
+            totals["failed"] += 0 if span["ok"] else 1
+            for name in ("retries", "latency", "queue_wait", "prompt_tokens", "completion_tokens", "images", "cost"):
+                totals[name] += span[name]
+            models[span["model"]] = models.get(span["model"], 0.0) + span["cost"]
+            end = span["start"] + span["latency"]
+            if span["start"] >= window_start:
+                if span["stage"] in text_stages:
+                    text_end = end if text_end is None else max(text_end, end)
+                    if not span["cached"]:
+                        completion_tokens += span["completion_tokens"]
+                elif span["stage"] in image_stages:
+                    image_end = end if image_end is None else max(image_end, end)
+
+        window = max(window_end - window_start, 0.001)
+        if text_end is not None and image_end is not None and image_end > text_end:
+            critical_path = f"images (+{image_end - text_end:.1f}s after text)"
+        elif text_end is not None:
+            critical_path = "text"
+        else:
+            critical_path = ""
+        return {
+            "elapsed": round(window, 3),
+            "tokens_per_second": round(completion_tokens / window, 2),
+            "chapters_per_minute": round(chapters_written * 60 / window, 2),
+            "chapters_written": chapters_written,
+            "critical_path": critical_path,
+            "cost": round(sum(models.values()), 6),
+            "cost_by_model": {model: round(cost, 6) for model, cost in models.items()},
+            "stages": stages,
+        }
+
+    def status_line(self):
+        summary = self.summary()
+        line = f"{summary['tokens_per_second']:.0f} tok/s, {summary['chapters_per_minute']:.1f} ch/min"
+        if summary["critical_path"]:
+            line += f", critical path: {summary['critical_path']}"
+        return line
+
+    def export(self, folder):
+        # telemetry.json holds the summary and every span, telemetry.csv only the spans
+        with self.lock:
+            spans = list(self.spans)
+        trace = {"started_at": self.started_at, "summary": self.summary(), "spans": spans}
+        atomic_write_text(os.path.join(folder, "telemetry.json"), json.dumps(trace, indent=2))
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=trace_fields, lineterminator="\n")
+        writer.writeheader()
+        writer.writerows(spans)
+        atomic_write_text(os.path.join(folder, "telemetry.csv"), buffer.getvalue())
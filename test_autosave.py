@@ -0,0 +1,50 @@
+import os
+from autosave import AutosaveService, revisions_folder_name
+
+def changes(book_folder, chapters, merged):
+    return {
+        "book_folder": str(book_folder),
+        "chapters": chapters,
+        "merged": [merged],
+        "merged_path": os.path.join(str(book_folder), "Book.md"),
+    }
+
+def revisions(book_folder):
+    folder = os.path.join(str(book_folder), revisions_folder_name)
+    return sorted(os.listdir(folder)) if os.path.isdir(folder) else []
+
+def test_saves_write_chapters_and_merged_book(tmp_path):
+    saved = []
+    autosaver = AutosaveService(on_saved=lambda count, path: saved.append((count, path)))
+    count, merged_path = autosaver.submit(changes(tmp_path, {"a.md": "A"}, "Book A")).result()
+    autosaver.close()
+    assert (count, merged_path) == (1, os.path.join(str(tmp_path), "Book.md"))
+    assert saved == [(1, merged_path)]
+    with open(os.path.join(str(tmp_path), "a.md"), encoding="utf-8") as file:
+        assert file.read() == "A"
+    with open(merged_path, encoding="utf-8") as file:
+        assert file.read() == "Book A"
+
+def test_revisions_are_taken_at_most_once_per_interval(tmp_path):
+    autosaver = AutosaveService(max_revisions=5, revision_interval=3600)
+    for number in range(3):
+        autosaver.submit(changes(tmp_path, {}, f"Book {number}")).result()
+    assert len(revisions(tmp_path)) == 1
+    autosaver.revision_interval = 0
+    for number in range(8):
+        autosaver.submit(changes(tmp_path, {}, f"Book {number}")).result()
+    autosaver.close()
+    # Only the newest max_revisions copies are kept
+    assert len(revisions(tmp_path)) == 5
+
+def test_failed_write_is_retried_with_the_next_save(tmp_path):
+    errors = []
+    autosaver = AutosaveService(on_error=errors.append)
+    missing = tmp_path / "missing"
+    future = autosaver.submit(changes(missing, {"a.md": "A"}, "Book"))
+    assert future.exception() is not None and len(errors) == 1
+    os.makedirs(str(missing))
+    count, _ = autosaver.submit(changes(missing, {"b.md": "B"}, "Book")).result()
+    autosaver.close()
+    assert count == 2
+    assert sorted(os.listdir(str(missing))) == sorted(["a.md", "b.md", "Book.md", revisions_folder_name])
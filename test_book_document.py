@@ -0,0 +1,49 @@
+import os
+from book_document import BookDocument, write_changes
+
+def make_document(book_folder):
+    document = BookDocument(str(book_folder), "Bees", ["CHAPTER 01 - Hives", "CHAPTER 02 - Honey"])
+    document.load_chapter(0, "# CHAPTER 01 - Hives\n\nHive text.")
+    document.load_chapter(1, "# CHAPTER 02 - Honey\n\nHoney text.")
+    return document
+
+def test_take_changes_holds_only_edited_chapters(tmp_path):
+    document = make_document(tmp_path)
+    assert document.set_text(2, "# CHAPTER 02 - Honey\n\nEdited.")
+    assert not document.set_text(1, document.text(1))
+    changes = document.take_changes()
+    assert changes["chapters"] == {"CHAPTER_02_-_Honey.md": "# CHAPTER 02 - Honey\n\nEdited."}
+    assert "".join(changes["merged"]) == document.markdown()
+    # The segments count as saved once the changes are taken
+    assert not document.is_dirty()
+    assert document.take_changes()["chapters"] == {}
+
+def test_changes_are_a_snapshot(tmp_path):
+    document = make_document(tmp_path)
+    document.set_text(1, "First edit.")
+    changes = document.take_changes()
+    document.set_text(1, "Second edit.")
+    assert changes["chapters"]["CHAPTER_01_-_Hives.md"] == "First edit."
+    assert "Second edit." not in "".join(changes["merged"])
+
+def test_streamed_pieces_and_edits_during_generation(tmp_path):
+    document = BookDocument(str(tmp_path), "Bees", ["CHAPTER 01 - Hives"])
+    document.append_text(1, "# CHAPTER 01 - Hives\n")
+    document.append_text(1, "Streamed.")
+    assert document.text(1) == "# CHAPTER 01 - Hives\nStreamed."
+    document.set_text(1, "Edited while writing.")
+    # The finished chapter does not overwrite the edit
+    document.load_chapter(0, "# CHAPTER 01 - Hives\nStreamed.")
+    assert document.text(1) == "Edited while writing."
+
+def test_write_changes(tmp_path):
+    document = make_document(tmp_path)
+    document.set_text(1, "Edited.")
+    saved, merged_path = write_changes(document.take_changes())
+    assert saved == 1
+    assert merged_path == os.path.join(str(tmp_path), "Bees.md")
+    with open(os.path.join(str(tmp_path), "CHAPTER_01_-_Hives.md"), encoding="utf-8") as file:
+        assert file.read() == "Edited."
+    with open(merged_path, encoding="utf-8") as file:
+        assert file.read() == document.markdown()
+    assert not os.path.exists(os.path.join(str(tmp_path), "CHAPTER_02_-_Honey.md"))
@@ -0,0 +1,49 @@
+import os
+import shutil
+from book_library import BookLibrary
+from run_manifest import RunManifest, atomic_write_text
+
+def write_book(root, topic, chapters):
+    folder = os.path.join(str(root), topic.replace(" ", "_"))
+    os.makedirs(folder, exist_ok=True)
+    manifest = RunManifest.load_or_create(folder)
+    manifest.start_run(topic, list(chapters), False)
+    for index, (title, text) in enumerate(chapters.items()):
+        key = title.replace(" ", "_")
+        atomic_write_text(manifest.chapter_file(key), text)
+        manifest.chapter_done(key, title, index, text, "Summary.")
+    manifest.finish_run()
+    return folder
+
+def test_search_finds_chapters_and_topics(tmp_path):
+    write_book(tmp_path / "books", "Urban beekeeping", {
+        "CHAPTER 01 - Hives": "# Hives\n\nA rooftop hive needs shade and water.",
+        "CHAPTER 02 - Honey": "# Honey\n\nExtracting honey with a centrifuge.",
+    })
+    write_book(tmp_path / "books", "Color psychology", {"CHAPTER 01 - Red": "# Red\n\nRed raises attention."})
+    library = BookLibrary(str(tmp_path / "library.sqlite3"))
+    assert library.refresh(str(tmp_path / "books")) == 2
+    results = library.search("centrifuge")
+    assert [(result["topic"], result["chapter"]) for result in results] == [("Urban beekeeping", "CHAPTER 02 - Honey")]
+    assert "«centrifuge»" in results[0]["snippet"]
+    # Prefixes match, and operators typed into the search box do not break the query
+    assert [result["chapter"] for result in library.search("roof* AND (")] == ["CHAPTER 01 - Hives"]
+    assert library.search("   ") == []
+    assert library.search("psychology")[0]["chapter"] == ""
+    library.close()
+
+def test_refresh_is_incremental(tmp_path):
+    folder = write_book(tmp_path / "books", "Urban beekeeping", {"CHAPTER 01 - Hives": "# Hives\n\nShade and water."})
+    library = BookLibrary(str(tmp_path / "library.sqlite3"))
+    assert library.refresh(str(tmp_path / "books")) == 1
+    assert library.refresh(str(tmp_path / "books")) == 0
+    # A chapter saved from the editor is re-indexed without a manifest change
+    atomic_write_text(os.path.join(folder, "CHAPTER_01_-_Hives.md"), "# Hives\n\nSmoke calms the bees.")
+    assert library.refresh(str(tmp_path / "books")) == 1
+    assert library.search("smoke") and not library.search("shade")
+    assert library.load_book(folder)["chapters"] == {"CHAPTER 01 - Hives": "# Hives\n\nSmoke calms the bees."}
+    # Deleted books are dropped
+    shutil.rmtree(folder)
+    assert library.refresh(str(tmp_path / "books")) == 1
+    assert library.books() == [] and library.search("smoke") == []
+    library.close()
@@ -0,0 +1,40 @@
+from chapter_validation import MarkdownNormalizer, normalize_markdown, truncation_reason
+
+# Checks as the chapter writer makes them: the answer is fed without a final newline, then
+# finish_fence_line runs before truncation_reason.
+
+def check_answer(answer, finish_reason="stop"):
+    normalizer = MarkdownNormalizer()
+    text = "".join(normalizer.feed(answer))
+    if finish_reason != "length":
+        text += "".join(normalizer.finish_fence_line())
+    return truncation_reason(normalizer, finish_reason), text + "".join(normalizer.close())
+
+def test_markdown_wrapped_answer_is_complete():
+    reason, text = check_answer("```markdown\n# Chapter\n\nA complete sentence.\n```")
+    assert reason is None
+    assert text == "# Chapter\n\nA complete sentence."
+
+def test_answer_ending_with_code_block_is_complete():
+    reason, text = check_answer("# Chapter\n\nAn example:\n\n```python\nprint('done')\n```")
+    assert reason is None
+    assert text.endswith("```python\nprint('done')\n```")
+
+def test_answer_ending_with_code_block_and_newline_is_complete():
+    reason, _ = check_answer("# Chapter\n\n```python\nprint('done')\n```\n")
+    assert reason is None
+
+def test_unfinished_sentence_is_cut_off():
+    reason, _ = check_answer("# Chapter\n\nThis sentence stops in the")
+    assert reason == "unfinished sentence"
+
+def test_unclosed_code_block_is_cut_off():
+    reason, _ = check_answer("# Chapter\n\n```python\nprint('a')")
+    assert reason == "unclosed code block"
+
+def test_length_limit_is_cut_off():
+    reason, _ = check_answer("# Chapter\n\nA complete sentence.\n```", "length")
+    assert reason == "length limit"
+
+def test_normalize_markdown_keeps_code_blocks():
+    assert normalize_markdown("# Title\n\n```\ncode\n```") == "# Title\n\n```\ncode\n```"
@@ -0,0 +1,18 @@
+import prompt_builder
+from prompt_builder import count_tokens
+
+class OfflineTiktoken:
+    # tiktoken without its encoding files and without network access
+    def encoding_for_model(self, model):
+        raise KeyError(model)
+
+    def get_encoding(self, name):
+        raise OSError("could not download the encoding")
+
+def test_count_tokens_estimates_without_encoding(monkeypatch):
+    monkeypatch.setattr(prompt_builder, "tiktoken", OfflineTiktoken())
+    monkeypatch.setattr(prompt_builder, "encodings", {})
+    assert count_tokens("a" * 40, "offline-model") == 10
+    # The failure is remembered, the encoding is not loaded again
+    assert prompt_builder.encodings == {"offline-model": None}
+    assert count_tokens("abcd", "offline-model") == 1
@@ -0,0 +1,38 @@
+from redundancy_index import RedundancyIndex
+
+repeated = ("Honey bees collect nectar from flowering plants and store it inside wax cells, where enzymes and "
+            "evaporation slowly turn the nectar into honey that feeds the colony through long cold winter months "
+            "when no flowers bloom outside the hive entrance.")
+unrelated = ("Beekeepers inspect every frame carefully during spring, checking brood patterns, queen health, mite "
+             "counts and stored pollen before deciding whether the colony needs more space, another super or a "
+             "split to prevent swarming later that season.")
+
+def chapter(title, *paragraphs):
+    return f"# {title}\n\n## {title} basics\n\n" + "\n\n".join(paragraphs)
+
+def test_repeated_paragraph_is_flagged_in_the_later_chapter():
+    index = RedundancyIndex(0.5)
+    assert index.add_chapter(2, "Honey", chapter("Honey", repeated)) == []
+    flags = index.add_chapter(0, "Bees", chapter("Bees", repeated, unrelated))
+    assert len(flags) == 1
+    assert (flags[0]["chapter"], flags[0]["other_chapter"], flags[0]["similarity"]) == (2, 0, 1.0)
+    assert list(index.rewrite_plan()) == [2]
+
+def test_unrelated_paragraphs_are_not_flagged():
+    index = RedundancyIndex(0.5)
+    index.add_chapter(0, "Bees", chapter("Bees", repeated))
+    assert index.add_chapter(1, "Hives", chapter("Hives", unrelated)) == []
+
+def test_rewritten_chapter_replaces_its_flags():
+    index = RedundancyIndex(0.5)
+    index.add_chapter(0, "Bees", chapter("Bees", repeated))
+    index.add_chapter(1, "Honey", chapter("Honey", repeated))
+    index.add_chapter(1, "Honey", chapter("Honey", unrelated))
+    assert index.stats() == {"chapters": 2, "paragraphs": 2, "flags": 0}
+
+def test_covered_topics_lists_headings_in_chapter_order():
+    index = RedundancyIndex(0.5)
+    index.add_chapter(1, "Hives", chapter("Hives", unrelated))
+    index.add_chapter(0, "Bees", chapter("Bees", repeated))
+    assert index.covered_topics() == "- Bees: Bees basics\n- Hives: Hives basics"
+    assert index.covered_topics(exclude=0) == "- Hives: Hives basics"
@@ -0,0 +1,30 @@
+from research_index import ResearchIndex
+
+def result(url, title, content, score=0.5):
+    return {"url": url, "title": title, "content": content, "score": score}
+
+def book_index(extra_chapters=()):
+    index = ResearchIndex()
+    index.add_results([result("https://a.example/topic", "Bees", "Bees live in hives and make honey.")], "Bees")
+    index.add_results([
+        result("https://a.example/hives", "Hives", "Hive boxes, frames and hive inspections for bees."),
+        result("https://a.example/honey", "Honey", "Harvesting honey from the hive."),
+    ], "Bees: Hives")
+    for query, results in extra_chapters:
+        index.add_results(results, query)
+    return index
+
+def test_chapter_research_ignores_other_chapters():
+    before = book_index().research_for("Bees: Hives", 2, 200, ("Bees",))
+    after = book_index([("Bees: Hive pests", [
+        result("https://b.example/pests", "Hive pests", "Mites and beetles in the hive."),
+        result("https://a.example/honey", "Honey", "Harvesting honey from the hive."),
+    ])]).research_for("Bees: Hives", 2, 200, ("Bees",))
+    assert before == after
+    assert "Hive boxes" in before
+
+def test_duplicates_are_kept_once():
+    index = book_index([("Bees: Honey", [result("https://mirror.example/honey", "Honey", "harvesting  honey from the HIVE.")])])
+    assert index.stats() == {"sources": 3, "duplicates": 1}
+    # The mirrored page still counts for the chapter whose search found it
+    assert [source["url"] for source in index.top_sources("Bees: Honey", 5)] == ["https://mirror.example/honey"]
@@ -0,0 +1,50 @@
+from toc_diff import chapter_context, normalize_chapter_title, plan_chapter_reuse, unchanged_chapters
+
+# Previous chapters as the manifest records them, keyed like the chapter files
+
+def previous_run(chapter_titles):
+    return {
+        f"key{index}": {"title": title, "index": index, "status": "done", "context": chapter_context(chapter_titles, index)}
+        for index, title in enumerate(chapter_titles)
+    }
+
+toc = ["CHAPTER 01 - Why bees", "CHAPTER 02 - Hives", "CHAPTER 03 - Honey", "CHAPTER 04 - Winter"]
+
+def test_unchanged_toc_reuses_every_chapter():
+    assert plan_chapter_reuse(previous_run(toc), toc) == {0: "key0", 1: "key1", 2: "key2", 3: "key3"}
+
+def test_renumbering_and_punctuation_are_not_a_change():
+    assert normalize_chapter_title("CHAPTER 07: Why Bees?") == normalize_chapter_title("CHAPTER 01 - why bees")
+
+def test_renamed_chapter_and_its_neighbours_are_written_again():
+    edited = ["CHAPTER 01 - Why bees", "CHAPTER 02 - Hive boxes", "CHAPTER 03 - Honey", "CHAPTER 04 - Winter"]
+    assert plan_chapter_reuse(previous_run(toc), edited) == {3: "key3"}
+
+def test_insert_shifts_neighbours():
+    edited = ["CHAPTER 01 - Why bees", "CHAPTER 02 - Hives", "CHAPTER 03 - Pests", "CHAPTER 04 - Honey", "CHAPTER 05 - Winter"]
+    # Hives and Honey now border Pests, Winter is renumbered but keeps its neighbours
+    assert plan_chapter_reuse(previous_run(toc), edited) == {0: "key0", 4: "key3"}
+
+def test_delete():
+    edited = ["CHAPTER 01 - Why bees", "CHAPTER 02 - Hives", "CHAPTER 03 - Winter"]
+    assert plan_chapter_reuse(previous_run(toc), edited) == {0: "key0"}
+
+def test_reorder():
+    edited = ["CHAPTER 01 - Why bees", "CHAPTER 02 - Hives", "CHAPTER 03 - Winter", "CHAPTER 04 - Honey"]
+    assert plan_chapter_reuse(previous_run(toc), edited) == {0: "key0"}
+
+def test_duplicated_title_matches_the_closest_previous_chapter():
+    previous = ["CHAPTER 01 - Basics", "CHAPTER 02 - Review", "CHAPTER 03 - Basics", "CHAPTER 04 - Review"]
+    assert plan_chapter_reuse(previous_run(previous), previous) == {0: "key0", 1: "key1", 2: "key2", 3: "key3"}
+    # Both "Review" chapters stay, each one is matched once
+    edited = previous + ["CHAPTER 05 - Review"]
+    assert plan_chapter_reuse(previous_run(previous), edited) == {0: "key0", 1: "key1", 2: "key2"}
+
+def test_unfinished_chapters_are_not_reused():
+    previous = previous_run(toc)
+    previous["key2"]["status"] = "writing"
+    assert plan_chapter_reuse(previous, toc) == {0: "key0", 1: "key1", 3: "key3"}
+
+def test_unchanged_chapters_of_a_proposed_toc():
+    edited = ["CHAPTER 01 - Why bees", "CHAPTER 02 - Hives", "CHAPTER 03 - Winter"]
+    assert unchanged_chapters(toc, edited) == {0}
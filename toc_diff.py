@@ -0,0 +1,49 @@
+import re
+
+# Diff of an edited TOC against the chapters of the previous run.
+# Chapters are matched by normalised title, so renumbering ("CHAPTER 02" becoming "CHAPTER 03"),
+# case and punctuation changes do not count as a change. A chapter is written with its neighbours
+# in mind, so it is only reused when the chapters before and after it are unchanged as well.
+
+def strip_chapter_number(chapter_title):
+    return re.sub(r"^\s*CHAPTER\s+\d+\s*[-:.]?\s*", "", chapter_title, flags=re.IGNORECASE)
+
+def normalize_chapter_title(chapter_title):
+    return " ".join(re.findall(r"[a-z0-9]+", strip_chapter_number(chapter_title).lower()))
+
+# Normalised titles of the previous and next chapter ("" at either end of the book)
+def chapter_context(chapter_titles, index):
+    previous_title = normalize_chapter_title(chapter_titles[index - 1]) if index > 0 else ""
+    next_title = normalize_chapter_title(chapter_titles[index + 1]) if index + 1 < len(chapter_titles) else ""
+    return [previous_title, next_title]
+
+def plan_chapter_reuse(previous_chapters, chapter_titles):
+    # previous_chapters are the manifest's chapter entries, returns {index in chapter_titles: previous entry key}
+    candidates = {}
+    for key, entry in previous_chapters.items():
+        if entry.get("status") != "done" or entry.get("context") is None:
+            continue
+        candidates.setdefault(normalize_chapter_title(entry["title"]), []).append((entry.get("index", 0), key, entry))
+
+    plan = {}
+    for index, chapter_title in enumerate(chapter_titles):
+        matches = candidates.get(normalize_chapter_title(chapter_title))
+        if not matches:
+            continue  # New chapter
+        # The same title can appear twice, take the previous chapter closest in position
+        matches.sort(key=lambda match: abs(match[0] - index))
+        previous_index, key, entry = matches.pop(0)
+        if list(entry["context"]) == chapter_context(chapter_titles, index):
+            plan[index] = key
+    return plan
+
+# Indexes of proposed_titles whose chapter would be reused if chapter_titles were approved
+def unchanged_chapters(proposed_titles, chapter_titles):
+    approved = {
+        (normalize_chapter_title(chapter_title), tuple(chapter_context(chapter_titles, index)))
+        for index, chapter_title in enumerate(chapter_titles)
+    }
+    return {
+        index for index, chapter_title in enumerate(proposed_titles)
+        if (normalize_chapter_title(chapter_title), tuple(chapter_context(proposed_titles, index))) in approved
+    }